@@ -0,0 +1,221 @@
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import tracemalloc
+from time import perf_counter
+from typing import List, Dict, Tuple, Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ultimate1541.ansi_reader import BufferedAnsiReaderWriter
+from ultimate1541.console_manipulator import ConsoleManipulator
+from ultimate1541.recording import read_records, INBOUND
+from ultimate1541.simulator.menu import MenuUI, default_settings
+
+# Measures the screen scraping pipeline: AnsiReaderWriter.read_token -> PseudoScreen.write
+# -> ConsoleManipulator.get_big_menu / get_small_menu, on telnet streams recorded from the simulator's menu.
+#
+#     python benchmarks/screen_pipeline.py [--save] [--baseline <file>] [--tolerance <fraction>]
+#         [--recording <file>]
+#
+# --recording adds the screen output of a session recorded with u1541.py --record, one screen per burst of keys.
+# Without --save, the results are compared with the baseline and the exit status is 1 if any got worse
+# by more than the tolerance. Timings depend on the machine, so save a baseline on the machine that compares.
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'screen_pipeline_baseline.json')
+DEFAULT_TOLERANCE = 0.25
+# the size of TCP segments the streams are cut into, so that escape sequences get split like on the wire
+SEGMENT_SIZE = 1460
+REPEATS = 5
+
+# metric -> True if higher is better
+METRICS = {
+    'tokens_per_second': True,
+    'bytes_per_second': True,
+    'median_screen_ms': False,
+    'p95_screen_ms': False,
+    'peak_bytes_per_redraw': False,
+}
+
+
+def record(root: str, keys: List[str]) -> List[bytes]:
+    # the screens drawn by the simulated menu, the first one and then one after each key
+    ui = MenuUI(root, default_settings(), [], threading.Lock())
+    screens = [ui.render()]
+    for key in keys:
+        if ':' in key:
+            # a group of keys sent together, redrawn once
+            for k in key.split(':'):
+                ui.press(k)
+        else:
+            ui.press(key)
+        screens.append(ui.render())
+    return screens
+
+
+def make_tree(root: str):
+    for device in ('Usb0', 'Usb1', 'SD'):
+        os.makedirs(os.path.join(root, device), exist_ok=True)
+    large = os.path.join(root, 'Usb0', 'Collection')
+    os.makedirs(large, exist_ok=True)
+    for i in range(1000):
+        with open(os.path.join(large, 'Game number {:04d}.d64'.format(i)), 'wb') as f:
+            f.write(b'\0' * (i % 7))
+    for i in range(20):
+        os.makedirs(os.path.join(large, 'Folder {:02d}'.format(i)), exist_ok=True)
+
+
+def scenarios(root: str) -> Dict[str, List[bytes]]:
+    return {
+        # the device list, redrawn completely for every key
+        'full_redraw': record(root, ['down', 'down', 'up', 'up'] * 25),
+        # scrolling through a directory of a thousand entries
+        'large_directory': record(root, ['right', 'right'] + ['down'] * 300 + ['down:down:down:down:down'] * 40),
+        # the F2 settings tree: categories and their settings
+        'settings': record(root, ['f2'] + ['return', 'down', 'down', 'down', 'left', 'down'] * 10),
+        # the context menu of a file and the value choosers of settings, over the file browser
+        'nested_popups': record(root, ['right', 'right'] + ['return', 'down', 'left', 'down'] * 20 +
+                                ['f2', 'down', 'down', 'return', 'down', 'return'] +
+                                ['return', 'down', 'down', 'up', 'left'] * 15),
+    }
+
+
+def recorded_screens(path: str) -> List[bytes]:
+    screens = []
+    current = bytearray()
+    for record in read_records(path):
+        if record.kind == INBOUND:
+            current += record.data
+        elif current:
+            screens.append(bytes(current))
+            current = bytearray()
+    if current:
+        screens.append(bytes(current))
+    return screens
+
+
+def run_pipeline(screens: List[bytes], on_screen: Callable[[float], None] = lambda t: None) -> int:
+    # returns the number of tokens
+    reader = BufferedAnsiReaderWriter()
+    console = ConsoleManipulator(reader)
+    screen = console.screen
+    tokens = 0
+    for data in screens:
+        start = perf_counter()
+        for position in range(0, len(data), SEGMENT_SIZE):
+            reader.feed(data[position:position + SEGMENT_SIZE])
+            while True:
+                t = reader.read_token()
+                if t is None:
+                    break
+                screen.write(t)
+                tokens += 1
+        if console.get_small_menu() is None:
+            console.get_big_menu()
+        on_screen(perf_counter() - start)
+    return tokens
+
+
+def measure(screens: List[bytes]) -> Dict[str, float]:
+    size = sum(len(s) for s in screens)
+    best = None
+    latencies: List[float] = []
+    tokens = 0
+    for _ in range(REPEATS):
+        run: List[float] = []
+        start = perf_counter()
+        tokens = run_pipeline(screens, run.append)
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+            latencies = run
+    latencies.sort()
+    # memory is measured separately, tracing slows everything down
+    tracemalloc.start()
+    peaks: List[int] = []
+
+    def peak(_):
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    tracemalloc.reset_peak()
+    run_pipeline(screens, peak)
+    tracemalloc.stop()
+    return {
+        'screens': len(screens),
+        'bytes': size,
+        'tokens': tokens,
+        'tokens_per_second': tokens / best,
+        'bytes_per_second': size / best,
+        'median_screen_ms': statistics.median(latencies) * 1000,
+        'p95_screen_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        'peak_bytes_per_redraw': statistics.median(peaks),
+    }
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[Tuple[str, str, float, float]]:
+    # returns (scenario, metric, baseline, result) for everything that got worse by more than the tolerance
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, higher_is_better in METRICS.items():
+            old = baseline.get(scenario, {}).get(metric)
+            if old is None or old == 0:
+                continue
+            new = metrics[metric]
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append((scenario, metric, old, new))
+    return regressions
+
+
+def format_row(name: str, metrics: Dict[str, float], baseline: Dict[str, float]) -> str:
+    def cell(metric: str, fmt: str) -> str:
+        text = fmt.format(metrics[metric])
+        if metric in baseline and baseline[metric]:
+            text += ' ({:+.0%})'.format((metrics[metric] - baseline[metric]) / baseline[metric])
+        return text
+
+    return '{:16} {:>6} {:>20} {:>22} {:>16} {:>16} {:>18}'.format(
+        name, int(metrics['screens']), cell('tokens_per_second', '{:.0f}'), cell('bytes_per_second', '{:.0f}'),
+        cell('median_screen_ms', '{:.3f}'), cell('p95_screen_ms', '{:.3f}'), cell('peak_bytes_per_redraw', '{:.0f}'))
+
+
+def main(args: List[str]):
+    save = '--save' in args
+    baseline_path = args[args.index('--baseline') + 1] if '--baseline' in args else BASELINE
+    tolerance = float(args[args.index('--tolerance') + 1]) if '--tolerance' in args else DEFAULT_TOLERANCE
+    baseline: Dict[str, Dict[str, float]] = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root)
+        streams = scenarios(root)
+    if '--recording' in args:
+        streams['recording'] = recorded_screens(args[args.index('--recording') + 1])
+    results = {}
+    print('{:16} {:>6} {:>20} {:>22} {:>16} {:>16} {:>18}'.format(
+        'scenario', 'screens', 'tokens/s', 'bytes/s', 'median ms', 'p95 ms', 'peak B/redraw'))
+    for name, screens in streams.items():
+        results[name] = measure(screens)
+        print(format_row(name, results[name], {} if save else baseline.get(name, {})))
+    if save:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print('Saved the baseline to ' + baseline_path)
+        return 0
+    if not baseline:
+        print('No baseline to compare with, run with --save to create one')
+        return 0
+    regressions = compare(results, baseline, tolerance)
+    for scenario, metric, old, new in regressions:
+        print('Regression: {} {}: {:.3f} -> {:.3f}'.format(scenario, metric, old, new))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,63 +1,169 @@
+import json
 import os
 import sys
 import traceback
 from builtins import ValueError
-from typing import List, Callable, Dict
+from typing import List, Callable, Dict, Optional, Tuple, Union
 
-from ultimate1541 import Ultimate1541
+from ultimate1541 import Ultimate1541, agent, tracing
+from ultimate1541.command_context import CommandContext
+from ultimate1541.menu_cache import MenuCache
+from ultimate1541.fleet import DEFAULT_FLEET_CONCURRENCY, DEFAULT_HOST_TIMEOUT, DEFAULT_NETWORK_TIMEOUT, HostResult, \
+    FleetReport, read_hosts, run_fleet, print_fleet_report
+from ultimate1541.watch import watch
+from ultimate1541.transfer import DEFAULT_CONCURRENCY, DEFAULT_BLOCK_SIZE, TransferResult, TransferReport
 
 
-def cmd_dir(u: Ultimate1541, params: List[str]):
+def cmd_dir(u: Ultimate1541, params: List[str], context: CommandContext):
     if len(params) == 0:
-        return cmd_dir(u, ['/Usb0'])
+        return cmd_dir(u, ['/Usb0'], context)
     for param in params:
         if len(params) > 1:
-            print('')
-            print(param)
+            context.print('')
+            context.print(param)
         for line in u.dir(param):
-            print(line)
+            context.print(line)
 
 
-def cmd_upload(u: Ultimate1541, params: List[str]):
-    cmd_upload_and_then(u, params, lambda: None)
+def parse_flags(params: List[str], flags: List[str], options: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    # returns the remaining parameters and the flags and options that were present, with option values
+    params = params[:]
+    present: Dict[str, str] = {}
+    for flag in flags:
+        if flag in params:
+            params.remove(flag)
+            present[flag] = ''
+    for option in options:
+        if option in params:
+            ix = params.index(option)
+            if ix + 1 >= len(params):
+                raise ValueError(option + " requires a value")
+            present[option] = params[ix + 1]
+            del params[ix:ix + 2]
+    return params, present
+
+
+def transfer_options(present: Dict[str, str]) -> Dict[str, Union[int, bool]]:
+    return {
+        'concurrency': int(present.get('-j', DEFAULT_CONCURRENCY)),
+        'blocksize': int(present.get('-b', DEFAULT_BLOCK_SIZE)),
+        'resume': '--resume' in present,
+    }
+
+
+def progress_printer(context: CommandContext) -> Callable[[TransferResult, TransferReport], None]:
+    def print_progress(result: TransferResult, report: TransferReport):
+        prefix = '[{}/{}] '.format(report.finished, len(report.results))
+        context.print(prefix + ('Failed: ' if result.error is not None else '') + str(result))
+
+    return print_progress
+
+
+def finish_transfers(report: TransferReport, what: str, context: CommandContext):
+    context.print(what + ' ' + str(report))
+    if report.failed():
+        raise IOError('{} of {} transfers failed'.format(len(report.failed()), len(report.results)))
+
+
+def cmd_upload(u: Ultimate1541, params: List[str], context: CommandContext):
+    params, flags = parse_flags(params, ['-r', '--resume'], ['-j', '-b'])
+    if '-r' in flags:
+        if len(params) != 2:
+            raise ValueError("Exactly two parameters required")
+        report = u.upload_tree(context.path(params[0]), params[1], progress=progress_printer(context),
+                               **transfer_options(flags))
+    else:
+        report = u.upload_files(upload_targets(params, context), overwrite=True, progress=progress_printer(context),
+                                **transfer_options(flags))
+    finish_transfers(report, 'Uploaded', context)
 
 
-def cmd_download(u: Ultimate1541, params: List[str]):
-    for file in params:
-        u.download_file(file, os.path.basename(file))
+def cmd_sync(u: Ultimate1541, params: List[str], context: CommandContext):
+    params, flags = parse_flags(params, ['--delete'], ['-j'])
+    if len(params) != 2:
+        raise ValueError("Exactly two parameters required")
+    concurrency = transfer_options(flags)['concurrency']
+    report = u.sync(context.path(params[0]), params[1], delete='--delete' in flags, concurrency=concurrency)
+    for result in report.transfers.failed():
+        context.print('Failed: ' + str(result))
+    context.print('Synced: ' + str(report))
+    if report.transfers.failed():
+        raise IOError('{} of {} uploads failed'.format(len(report.transfers.failed()), len(report.transfers.results)))
+
+
+def cmd_download(u: Ultimate1541, params: List[str], context: CommandContext):
+    params, flags = parse_flags(params, ['-r', '--resume'], ['-j', '-b'])
+    options = transfer_options(flags)
+    if '-r' in flags:
+        if len(params) not in (1, 2):
+            raise ValueError("One or two parameters required")
+        local_dir = params[1] if len(params) == 2 else os.path.basename(params[0].rstrip('/'))
+        report = u.download_tree(params[0], context.path(local_dir), progress=progress_printer(context), **options)
+    elif len(params) == 2 and params[1] == '-':
+        # nothing else may be printed, the standard output is the file
+        context.stdout.flush()
+        u.download_file(params[0], '-', resume=False, blocksize=options['blocksize'], output=context.stdout.buffer)
+        return
+    elif len(params) == 1:
+        u.download_file(params[0], context.path(os.path.basename(params[0])), resume=options['resume'],
+                        blocksize=options['blocksize'])
+        return
+    else:
+        report = u.download_files([(file, context.path(os.path.basename(file))) for file in params],
+                                  progress=progress_printer(context), **options)
+    finish_transfers(report, 'Downloaded', context)
 
 
-def cmd_run(u: Ultimate1541, params: List[str]):
+def cmd_run(u: Ultimate1541, params: List[str], context: CommandContext):
     if len(params) != 1:
         raise ValueError("Exactly one parameter required")
     u.run_file(params[0])
 
 
-def cmd_mount(u: Ultimate1541, params: List[str]):
+def cmd_run_local(u: Ultimate1541, params: List[str], context: CommandContext):
     if len(params) != 1:
         raise ValueError("Exactly one parameter required")
-    u.run_file(params[0])
+    u.run_local_file(context.path(params[0]))
 
 
-def cmd_set_reu_size(u: Ultimate1541, params: List[str]):
+def cmd_mount(u: Ultimate1541, params: List[str], context: CommandContext):
     if len(params) != 1:
         raise ValueError("Exactly one parameter required")
-    if params[0] in ['0', 'none', 'off', 'disabled']:
-        u.set_reu_enabled(False)
-    else:
-        u.set_reu_enabled(True)
-        u.set_reu_size(params[0])
+    u.mount_file(params[0])
+
+
+def cmd_set_reu_size(u: Ultimate1541, params: List[str], context: CommandContext):
+    if len(params) != 1:
+        raise ValueError("Exactly one parameter required")
+    with u.settings() as s:
+        if params[0] in ['0', 'none', 'off', 'disabled']:
+            s.set_reu_enabled(False)
+        else:
+            s.set_reu_enabled(True)
+            s.set_reu_size(params[0])
+
+
+def cmd_set(u: Ultimate1541, params: List[str], context: CommandContext):
+    if len(params) == 0:
+        raise ValueError("At least one setting required")
+    with u.settings() as s:
+        for param in params:
+            if '=' not in param:
+                raise ValueError("Settings should be given as key=value: " + param)
+            key, value = param.split('=', 1)
+            s.set_by_name(key, value)
 
 
-def cmd_upload_and_run(u: Ultimate1541, params: List[str]):
-    cmd_upload_one_file_and_then(u, params, lambda f: cmd_run(u, [f]))
+def cmd_upload_and_run(u: Ultimate1541, params: List[str], context: CommandContext):
+    cmd_upload_one_file_and_then(u, params, context, lambda f: cmd_run(u, [f], context))
 
 
-def cmd_upload_and_mount(u: Ultimate1541, params: List[str]):
-    cmd_upload_one_file_and_then(u, params, lambda f: cmd_mount(u, [f]))
+def cmd_upload_and_mount(u: Ultimate1541, params: List[str], context: CommandContext):
+    cmd_upload_one_file_and_then(u, params, context, lambda f: cmd_mount(u, [f], context))
 
 
-def cmd_upload_one_file_and_then(u: Ultimate1541, params: List[str], callback: Callable[[str], None]):
+def cmd_upload_one_file_and_then(u: Ultimate1541, params: List[str], context: CommandContext,
+                                 callback: Callable[[str], None]):
     params = params[:]
     if len(params) > 2:
         raise ValueError("Exactly two parameters required")
@@ -65,10 +171,33 @@ def cmd_upload_one_file_and_then(u: Ultimate1541, params: List[str], callback: C
         params.append('/Usb0/' + os.path.basename(params[0]))
     if params[1].endswith('/'):
         params[1] += os.path.basename(params[0])
-    cmd_upload_and_then(u, params, lambda: callback(params[1]))
+    cmd_upload_and_then(u, params, context, lambda: callback(params[1]))
 
 
-def cmd_upload_and_then(u: Ultimate1541, params: List[str], callback: Callable[[], None]):
+def cmd_upload_and_then(u: Ultimate1541, params: List[str], context: CommandContext, callback: Callable[[], None]):
+    for source, target in upload_targets(params, context):
+        u.upload_file(source, target, overwrite=True)  # TODO: True?
+        callback()
+
+
+def cmd_watch(u: Ultimate1541, params: List[str], context: CommandContext):
+    if len(params) not in (2, 3):
+        raise ValueError("Two or three parameters required")
+    actions = {'run': u.run_file, 'mount': u.mount_file}
+    if len(params) == 3 and params[2] not in actions:
+        raise ValueError("The action should be run or mount")
+    remote_path = params[1]
+    if remote_path.endswith('/'):
+        remote_path += os.path.basename(params[0])
+    context.print("Watching " + params[0] + ", press Ctrl+C to stop")
+    try:
+        watch(u, context.path(params[0]), remote_path, actions[params[2]] if len(params) == 3 else None,
+              log=context.print)
+    except KeyboardInterrupt:
+        pass
+
+
+def upload_targets(params: List[str], context: CommandContext) -> List[Tuple[str, str]]:
     if len(params) == 0:
         raise ValueError("Not enough parameters")
     if len(params) == 1:
@@ -79,36 +208,86 @@ def cmd_upload_and_then(u: Ultimate1541, params: List[str], callback: Callable[[
         target = params[-1]
         if len(params) > 2 and not target.endswith('/'):
             target += '/'
+    result = []
     for source in sources:
+        if source == '-' and (len(sources) > 1 or target.endswith('/')):
+            raise ValueError("Standard input can only be uploaded as a single named file")
         tmp = target
         if target.endswith('/'):
             tmp += os.path.basename(source)
-        u.upload_file(source, tmp, overwrite=True)  # TODO: True?
-        callback()
+        result.append((context.path(source), tmp))
+    return result
+
+
+def cmd_settings_dump(u: Ultimate1541, params: List[str], context: CommandContext):
+    params = params[:]
+    max_age: Optional[float] = None
+    if len(params) >= 2 and params[0] == '--max-age':
+        max_age = float(params[1])
+        params = params[2:]
+    if len(params) > 1:
+        raise ValueError("At most one output file allowed")
+    snapshot = u.dump_settings(max_age=max_age)
+    if len(params) == 0:
+        context.print(json.dumps(snapshot, indent=2, ensure_ascii=False))
+    else:
+        with open(context.path(params[0]), 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, indent=2, ensure_ascii=False)
+
+
+def cmd_settings_apply(u: Ultimate1541, params: List[str], context: CommandContext):
+    if len(params) != 1:
+        raise ValueError("Exactly one parameter required")
+    with open(context.path(params[0]), 'r', encoding='utf-8') as f:
+        profile = json.load(f)
+    for category, setting, value in u.apply_settings_profile(profile):
+        context.print(category + '/' + setting + ' = ' + value)
 
 
 def display_help():
     print("Usage: python u1541.py <IP address> <command>")
+    print("   or: python u1541.py [--parallel <n>] [--timeout <seconds>] [--io-timeout <seconds>] <hosts> <command>")
+    print("where <hosts> is a comma-separated list of IP addresses or @<file> with one address per line;")
+    print("--timeout limits the time per device, --io-timeout the wait for a single network operation")
+    print("   or: python u1541.py --agent | --agent-stop - start or stop the agent that keeps connections open")
+    print("Commands for a single device go through the agent when it is running, unless --no-agent is given.")
+    print("--trace <file> before the IP address records where the time goes, writes it to the file")
+    print("in the Chrome trace format and prints a summary; traced commands do not go through the agent.")
+    print("--record <file> before the IP address records the telnet session to the file, to be replayed with")
+    print("python -m ultimate1541.replay <file>; recorded commands do not go through the agent either.")
     print("where <command> may be:")
     print("* run <remote file> - run remote file")
+    print("* run-local <local file> - load a program file straight into the memory and run it, without storing it")
     print("* mount <remote file> - mount remote file")
-    print("* upload <local file> <remote file> - upload file")
+    print("* upload [<options>] <local files> <remote file> - upload files; use - to upload standard input")
+    print("* upload -r [<options>] <local dir> <remote dir> - upload a directory tree")
+    print("* sync [--delete] [-j <connections>] <local dir> <remote dir> - upload new and changed files")
     print("* ur <local file> <remote file> - upload and run file")
     print("* um <local file> <remote file> - upload and mount file")
-    print("* download <remote file> - download remote file to current directory")
+    print("* watch <local file> <remote file> [run|mount] - upload, and run or mount, every new build of a file")
+    print("* download [<options>] <remote files> - download remote files to current directory")
+    print("* download [-b <block size>] <remote file> - - download remote file to standard output")
+    print("* download -r [<options>] <remote dir> [<local dir>] - download a directory tree")
     print("* reu <REU size> - set REU size; use 0 to disable")
+    print("* set <key>=<value>... - change several settings at once")
+    print("* settings_dump [--max-age <seconds>] [<file>] - save all settings as JSON")
+    print("* settings_apply <file> - change settings that differ from a JSON profile")
     print("* shell - start a shell")
     print("* quit - exit the shell")
     print("* help - display this list")
+    print("transfer options:")
+    print("  -j <connections> - number of parallel FTP connections")
+    print("  -b <block size> - transfer block size in bytes")
+    print("  --resume - continue interrupted transfers instead of starting over")
     return
 
 
-def cmd_help(u: Ultimate1541, params: List[str]):
+def cmd_help(u: Ultimate1541, params: List[str], context: CommandContext):
     display_help()
 
 
-def cmd_shell(u: Ultimate1541, params: List[str]):
-    print("Type quit to exit")
+def cmd_shell(u: Ultimate1541, params: List[str], context: CommandContext):
+    context.print("Type quit to exit")
     while True:
         command = list(filter(lambda x:x!='', input('> ').split(' ')))
         if len(command) == 0:
@@ -119,45 +298,140 @@ def cmd_shell(u: Ultimate1541, params: List[str]):
         if c == 'shell':
             continue
         if c not in COMMANDS:
-            print('Invalid command ' + c)
+            context.print('Invalid command ' + c)
         else:
             # noinspection PyBroadException
             try:
-                COMMANDS[c](u, command[1:])
+                COMMANDS[c](u, command[1:], context)
             except Exception as e:
-                traceback.print_exc()
+                traceback.print_exc(file=context.stderr)
 
 
-COMMANDS: Dict[str, Callable[[Ultimate1541, List[str]], None]] = {
+COMMANDS: Dict[str, Callable[[Ultimate1541, List[str], CommandContext], None]] = {
     'dir': cmd_dir,
     'ls': cmd_dir,
     'u': cmd_upload,
     'upload': cmd_upload,
+    'sync': cmd_sync,
     'd': cmd_download,
     'download': cmd_download,
     'h': cmd_help,
     'help': cmd_help,
     'r': cmd_run,
     'run': cmd_run,
+    'rl': cmd_run_local,
+    'run-local': cmd_run_local,
+    'm': cmd_mount,
+    'mount': cmd_mount,
     'ur': cmd_upload_and_run,
     'upload_and_run': cmd_upload_and_run,
+    'um': cmd_upload_and_mount,
+    'upload_and_mount': cmd_upload_and_mount,
+    'watch': cmd_watch,
     'reu': cmd_set_reu_size,
+    'set': cmd_set,
+    'settings_dump': cmd_settings_dump,
+    'settings_apply': cmd_settings_apply,
     'shell': cmd_shell,
 }
 
 
-def run_command(u: Ultimate1541, command: str, params: List[str]):
-    COMMANDS[command](u, params)
+def run_command(u: Ultimate1541, command: str, params: List[str], context: CommandContext):
+    COMMANDS[command](u, params, context)
+
+
+def print_host_done(result: HostResult, report: FleetReport):
+    print('[{}/{}] {}'.format(report.finished, len(report.results), result))
+
+
+def run_fleet_command(hosts: List[str], command: str, params: List[str], fleet_options: Dict[str, str]):
+    if command in ('shell', 'h', 'help', 'watch'):
+        raise ValueError('Command ' + command + ' cannot be run on several devices')
+    report = run_fleet(hosts, lambda u, context: COMMANDS[command](u, params, context),
+                       concurrency=int(fleet_options.get('--parallel', DEFAULT_FLEET_CONCURRENCY)),
+                       timeout=float(fleet_options.get('--io-timeout', DEFAULT_NETWORK_TIMEOUT)),
+                       host_timeout=float(fleet_options.get('--timeout', DEFAULT_HOST_TIMEOUT)),
+                       progress=print_host_done)
+    print_fleet_report(report)
+    if report.failed():
+        raise IOError('{} of {} devices failed'.format(len(report.failed()), len(report.results)))
+
+
+def forwarded_to_agent(ip_addr: str, command: str, params: List[str]) -> bool:
+    if command in ('shell', 'h', 'help', 'watch'):
+        return False
+    if command in ('u', 'upload', 'ur', 'upload_and_run', 'um', 'upload_and_mount') and '-' in params:
+        # the agent cannot read our standard input
+        return False
+    sock = agent.connect()
+    if sock is None:
+        return False
+    status = agent.forward(sock, ip_addr, command, params)
+    if status != 0:
+        sys.exit(status)
+    return True
 
 
 def do_main():
-    ip_addr = sys.argv[1]
-    command = sys.argv[2] if len(sys.argv) > 2 else 'help'
-    params: List[str] = sys.argv[3:] if len(sys.argv) > 3 else []
+    args = sys.argv[1:]
+    if args[0] == '--agent':
+        if not agent.agent_supported():
+            raise OSError('The agent needs Unix domain sockets')
+        agent.Agent(run_command).serve()
+        return
+    if args[0] == '--agent-stop':
+        if not agent.stop():
+            print('No agent is running')
+        return
+    fleet_options: Dict[str, str] = {}
+    use_agent = True
+    trace_file: Optional[str] = None
+    record_file: Optional[str] = None
+    while len(args) >= 1 and args[0] in ('--parallel', '--timeout', '--io-timeout', '--no-agent', '--trace', '--record'):
+        if args[0] == '--no-agent':
+            use_agent = False
+            args = args[1:]
+            continue
+        if len(args) < 2:
+            raise ValueError(args[0] + " requires a value")
+        if args[0] in ('--trace', '--record'):
+            if args[0] == '--trace':
+                trace_file = args[1]
+            else:
+                record_file = args[1]
+            # the agent would do the work in another process
+            use_agent = False
+        else:
+            fleet_options[args[0]] = args[1]
+        args = args[2:]
+    ip_addr = args[0]
+    command = args[1] if len(args) > 1 else 'help'
+    params: List[str] = args[2:]
     if command not in COMMANDS:
         raise ValueError('Unsupported command: ' + command)
-    with Ultimate1541(ip_addr) as u:
-        COMMANDS[command](u, params)
+    if trace_file is not None:
+        tracing.enable()
+        try:
+            run_command_locally(ip_addr, command, params, fleet_options, use_agent, record_file)
+        finally:
+            tracer = tracing.disable()
+            tracer.export(trace_file)
+            print(tracer.format_summary(), file=sys.stderr)
+        return
+    run_command_locally(ip_addr, command, params, fleet_options, use_agent, record_file)
+
+
+def run_command_locally(ip_addr: str, command: str, params: List[str], fleet_options: Dict[str, str],
+                        use_agent: bool, record_file: Optional[str]):
+    if fleet_options or ',' in ip_addr or ip_addr.startswith('@'):
+        if record_file is not None:
+            raise ValueError("Only the session with a single device can be recorded")
+        run_fleet_command(read_hosts(ip_addr), command, params, fleet_options)
+        return
+    if use_agent and forwarded_to_agent(ip_addr, command, params):
+        return
+    with Ultimate1541(ip_addr, menu_cache=MenuCache.default(), record_to=record_file) as u:
+        COMMANDS[command](u, params, CommandContext())
         # u.upload_file(
         #     'D:\\dokumenty\\millfork-benchmarks\\6502\\plasma-asm.prg',
         #     '/Usb0/EKSPERYMENTY/plasma-asm.prg',
@@ -1,50 +1,51 @@
 import os
-from typing import Optional, List, Tuple, Union, Dict
-from telnetlib import Telnet, WILL, DO, DONT, WONT, IAC
-from ftplib import FTP, error_reply, error_perm
+from collections import deque
+from typing import Optional, List, Tuple, Union, Dict, Iterator, Callable, BinaryIO, TYPE_CHECKING
+from ftplib import error_reply, error_perm, error_temp
+from time import monotonic
 
+from ultimate1541.command_socket import CommandSocket, COMMAND_PORT
 from ultimate1541.console_manipulator import ConsoleManipulator
-from ultimate1541.ansi_reader import TelnetAnsiReaderWriter
-
-REU_SIZES: Dict[Union[str, int, Tuple[int, str]], str] = {}
-
-for mb in [128, 256, 512]:
-    normalized = str(mb) + ' KB'
-    REU_SIZES[(mb, 'k')] = normalized
-    REU_SIZES[(mb, 'kB')] = normalized
-    REU_SIZES[(mb, 'KB')] = normalized
-    REU_SIZES[(mb, 'K')] = normalized
-    REU_SIZES[mb * 1024] = normalized
-    REU_SIZES[mb * 1000] = normalized
-    REU_SIZES[str(mb) + 'k'] = normalized
-    REU_SIZES[str(mb) + ' k'] = normalized
-    REU_SIZES[str(mb) + 'kB'] = normalized
-    REU_SIZES[str(mb) + ' kB'] = normalized
-    REU_SIZES[str(mb) + 'K'] = normalized
-    REU_SIZES[str(mb) + ' K'] = normalized
-    REU_SIZES[str(mb) + 'KB'] = normalized
-    REU_SIZES[str(mb) + ' KB'] = normalized
-
-for mb in [1, 2, 4, 8, 16]:
-    normalized = str(mb) + ' MB'
-    REU_SIZES[(mb, 'MB')] = normalized
-    REU_SIZES[(mb, 'M')] = normalized
-    REU_SIZES[mb * 1024 * 1024] = normalized
-    REU_SIZES[mb * 1000 * 1000] = normalized
-    REU_SIZES[mb * 1024 * 1000] = normalized
-    REU_SIZES[str(mb) + 'M'] = normalized
-    REU_SIZES[str(mb) + ' M'] = normalized
-    REU_SIZES[str(mb) + 'MB'] = normalized
-    REU_SIZES[str(mb) + ' MB'] = normalized
-
-
+from ultimate1541.menu_cache import MenuCache
+from ultimate1541.settings import REU_SIZES, SettingsTransaction, crawl_settings, apply_profile
+from ultimate1541.ansi_reader import AnsiReaderWriter, TelnetAnsiReaderWriter
+from ultimate1541.listing import DirEntry, DirectoryCache, stream_listing, normalize_dir, parent_dir, browser_order, \
+    find_entry
+from ultimate1541.recording import RecordWriter, RecordingAnsiReaderWriter
+from ultimate1541.telnet import negotiation_reply
+from ultimate1541.tracing import traced
+from ultimate1541.sync import SyncManifest, SyncReport, sync
+from ultimate1541.transfer import UltimateFTP, FtpPool, TransferReport, TransferResult, DEFAULT_CONCURRENCY, \
+    DEFAULT_BLOCK_SIZE, FTP_ERRORS, FTP_IDLE_CHECK_AFTER, upload, download, bulk_upload, bulk_download
+
+if TYPE_CHECKING:
+    from telnetlib import Telnet
 
 class Ultimate1541:
-    def __init__(self, ip_addr: str):
+    def __init__(self, ip_addr: str, *, menu_cache: Optional[MenuCache] = None,
+                 sync_manifest: Optional[SyncManifest] = None, timeout: Optional[float] = None,
+                 telnet_port: int = 23, ftp_port: int = 21, command_port: int = COMMAND_PORT,
+                 record_to: Optional[str] = None):
         self.ip_addr: str = ip_addr
-        self.telnet: Optional[Telnet] = None
-        self.ftp: Optional[FTP] = None
+        self.telnet_port: int = telnet_port
+        self.ftp_port: int = ftp_port
+        self.command_port: int = command_port
+        # for network operations, in seconds; None waits as long as the operating system does
+        self.timeout: Optional[float] = timeout
+        # kept in memory only, unless a persistent one such as MenuCache.default() is given
+        self.menu_cache: MenuCache = menu_cache if menu_cache is not None else MenuCache()
+        # None until the menu was seen, or if its title was not recognized
+        self.firmware: Optional[str] = None
+        self.telnet: Optional['Telnet'] = None
+        self.ftp: Optional[UltimateFTP] = None
+        self.ftp_pool: Optional[FtpPool] = None
+        self.sync_manifest: Optional[SyncManifest] = sync_manifest
+        self.dir_cache: DirectoryCache = DirectoryCache()
         self.console_manipulator: Optional[ConsoleManipulator] = None
+        self.ftp_last_used: float = 0.0
+        # a file to record the telnet sessions to, see ultimate1541.recording
+        self.record_to: Optional[str] = record_to
+        self.recording: Optional[RecordWriter] = None
 
     def __enter__(self):
         return self
@@ -52,15 +53,27 @@ class Ultimate1541:
     def __exit__(self, type, value, traceback):
         self.close()
 
+    @traced
     def close(self):
         self.close_ftp()
         self.close_telnet()
-
+        if self.ftp_pool is not None:
+            self.ftp_pool.close()
+            self.ftp_pool = None
+        if self.recording is not None:
+            self.recording.close()
+            self.recording = None
+
+    @traced
     def close_ftp(self):
         if self.ftp:
-            self.ftp.quit()
+            try:
+                self.ftp.quit()
+            except (OSError, EOFError, error_reply, error_temp, error_perm):
+                self.ftp.close()
             self.ftp = None
 
+    @traced
     def close_telnet(self):
         if self.telnet:
             self.console_manipulator.close()
@@ -68,20 +81,43 @@ class Ultimate1541:
             self.telnet.close()
             self.telnet = None
 
+    @traced
     def open_ftp(self):
-        self.close_telnet()
+        if self.ftp is not None and monotonic() - self.ftp_last_used > FTP_IDLE_CHECK_AFTER:
+            # the server may have dropped an idle control connection in the meantime
+            try:
+                self.ftp.voidcmd('NOOP')
+            except (OSError, EOFError, error_reply, error_temp, error_perm):
+                self.ftp.close()
+                self.ftp = None
         if self.ftp is None:
-            self.ftp = FTP(self.ip_addr)
+            self.ftp = UltimateFTP(self.ip_addr, self.ftp_port, timeout=self.timeout)
             # self.ftp.set_debuglevel(2)
+        self.ftp_last_used = monotonic()
 
+    @traced
     def open_telnet(self):
-        self.close_ftp()
+        if self.telnet is not None and self.telnet.eof:
+            self.telnet.close()
+            self.telnet = None
+            self.console_manipulator = None
         if self.telnet is None:
-            self.telnet = Telnet(self.ip_addr, 23, timeout=1000)
+            # telnetlib is gone from newer Pythons; AsyncUltimate1541 works without it
+            from telnetlib import Telnet
+            self.telnet = Telnet(self.ip_addr, self.telnet_port, timeout=self.timeout if self.timeout is not None else 1000)
             self.telnet.set_option_negotiation_callback(option_callback)
-            self.console_manipulator = ConsoleManipulator(TelnetAnsiReaderWriter(self.telnet))
+            reader: AnsiReaderWriter = TelnetAnsiReaderWriter(self.telnet)
+            if self.record_to is not None:
+                if self.recording is None:
+                    # a reconnection continues the same recording
+                    self.recording = RecordWriter(open(self.record_to, 'wb'))
+                reader = RecordingAnsiReaderWriter(reader, self.recording)
+            self.console_manipulator = ConsoleManipulator(reader)
+            self.console_manipulator.directory_lister = self.browser_listing
             self.console_manipulator.refresh_screen()
+            self.firmware = self.console_manipulator.firmware()
 
+    @traced
     def get_usb_devices(self) -> List[str]:
         self.open_telnet()
         self.console_manipulator.go_home()
@@ -92,61 +128,218 @@ class Ultimate1541:
                 result.append(item.label)
         return result
 
+    @traced
     def run_file(self, remote_path: str) -> None:
         self.do_with_file('Run', remote_path)
 
+    @traced
     def mount_file(self, remote_path: str) -> None:
         self.do_with_file('Mount disk', remote_path)
 
+    @traced
     def do_with_file(self, command: str, remote_path: str) -> None:
         path_split = split_path(remote_path)
-        print(path_split)
         self.__do_with_file_internal(command, path_split[1:], device=path_split[0])
 
     def __do_with_file_internal(self, command: str, path: List[str], *, device: str = 'Usb0') -> None:
         if len(path) == 0:
             raise ValueError('path cannot be empty')
         self.open_telnet()
-        c = self.console_manipulator
-        c.go_home()
-        devices = c.get_big_menu()
-        for i, d in enumerate(devices.items):
-            if d.label.startswith(device):
-                c.select_option(i, use_return=False)
-                break
-        else:
-            raise ValueError('Cannot find device ' + device)
-        c.wait_for_device_opening(timeout=3)
-        for n in path[:-1]:
-            c.select_option_by_name(n, use_return=False)
-        c.select_option_by_name(path[-1], use_return=True)
-        c.wait_for_small_menu(timeout=1)
-        c.select_option_by_name(command)
-
-    def upload_file(self, local_path: str, remote_path: str, *, overwrite: bool = False):
-        self.open_ftp()
-        self.ftp.cwd(os.path.dirname(remote_path))
-        if overwrite:
-            self.delete_file(remote_path, quietly=True)
+        self.console_manipulator.do_with_file(command, device, path)
+
+    @traced
+    def open_command_socket(self) -> CommandSocket:
+        # a new connection for every command, so that one dropped by the device in the meantime is never used
+        return CommandSocket(self.ip_addr, self.command_port, timeout=self.timeout)
+
+    @traced
+    def run_prg(self, data: bytes) -> None:
+        # runs a program straight from memory, without the file browser and without storing it on the device
+        with self.open_command_socket() as s:
+            s.run_prg(data)
+
+    @traced
+    def run_local_file(self, local_path: str) -> None:
         with open(local_path, 'rb') as f:
-            self.ftp.storbinary('STOR {}'.format(os.path.basename(remote_path)), f)
+            self.run_prg(f.read())
 
+    @traced
+    def upload_file(self, local_path: str, remote_path: str, *, overwrite: bool = False, resume: bool = False,
+                    blocksize: int = DEFAULT_BLOCK_SIZE):
+        self.open_ftp()
+        try:
+            upload(self.ftp, local_path, remote_path, overwrite=overwrite, resume=resume, blocksize=blocksize)
+        finally:
+            self.dir_cache.invalidate_parent(remote_path)
+
+    @traced
+    def upload_files(self, files: List[Tuple[str, str]], *, overwrite: bool = False, resume: bool = False,
+                     blocksize: int = DEFAULT_BLOCK_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+                     progress: Optional[Callable[[TransferResult, TransferReport], None]] = None) -> TransferReport:
+        try:
+            return bulk_upload(self.get_ftp_pool(concurrency), files, overwrite=overwrite, resume=resume,
+                               blocksize=blocksize, concurrency=concurrency, progress=progress)
+        finally:
+            for _, remote_path in files:
+                self.dir_cache.invalidate_parent(remote_path)
+
+    @traced
+    def upload_tree(self, local_dir: str, remote_dir: str, *, resume: bool = False,
+                    blocksize: int = DEFAULT_BLOCK_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+                    progress: Optional[Callable[[TransferResult, TransferReport], None]] = None) -> TransferReport:
+        remote_dir = normalize_dir(remote_dir)
+        directories: List[str] = [remote_dir]
+        files: List[Tuple[str, str]] = []
+        queue = deque([(local_dir, remote_dir)])
+        while queue:
+            local, remote = queue.popleft()
+            for entry in sorted(os.scandir(local), key=lambda e: e.name):
+                target = remote.rstrip('/') + '/' + entry.name
+                if entry.is_dir():
+                    directories.append(target)
+                    queue.append((entry.path, target))
+                else:
+                    files.append((entry.path, target))
+        # breadth-first order guarantees that parents are created before their children
+        created = set()
+        for directory in directories:
+            if parent_dir(directory) in created or not self.is_dir(directory):
+                self.make_directory(directory)
+                created.add(directory)
+        return self.upload_files(files, overwrite=True, resume=resume, blocksize=blocksize, concurrency=concurrency,
+                                 progress=progress)
+
+    @traced
+    def download_files(self, files: List[Tuple[str, str]], *, resume: bool = False,
+                       blocksize: int = DEFAULT_BLOCK_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+                       progress: Optional[Callable[[TransferResult, TransferReport], None]] = None) -> TransferReport:
+        return bulk_download(self.get_ftp_pool(concurrency), files, resume=resume, blocksize=blocksize,
+                             concurrency=concurrency, progress=progress)
+
+    @traced
+    def download_tree(self, remote_dir: str, local_dir: str, *, resume: bool = False,
+                      blocksize: int = DEFAULT_BLOCK_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+                      progress: Optional[Callable[[TransferResult, TransferReport], None]] = None) -> TransferReport:
+        files: List[Tuple[str, str]] = []
+        queue = deque([(normalize_dir(remote_dir), local_dir)])
+        while queue:
+            remote, local = queue.popleft()
+            os.makedirs(local, exist_ok=True)
+            for entry in self.list_dir(remote):
+                source = remote.rstrip('/') + '/' + entry.name
+                if entry.is_dir:
+                    queue.append((source, os.path.join(local, entry.name)))
+                else:
+                    files.append((source, os.path.join(local, entry.name)))
+        return self.download_files(files, resume=resume, blocksize=blocksize, concurrency=concurrency,
+                                   progress=progress)
+
+    @traced
+    def sync(self, local_dir: str, remote_dir: str, *, delete: bool = False,
+             concurrency: int = DEFAULT_CONCURRENCY) -> SyncReport:
+        self.open_ftp()
+        if self.sync_manifest is None:
+            self.sync_manifest = SyncManifest.default()
+        return sync(self, local_dir, remote_dir, manifest=self.sync_manifest, delete=delete, concurrency=concurrency)
+
+    @traced
+    def get_ftp_pool(self, size: int = DEFAULT_CONCURRENCY) -> FtpPool:
+        if self.ftp_pool is not None and self.ftp_pool.size < size:
+            self.ftp_pool.close()
+            self.ftp_pool = None
+        if self.ftp_pool is None:
+            self.ftp_pool = FtpPool(self.ip_addr, size, timeout=self.timeout, port=self.ftp_port)
+        return self.ftp_pool
+
+    @traced
     def dir(self, remote_directory: str) -> List[str]:
+        # the lines of LIST, as the server formats them; always fresh, unlike list_dir
         self.open_ftp()
         result = []
         self.ftp.cwd(remote_directory)
         self.ftp.dir(result.append)
         return result
 
-    def download_file(self, remote_path: str, local_path: str):
+    @traced
+    def list_dir(self, remote_directory: str) -> List[DirEntry]:
+        cached = self.dir_cache.get(remote_directory)
+        if cached is not None:
+            return cached
         self.open_ftp()
-        self.ftp.cwd(os.path.dirname(remote_path))
-        with open(local_path, 'wb') as f:
-            self.ftp.retrbinary('RETR {}'.format(os.path.basename(remote_path)), f.write)
+        result = list(stream_listing(self.ftp, remote_directory))
+        self.dir_cache.put(remote_directory, result)
+        return result
+
+    @traced
+    def browser_listing(self, location: List[str]) -> Optional[List[str]]:
+        # the names in a directory, in the order of the file browser, for ConsoleManipulator
+        try:
+            return [entry.name for entry in browser_order(self.list_dir('/' + '/'.join(location)))]
+        except FTP_ERRORS:
+            return None
+
+    def iter_dir(self, remote_directory: str) -> Iterator[DirEntry]:
+        # the FTP connection must not be used for anything else until the iteration is finished
+        cached = self.dir_cache.get(remote_directory)
+        if cached is not None:
+            yield from cached
+            return
+        self.open_ftp()
+        result = []
+        for entry in stream_listing(self.ftp, remote_directory):
+            result.append(entry)
+            yield entry
+        self.dir_cache.put(remote_directory, result)
+
+    @traced
+    def stat(self, remote_path: str) -> Optional[DirEntry]:
+        if normalize_dir(remote_path) == '/':
+            return DirEntry('', 'dir')
+        try:
+            return find_entry(self.list_dir(parent_dir(remote_path)), remote_path)
+        except error_perm:
+            return None
+
+    @traced
+    def exists(self, remote_path: str) -> bool:
+        return self.stat(remote_path) is not None
+
+    @traced
+    def is_dir(self, remote_path: str) -> bool:
+        entry = self.stat(remote_path)
+        return entry is not None and entry.is_dir
+
+    @traced
+    def make_directory(self, remote_path: str):
+        self.open_ftp()
+        try:
+            self.ftp.mkd(remote_path)
+        finally:
+            self.dir_cache.invalidate_parent(remote_path)
+
+    @traced
+    def remove_directory(self, remote_path: str):
+        self.open_ftp()
+        # the server may refuse to remove the current directory
+        self.ftp.cwd(parent_dir(remote_path))
+        try:
+            self.ftp.rmd(remote_path)
+        finally:
+            self.dir_cache.invalidate_parent(remote_path)
+            self.dir_cache.invalidate_tree(remote_path)
+
+    @traced
+    def download_file(self, remote_path: str, local_path: str, *, resume: bool = False,
+                      blocksize: int = DEFAULT_BLOCK_SIZE, output: Optional[BinaryIO] = None):
+        # a local path of - writes to the output stream, the standard output by default
+        self.open_ftp()
+        download(self.ftp, remote_path, local_path, resume=resume, blocksize=blocksize, output=output)
 
+    @traced
     def delete_file(self, remote_path: str, *, quietly: bool = False):
         self.open_ftp()
         self.ftp.cwd(os.path.dirname(remote_path))
+        self.dir_cache.invalidate_parent(remote_path)
         if quietly:
             try:
                 self.ftp.delete(os.path.basename(remote_path))
@@ -155,39 +348,38 @@ class Ultimate1541:
         else:
             self.ftp.delete(os.path.basename(remote_path))
 
-    def set_reu_enabled(self, enabled: bool):
-        self.__set_enabled(['C64 and cartridge settings', 'RAM Expansion Unit'], enabled)
+    def settings(self) -> SettingsTransaction:
+        return SettingsTransaction(self)
 
-    def set_reu_size(self, size: Union[int, str, Tuple[int, str]]):
-        if size not in REU_SIZES:
-            raise ValueError("Invalid REU size: " + str(size))
-        self.__set_setting(['C64 and cartridge settings', 'REU Size'], REU_SIZES[size])
+    @traced
+    def dump_settings(self, *, max_age: Optional[float] = None) -> Dict[str, Dict[str, str]]:
+        return crawl_settings(self, max_age=max_age)
 
+    @traced
+    def apply_settings_profile(self, profile: Dict[str, Dict[str, str]]) -> List[Tuple[str, str, str]]:
+        self.open_telnet()
+        return apply_profile(self, profile)
 
-    def set_command_interface_enabled(self, enabled: bool):
-        self.__set_enabled(['C64 and cartridge settings', 'Command Interface'], enabled)
+    @traced
+    def set_reu_enabled(self, enabled: bool):
+        with self.settings() as s:
+            s.set_reu_enabled(enabled)
 
-    def __set_enabled(self, option_path: List[str], enabled: bool):
-        self.__set_setting(option_path, 'Enabled' if enabled else 'Disabled')
+    @traced
+    def set_reu_size(self, size: Union[int, str, Tuple[int, str]]):
+        with self.settings() as s:
+            s.set_reu_size(size)
 
-    def __set_setting(self, option_path: List[str], option_name: str):
-        self.open_telnet()
-        c = self.console_manipulator
-        c.go_home()
-        c.enter_settings()
-        for option in option_path:
-            c.select_option_by_name(option, use_return=True)
-        c.select_option_by_name(option_name, use_return=True)
-        c.leave_settings()
+    @traced
+    def set_command_interface_enabled(self, enabled: bool):
+        with self.settings() as s:
+            s.set_command_interface_enabled(enabled)
 
 
 def option_callback(sock, cmd: bytes, opt: bytes):
-    if cmd == WILL and opt == b'\x01':
-        sock.sendall(IAC + DO + opt)
-    elif cmd in (DO, DONT):
-        sock.sendall(IAC + WONT + opt)
-    elif cmd in (WILL, WONT):
-        sock.sendall(IAC + DONT + opt)
+    reply = negotiation_reply(cmd, opt)
+    if reply:
+        sock.sendall(reply)
     else:
         print("Unsupported IAC: " + (cmd + opt).hex())
 
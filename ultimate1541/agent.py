@@ -0,0 +1,274 @@
+import io
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import traceback
+from time import monotonic
+from typing import Optional, List, Dict, Callable, BinaryIO, Tuple
+
+from ultimate1541 import Ultimate1541
+from ultimate1541.command_context import CommandContext
+from ultimate1541.menu_cache import MenuCache, default_cache_dir
+from ultimate1541.sync import SyncManifest
+
+# sessions unused for longer than this are closed, in seconds
+DEFAULT_SESSION_IDLE_TIMEOUT = 600.0
+
+# Frames are a kind byte, a 4-byte big-endian length and the payload.
+# The client sends one request; the agent answers with output frames and finally an exit frame.
+FRAME_REQUEST = b'q'
+FRAME_STDOUT = b'o'
+FRAME_STDERR = b'e'
+FRAME_EXIT = b'x'
+FRAME_HEADER = struct.Struct('>cI')
+
+STOP_COMMAND = '__stop__'
+
+
+def default_socket_path() -> str:
+    return os.environ.get('U1541_AGENT_SOCKET') or os.path.join(default_cache_dir(), 'agent.sock')
+
+
+def agent_supported() -> bool:
+    return hasattr(socket, 'AF_UNIX')
+
+
+def send_frame(sock: socket.socket, kind: bytes, payload: bytes):
+    sock.sendall(FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('Agent connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock: socket.socket) -> Tuple[bytes, bytes]:
+    kind, size = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    return kind, recv_exactly(sock, size)
+
+
+class FrameWriter(io.RawIOBase):
+    # what the command writes to the standard output or error, sent to the client as it comes
+    def __init__(self, sock: socket.socket, kind: bytes):
+        self.sock: socket.socket = sock
+        self.kind: bytes = kind
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if len(data) > 0:
+            send_frame(self.sock, self.kind, bytes(data))
+        return len(data)
+
+
+def frame_text_stream(sock: socket.socket, kind: bytes) -> io.TextIOWrapper:
+    # has .buffer like sys.stdout, for commands that write binary data, e.g. a download to the standard output
+    return io.TextIOWrapper(io.BufferedWriter(FrameWriter(sock, kind)), encoding='utf-8', line_buffering=True,
+                            write_through=True)
+
+
+class Session:
+    def __init__(self, u: Ultimate1541):
+        self.u: Ultimate1541 = u
+        self.last_used: float = monotonic()
+        # held while a command for this device runs
+        self.lock: threading.Lock = threading.Lock()
+        self.closed: bool = False
+
+    def close(self):
+        self.closed = True
+        try:
+            self.u.close()
+        except (OSError, EOFError):
+            pass
+
+
+class Agent:
+    # Keeps one Ultimate1541 per device open between commands, so that a command does not pay for
+    # connecting, logging in and reading the initial screen again.
+    # Commands for one device run one at a time, commands for different devices at the same time,
+    # with their local paths relative to the working directory of the client that sent them
+    # and their output sent back to it; the agent's own directory and output stay as they are.
+
+    def __init__(self, run_command: Callable[[Ultimate1541, str, List[str], CommandContext], None], *,
+                 idle_timeout: float = DEFAULT_SESSION_IDLE_TIMEOUT):
+        self.run_command: Callable[[Ultimate1541, str, List[str], CommandContext], None] = run_command
+        self.idle_timeout: float = idle_timeout
+        self.sessions: Dict[str, Session] = {}
+        # guards sessions only; it is never held while a command runs
+        self.lock: threading.Lock = threading.Lock()
+        self.menu_cache: MenuCache = MenuCache.default()
+        self.sync_manifest: SyncManifest = SyncManifest.default()
+        self.server: Optional[socketserver.BaseServer] = None
+
+    def session(self, host: str) -> Session:
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = Session(Ultimate1541(host, menu_cache=self.menu_cache, sync_manifest=self.sync_manifest))
+                self.sessions[host] = session
+            session.last_used = monotonic()
+            return session
+
+    def drop_session(self, host: str, session: Session):
+        with self.lock:
+            if self.sessions.get(host) is session:
+                del self.sessions[host]
+        session.close()
+
+    def close_idle_sessions(self):
+        with self.lock:
+            now = monotonic()
+            idle = [(host, session) for host, session in self.sessions.items()
+                    if now - session.last_used > self.idle_timeout]
+        for host, session in idle:
+            # a session running a command is not idle, however long the command takes
+            if not session.lock.acquire(blocking=False):
+                continue
+            try:
+                if monotonic() - session.last_used > self.idle_timeout:
+                    self.drop_session(host, session)
+            finally:
+                session.lock.release()
+
+    def close(self):
+        # the agent is stopping, commands still running lose their connections
+        with self.lock:
+            sessions = list(self.sessions.items())
+        for host, session in sessions:
+            self.drop_session(host, session)
+
+    def handle(self, sock: socket.socket):
+        kind, payload = recv_frame(sock)
+        if kind != FRAME_REQUEST:
+            raise ValueError('Expected a request frame')
+        request = json.loads(payload.decode('utf-8'))
+        if request['command'] == STOP_COMMAND:
+            send_frame(sock, FRAME_EXIT, b'0')
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        stdout = frame_text_stream(sock, FRAME_STDOUT)
+        stderr = frame_text_stream(sock, FRAME_STDERR)
+        context = CommandContext(stdout, stderr, request.get('cwd') or os.getcwd())
+        status = 0
+        host = request['host']
+        session = self.session(host)
+        session.lock.acquire()
+        while session.closed:
+            # dropped as idle between being looked up and being locked
+            session.lock.release()
+            session = self.session(host)
+            session.lock.acquire()
+        try:
+            self.run_command(session.u, request['command'], request.get('params', []), context)
+        except Exception as e:
+            traceback.print_exc(file=stderr)
+            status = 1
+            if isinstance(e, (OSError, EOFError)):
+                # the connections may be broken, the next command starts afresh
+                self.drop_session(host, session)
+        finally:
+            stdout.flush()
+            stderr.flush()
+            session.last_used = monotonic()
+            session.lock.release()
+        send_frame(sock, FRAME_EXIT, str(status).encode('ascii'))
+
+    def serve(self, socket_path: Optional[str] = None):
+        socket_path = socket_path or default_socket_path()
+        os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+        if os.path.exists(socket_path):
+            if ping(socket_path):
+                raise OSError('Another agent is already listening on ' + socket_path)
+            os.unlink(socket_path)
+        agent = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    agent.handle(self.request)
+                except (OSError, EOFError, ValueError):
+                    # the client went away
+                    pass
+
+        # the socket is created accessible to the owner only, there is no moment when others could connect
+        previous_umask = os.umask(0o077)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        finally:
+            os.umask(previous_umask)
+        self.server.daemon_threads = True
+        stop_reaper = threading.Event()
+
+        def reap():
+            while not stop_reaper.wait(min(60.0, self.idle_timeout)):
+                self.close_idle_sessions()
+
+        threading.Thread(target=reap, daemon=True).start()
+        try:
+            self.server.serve_forever()
+        finally:
+            stop_reaper.set()
+            self.server.server_close()
+            self.close()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+
+def connect(socket_path: Optional[str] = None) -> Optional[socket.socket]:
+    # None if no agent is running
+    if not agent_supported():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path or default_socket_path())
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def ping(socket_path: Optional[str] = None) -> bool:
+    sock = connect(socket_path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+def forward(sock: socket.socket, host: str, command: str, params: List[str], *,
+            stdout: Optional[BinaryIO] = None, stderr: Optional[BinaryIO] = None) -> int:
+    # sends the command to the agent and copies its output; returns the exit status
+    stdout = stdout if stdout is not None else sys.stdout.buffer
+    stderr = stderr if stderr is not None else sys.stderr.buffer
+    request = {'host': host, 'command': command, 'params': params, 'cwd': os.getcwd()}
+    with sock:
+        send_frame(sock, FRAME_REQUEST, json.dumps(request).encode('utf-8'))
+        while True:
+            kind, payload = recv_frame(sock)
+            if kind == FRAME_STDOUT:
+                stdout.write(payload)
+                stdout.flush()
+            elif kind == FRAME_STDERR:
+                stderr.write(payload)
+                stderr.flush()
+            elif kind == FRAME_EXIT:
+                return int(payload.decode('ascii'))
+
+
+def stop(socket_path: Optional[str] = None) -> bool:
+    sock = connect(socket_path)
+    if sock is None:
+        return False
+    forward(sock, '', STOP_COMMAND, [])
+    return True
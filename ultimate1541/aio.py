@@ -0,0 +1,622 @@
+import asyncio
+import mmap
+import os
+from ftplib import error_reply, error_perm, error_temp, parse227
+from typing import Optional, List, Tuple, Union, Callable, AsyncIterator, Awaitable, Any, Dict
+
+from ultimate1541.ansi_reader import BufferedAnsiReaderWriter
+from ultimate1541.console_manipulator import ConsoleManipulator, NavigationStep, NavigationError, WaitForData, Steps
+from ultimate1541.listing import DirEntry, DirectoryCache, LISTING_PARSERS, next_listing_command, find_entry, \
+    normalize_dir, parent_dir, browser_order
+from ultimate1541.menu import Menu
+from ultimate1541.menu_cache import MenuCache
+from ultimate1541.pseudoscreen import PseudoScreen
+from ultimate1541.settings import SettingsTransaction, REU_ENABLED_PATH, REU_SIZE_PATH, COMMAND_INTERFACE_PATH, \
+    normalize_enabled, normalize_reu_size, crawl_settings_steps, snapshot, profile_changes
+from ultimate1541.telnet import TelnetDecoder
+from ultimate1541.transfer import DEFAULT_BLOCK_SIZE, FTP_ERRORS, resume_offset, resume_download, partial_path
+from ultimate1541 import split_path
+
+
+async def close_writer(writer: asyncio.StreamWriter):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        # the other side has already closed the connection
+        pass
+
+
+class AsyncConsoleManipulator:
+    # The asyncio counterpart of ConsoleManipulator.
+    # A background task feeds everything the Ultimate sends into a ConsoleManipulator over a BufferedAnsiReaderWriter,
+    # which does the screen parsing, the key buffering and all the decisions about menus, as steps;
+    # this class only performs what the steps ask for: sending the keys, waiting for data and listing directories.
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader: asyncio.StreamReader = reader
+        self.writer: asyncio.StreamWriter = writer
+        self.buffer: BufferedAnsiReaderWriter = BufferedAnsiReaderWriter()
+        self.console: ConsoleManipulator = ConsoleManipulator(self.buffer)
+        self.screen: PseudoScreen = self.console.screen
+        self.decoder: TelnetDecoder = TelnetDecoder()
+        self.data_received: asyncio.Event = asyncio.Event()
+        self.eof: bool = False
+        self.pump: Optional[asyncio.Future] = None
+        # gives the entries of a browser location in the order the browser shows them, or None
+        self.directory_lister: Optional[Callable[[List[str]], Awaitable[Optional[List[str]]]]] = None
+
+    def start(self):
+        self.pump = asyncio.ensure_future(self.__pump())
+
+    async def __pump(self):
+        while True:
+            data = await self.reader.read(4096)
+            if not data:
+                self.eof = True
+                self.data_received.set()
+                return
+            payload, replies = self.decoder.feed(data)
+            if replies:
+                self.writer.write(replies)
+            if payload:
+                self.buffer.feed(payload)
+                self.data_received.set()
+
+    async def wait_for_data(self, timeout: float) -> bool:
+        if self.buffer.wait_for_input(0):
+            return True
+        if self.eof:
+            raise EOFError('Telnet connection closed')
+        self.data_received.clear()
+        try:
+            await asyncio.wait_for(self.data_received.wait(), max(0.0, timeout))
+        except asyncio.TimeoutError:
+            return False
+        if self.eof and not self.buffer.wait_for_input(0):
+            raise EOFError('Telnet connection closed')
+        return True
+
+    async def flush_keys(self):
+        self.console.flush_keys()
+        data = self.buffer.take_output()
+        if data:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    def press(self, key: bytes, times: int = 1):
+        self.console.press(key, times)
+
+    async def run(self, steps: Steps) -> Any:
+        # performs the steps of ConsoleManipulator, like ConsoleManipulator.run but without blocking
+        answer = None
+        error: Optional[Exception] = None
+        while True:
+            try:
+                request = steps.throw(error) if error is not None else steps.send(answer)
+            except StopIteration as e:
+                await self.flush_keys()
+                return e.value
+            answer, error = None, None
+            try:
+                if isinstance(request, WaitForData):
+                    await self.flush_keys()
+                    answer = await self.wait_for_data(request.timeout)
+                elif self.directory_lister is not None:
+                    answer = await self.directory_lister(request.location)
+            except Exception as e:
+                error = e
+
+    async def refresh_screen(self, *, deadline: Optional[float] = None):
+        await self.run(self.console.refresh_screen_steps(deadline=deadline))
+
+    async def wait_for_small_menu(self, timeout: float):
+        await self.run(self.console.wait_for_small_menu_steps(timeout))
+
+    async def wait_for_device_opening(self, timeout: float):
+        await self.run(self.console.wait_for_device_opening_steps(timeout))
+
+    def get_big_menu(self) -> Menu:
+        return self.console.get_big_menu()
+
+    def get_small_menu(self) -> Optional[Menu]:
+        return self.console.get_small_menu()
+
+    def current_menu(self) -> Menu:
+        return self.console.current_menu()
+
+    async def select_option(self, index: int, *, use_return: Optional[bool] = None):
+        await self.run(self.console.select_option_steps(index, use_return=use_return))
+
+    async def select_option_by_name(self, name: str, *, use_return: Optional[bool] = None):
+        await self.run(self.console.select_option_by_name_steps(name, use_return=use_return))
+
+    async def navigate(self, steps: List[NavigationStep], *, observe: Optional[Callable[[int, Menu], None]] = None,
+                       position: Optional[int] = None):
+        await self.run(self.console.navigate_steps(steps, observe=observe, position=position))
+
+    async def go_back(self):
+        await self.run(self.console.go_back_steps())
+
+    async def go_home(self):
+        await self.run(self.console.go_home_steps())
+
+    async def enter_settings(self):
+        await self.run(self.console.enter_settings_steps())
+
+    async def leave_settings(self):
+        await self.run(self.console.leave_settings_steps())
+
+    async def browse_to(self, device: str, directories: List[str]):
+        await self.run(self.console.browse_to_steps(device, directories))
+
+    async def select_entry(self, name: str, *, use_return: bool):
+        await self.run(self.console.select_entry_steps(name, use_return=use_return))
+
+    async def do_with_file(self, command: str, device: str, path: List[str]):
+        await self.run(self.console.do_with_file_steps(command, device, path))
+
+    async def close(self):
+        self.console.close()
+        await self.flush_keys()
+        if self.pump is not None:
+            self.pump.cancel()
+        await close_writer(self.writer)
+
+
+class AsyncFTP:
+    # A small FTP client on asyncio streams, covering what the Ultimate needs.
+    # Errors are reported with the same exceptions as ftplib;
+    # which listing command to use and where to resume come from the same functions as for UltimateFTP.
+
+    def __init__(self, host: str, port: int = 21):
+        self.host: str = host
+        self.port: int = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.current_dir: Optional[str] = None
+        self.mlsd_supported: bool = True
+        self.encoding: str = 'utf-8'
+
+    async def connect(self, user: str = 'anonymous', password: str = 'anonymous@'):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        await self.__response()
+        response = await self.sendcmd('USER ' + user)
+        if response.startswith('3'):
+            response = await self.sendcmd('PASS ' + password)
+        if not response.startswith('2'):
+            raise error_reply(response)
+
+    async def __response(self) -> str:
+        line = (await self.reader.readline()).decode(self.encoding, 'replace').rstrip('\r\n')
+        if line == '':
+            raise EOFError('FTP connection closed')
+        response = line
+        if line[3:4] == '-':
+            code = line[:3]
+            while True:
+                line = (await self.reader.readline()).decode(self.encoding, 'replace').rstrip('\r\n')
+                if line == '':
+                    raise EOFError('FTP connection closed')
+                response += '\n' + line
+                if line[:3] == code and line[3:4] != '-':
+                    break
+        if response[0] == '4':
+            raise error_temp(response)
+        if response[0] == '5':
+            raise error_perm(response)
+        return response
+
+    async def sendcmd(self, command: str) -> str:
+        self.writer.write((command + '\r\n').encode(self.encoding))
+        await self.writer.drain()
+        return await self.__response()
+
+    async def voidcmd(self, command: str) -> str:
+        response = await self.sendcmd(command)
+        if not response.startswith('2'):
+            raise error_reply(response)
+        return response
+
+    async def voidresp(self) -> str:
+        response = await self.__response()
+        if not response.startswith('2'):
+            raise error_reply(response)
+        return response
+
+    async def transfer(self, command: str, rest: Optional[int] = None) \
+            -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        _, port = parse227(await self.sendcmd('PASV'))
+        # the address in the reply is not trusted, like in ftplib
+        data = await asyncio.open_connection(self.host, port)
+        try:
+            if rest is not None:
+                response = await self.sendcmd('REST ' + str(rest))
+                if not response.startswith('3'):
+                    raise error_reply(response)
+            response = await self.sendcmd(command)
+            if not response.startswith('1'):
+                raise error_reply(response)
+        except BaseException:
+            await close_writer(data[1])
+            raise
+        return data
+
+    async def open_transfer(self, command: str, offset: int) \
+            -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+        # like transfer, from an offset; None means the server does not support REST
+        if offset <= 0:
+            return await self.transfer(command)
+        try:
+            return await self.transfer(command, offset)
+        except (error_perm, error_reply):
+            return None
+
+    async def cwd(self, path: str):
+        if path == self.current_dir:
+            return
+        self.current_dir = None
+        await self.voidcmd('CWD ' + path)
+        if path.startswith('/'):
+            self.current_dir = path
+
+    async def delete(self, name: str):
+        await self.voidcmd('DELE ' + name)
+
+    async def delete_quietly(self, name: str):
+        try:
+            await self.delete(name)
+        except (error_perm, error_reply):
+            pass
+
+    async def mkd(self, path: str):
+        await self.voidcmd('MKD ' + path)
+
+    async def rmd(self, path: str):
+        await self.voidcmd('RMD ' + path)
+
+    async def size(self, name: str) -> Optional[int]:
+        await self.voidcmd('TYPE I')
+        try:
+            return int((await self.voidcmd('SIZE ' + name)).split()[1])
+        except (error_perm, error_reply):
+            return None
+
+    async def iter_listing(self, remote_dir: str) -> AsyncIterator[DirEntry]:
+        # the counterpart of stream_listing
+        await self.cwd(remote_dir)
+        await self.voidcmd('TYPE A')
+        command = next_listing_command(self)
+        while True:
+            try:
+                reader, writer = await self.transfer(command)
+                break
+            except (error_perm, error_reply):
+                command = next_listing_command(self, command)
+                if command is None:
+                    raise
+        parse = LISTING_PARSERS[command]
+        complete = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                entry = parse(line.decode(self.encoding, 'replace').rstrip('\r\n'))
+                if entry is not None:
+                    yield entry
+            complete = True
+        finally:
+            await close_writer(writer)
+            if complete:
+                await self.voidresp()
+            else:
+                # the transfer was abandoned; the server still sends a reply, which must not be left for the next command
+                try:
+                    await self.voidresp()
+                except FTP_ERRORS:
+                    pass
+
+    async def list_lines(self, remote_dir: str) -> List[str]:
+        # the lines of LIST, as the server formats them
+        await self.cwd(remote_dir)
+        await self.voidcmd('TYPE A')
+        reader, writer = await self.transfer('LIST')
+        result = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                result.append(line.decode(self.encoding, 'replace').rstrip('\r\n'))
+        finally:
+            await close_writer(writer)
+        await self.voidresp()
+        return result
+
+    async def store(self, local_path: str, name: str, *, overwrite: bool = False, resume: bool = False,
+                    blocksize: int = DEFAULT_BLOCK_SIZE) -> int:
+        # the counterpart of transfer.store; returns the number of bytes sent
+        command = 'STOR ' + name
+        await self.voidcmd('TYPE I')
+        with open(local_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            if resume:
+                offset = resume_offset(await self.size(name) or 0, size)
+                if offset is None:
+                    return 0
+            data = await self.open_transfer(command, offset) if offset > 0 else None
+            if data is None:
+                offset = 0
+                if overwrite:
+                    await self.delete_quietly(name)
+                data = await self.transfer(command)
+            _, writer = data
+            try:
+                if size > offset:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        view = memoryview(mapped)
+                        try:
+                            for position in range(offset, size, blocksize):
+                                writer.write(view[position:position + blocksize])
+                                await writer.drain()
+                        finally:
+                            view.release()
+            finally:
+                await close_writer(writer)
+        await self.voidresp()
+        return size - offset
+
+    async def retrieve(self, name: str, local_path: str, *, resume: bool = False,
+                       blocksize: int = DEFAULT_BLOCK_SIZE) -> int:
+        # the counterpart of transfer.retrieve; returns the number of bytes received
+        command = 'RETR ' + name
+        await self.voidcmd('TYPE I')
+        offset = 0
+        if resume:
+            size = await self.size(name)
+            offset = resume_download(local_path, lambda: size)
+            if offset is None:
+                return 0
+        data = await self.open_transfer(command, offset) if offset > 0 else None
+        if data is None:
+            offset = 0
+            data = await self.transfer(command)
+        reader, writer = data
+        count = 0
+        try:
+            with open(partial_path(local_path), 'ab' if offset > 0 else 'wb') as f:
+                while True:
+                    block = await reader.read(blocksize)
+                    if not block:
+                        break
+                    f.write(block)
+                    count += len(block)
+        finally:
+            await close_writer(writer)
+        await self.voidresp()
+        os.replace(partial_path(local_path), local_path)
+        return count
+
+    async def quit(self):
+        try:
+            await self.voidcmd('QUIT')
+        except (error_reply, error_temp, error_perm, OSError, EOFError):
+            pass
+        await close_writer(self.writer)
+
+
+class AsyncSettingsTransaction(SettingsTransaction):
+    # the settings of AsyncUltimate1541, changed when the async with block ends
+    u: 'AsyncUltimate1541'
+
+    def __enter__(self):
+        raise TypeError('Use async with for the settings of AsyncUltimate1541')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        if type is None:
+            await self.apply()
+
+    async def apply(self) -> None:
+        if len(self.changes) == 0:
+            return
+        u = self.u
+        async with u.telnet_lock:
+            c = await u.open_telnet()
+            try:
+                await c.run(self.apply_steps(c.console, use_cache=True))
+            except NavigationError:
+                # the cached menu layout is stale, start over the slow way
+                u.menu_cache.invalidate(u.ip_addr)
+                c.console.close()
+                await c.run(self.apply_steps(c.console, use_cache=False))
+        self.changes.clear()
+
+
+class AsyncUltimate1541:
+    # The asyncio counterpart of Ultimate1541, without telnetlib.
+    # Menu operations and the main FTP connection are serialized separately, so a transfer can run during navigation;
+    # several devices can be driven from one event loop with asyncio.gather.
+
+    def __init__(self, ip_addr: str, *, menu_cache: Optional[MenuCache] = None, telnet_port: int = 23,
+                 ftp_port: int = 21):
+        self.ip_addr: str = ip_addr
+        self.telnet_port: int = telnet_port
+        self.ftp_port: int = ftp_port
+        self.menu_cache: MenuCache = menu_cache if menu_cache is not None else MenuCache()
+        self.firmware: Optional[str] = None
+        self.console_manipulator: Optional[AsyncConsoleManipulator] = None
+        self.ftp: Optional[AsyncFTP] = None
+        self.dir_cache: DirectoryCache = DirectoryCache()
+        self.telnet_lock: asyncio.Lock = asyncio.Lock()
+        self.ftp_lock: asyncio.Lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def close(self):
+        if self.ftp is not None:
+            await self.ftp.quit()
+            self.ftp = None
+        if self.console_manipulator is not None:
+            await self.console_manipulator.close()
+            self.console_manipulator = None
+
+    async def open_telnet(self) -> AsyncConsoleManipulator:
+        if self.console_manipulator is not None and self.console_manipulator.eof:
+            self.console_manipulator = None
+        if self.console_manipulator is None:
+            reader, writer = await asyncio.open_connection(self.ip_addr, self.telnet_port)
+            c = AsyncConsoleManipulator(reader, writer)
+            c.directory_lister = self.browser_listing
+            c.start()
+            await c.refresh_screen()
+            self.firmware = c.console.firmware()
+            self.console_manipulator = c
+        return self.console_manipulator
+
+    async def open_ftp(self) -> AsyncFTP:
+        if self.ftp is None:
+            ftp = AsyncFTP(self.ip_addr, self.ftp_port)
+            await ftp.connect()
+            self.ftp = ftp
+        return self.ftp
+
+    async def get_usb_devices(self) -> List[str]:
+        async with self.telnet_lock:
+            c = await self.open_telnet()
+            await c.go_home()
+            return [item.label for item in c.get_big_menu().items if item.label.startswith('Usb')]
+
+    async def run_file(self, remote_path: str):
+        await self.do_with_file('Run', remote_path)
+
+    async def mount_file(self, remote_path: str):
+        await self.do_with_file('Mount disk', remote_path)
+
+    async def do_with_file(self, command: str, remote_path: str):
+        path_split = split_path(remote_path)
+        async with self.telnet_lock:
+            c = await self.open_telnet()
+            await c.do_with_file(command, path_split[0], path_split[1:])
+
+    async def upload_file(self, local_path: str, remote_path: str, *, overwrite: bool = False, resume: bool = False,
+                          blocksize: int = DEFAULT_BLOCK_SIZE) -> int:
+        async with self.ftp_lock:
+            ftp = await self.open_ftp()
+            try:
+                await ftp.cwd(os.path.dirname(remote_path))
+                return await ftp.store(local_path, os.path.basename(remote_path), overwrite=overwrite, resume=resume,
+                                       blocksize=blocksize)
+            finally:
+                self.dir_cache.invalidate_parent(remote_path)
+
+    async def download_file(self, remote_path: str, local_path: str, *, resume: bool = False,
+                            blocksize: int = DEFAULT_BLOCK_SIZE) -> int:
+        async with self.ftp_lock:
+            ftp = await self.open_ftp()
+            await ftp.cwd(os.path.dirname(remote_path))
+            return await ftp.retrieve(os.path.basename(remote_path), local_path, resume=resume, blocksize=blocksize)
+
+    async def delete_file(self, remote_path: str, *, quietly: bool = False):
+        async with self.ftp_lock:
+            ftp = await self.open_ftp()
+            await ftp.cwd(os.path.dirname(remote_path))
+            self.dir_cache.invalidate_parent(remote_path)
+            if quietly:
+                await ftp.delete_quietly(os.path.basename(remote_path))
+            else:
+                await ftp.delete(os.path.basename(remote_path))
+
+    async def make_directory(self, remote_path: str):
+        async with self.ftp_lock:
+            ftp = await self.open_ftp()
+            try:
+                await ftp.mkd(remote_path)
+            finally:
+                self.dir_cache.invalidate_parent(remote_path)
+
+    async def remove_directory(self, remote_path: str):
+        async with self.ftp_lock:
+            ftp = await self.open_ftp()
+            # the server may refuse to remove the current directory
+            await ftp.cwd(parent_dir(remote_path))
+            try:
+                await ftp.rmd(remote_path)
+            finally:
+                self.dir_cache.invalidate_parent(remote_path)
+                self.dir_cache.invalidate_tree(remote_path)
+
+    async def list_dir(self, remote_directory: str) -> List[DirEntry]:
+        cached = self.dir_cache.get(remote_directory)
+        if cached is not None:
+            return cached
+        async with self.ftp_lock:
+            ftp = await self.open_ftp()
+            result = [entry async for entry in ftp.iter_listing(remote_directory)]
+        self.dir_cache.put(remote_directory, result)
+        return result
+
+    async def dir(self, remote_directory: str) -> List[str]:
+        # the lines of LIST, as the server formats them; always fresh, unlike list_dir
+        async with self.ftp_lock:
+            ftp = await self.open_ftp()
+            return await ftp.list_lines(remote_directory)
+
+    async def stat(self, remote_path: str) -> Optional[DirEntry]:
+        if normalize_dir(remote_path) == '/':
+            return DirEntry('', 'dir')
+        try:
+            return find_entry(await self.list_dir(parent_dir(remote_path)), remote_path)
+        except error_perm:
+            return None
+
+    async def exists(self, remote_path: str) -> bool:
+        return await self.stat(remote_path) is not None
+
+    async def is_dir(self, remote_path: str) -> bool:
+        entry = await self.stat(remote_path)
+        return entry is not None and entry.is_dir
+
+    async def browser_listing(self, location: List[str]) -> Optional[List[str]]:
+        # the names in a directory, in the order of the file browser, for the console steps
+        try:
+            return [entry.name for entry in browser_order(await self.list_dir('/' + '/'.join(location)))]
+        except FTP_ERRORS:
+            return None
+
+    def settings(self) -> AsyncSettingsTransaction:
+        return AsyncSettingsTransaction(self)
+
+    async def set_setting(self, option_path: List[str], value: str):
+        async with self.settings() as s:
+            s.set(option_path, value)
+
+    async def set_reu_enabled(self, enabled: bool):
+        await self.set_setting(REU_ENABLED_PATH, normalize_enabled(enabled))
+
+    async def set_reu_size(self, size: Union[int, str, Tuple[int, str]]):
+        await self.set_setting(REU_SIZE_PATH, normalize_reu_size(size))
+
+    async def set_command_interface_enabled(self, enabled: bool):
+        await self.set_setting(COMMAND_INTERFACE_PATH, normalize_enabled(enabled))
+
+    async def dump_settings(self, *, max_age: Optional[float] = None) -> Dict[str, Dict[str, str]]:
+        async with self.telnet_lock:
+            c = await self.open_telnet()
+            await c.run(crawl_settings_steps(self, c.console, max_age=max_age))
+        return snapshot(self)
+
+    async def apply_settings_profile(self, profile: Dict[str, Dict[str, str]]) -> List[Tuple[str, str, str]]:
+        changes = profile_changes(self, profile)
+        async with self.settings() as s:
+            for category, setting, value in changes:
+                s.set([category, setting], value)
+        return changes
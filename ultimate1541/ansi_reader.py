@@ -1,8 +1,14 @@
-from typing import Optional, Union
-from telnetlib import Telnet
+import re
+from collections import deque
+from typing import Optional, Union, List, Deque, TYPE_CHECKING
+from select import select
 from ultimate1541.escape_sequence import EscapeSequence
+from ultimate1541 import tracing
 from abc import ABC, abstractmethod
 
+if TYPE_CHECKING:
+    from telnetlib import Telnet
+
 V100_ACS = {
     'j': '┘',
     'k': '┐',
@@ -17,95 +23,163 @@ V100_ACS = {
     'x': '│',
 }
 
+V100_ACS_TABLE = str.maketrans(V100_ACS)
+
+Token = Union[str, EscapeSequence]
+
+# a run of printable text, a line break, or a complete escape sequence;
+# an escape sequence cut off by the end of a chunk does not match at all
+TOKEN_PATTERN = re.compile(rb'([^\x1b\r\n]+)|([\r\n])|\x1b(?:\[([0-9;,]*)([^0-9;,])|\((.)|([^\[(]))', re.DOTALL)
+PARAM_SEPARATOR = re.compile(rb'[;,]')
+
 
 class AnsiReaderWriter(ABC):
     def __init__(self):
         self.shifted: bool = False
+        self.partial: bytes = b''
+        self.tokens: Deque[Token] = deque()
 
     @abstractmethod
-    def read_byte(self) -> Optional[int]:
+    def read_chunk(self) -> bytes:
         pass
 
     @abstractmethod
     def write(self, data: bytes) -> None:
         pass
 
+    @abstractmethod
+    def wait_for_input(self, timeout: float) -> bool:
+        pass
+
+    def wait_for_data(self, timeout: float) -> bool:
+        if self.tokens:
+            return True
+        return self.wait_for_input(timeout)
+
     def read_token(self) -> Union[None, str, EscapeSequence]:
-        c = self.read_byte()
-        if c is None:
-            return None
-        if type(c) != int:
-            raise TypeError("c should be int, is " + str(type(c)))
-        if c != 0x1b:
-            # TODO: shifted character set
-            char = chr(c)
-            if self.shifted and char in V100_ACS:
-                return V100_ACS[char]
-            return char
-        cmd1 = chr(self.read_byte())
-        if cmd1 == '[':
-            params = [0]
-            while True:
-                c = self.read_byte()
-                if c == ord(';') or c == ord(','):
-                    params.append(0)
-                elif 0x30 <= c <= 0x39:
-                    params[-1] *= 10
-                    params[-1] += c - 0x30
+        if not self.tokens:
+            self.tokens.extend(self.read_tokens())
+            if not self.tokens:
+                return None
+        return self.tokens.popleft()
+
+    def read_tokens(self) -> List[Token]:
+        if self.tokens:
+            result = list(self.tokens)
+            self.tokens.clear()
+            return result
+        while True:
+            chunk = self.read_chunk()
+            if chunk == b'':
+                return []
+            if type(chunk) != bytes:
+                raise TypeError("chunk should be bytes, is " + str(type(chunk)))
+            if tracing.tracer is not None:
+                tracing.count(bytes_received=len(chunk))
+            result = self.tokenize(chunk)
+            if result:
+                return result
+
+    def tokenize(self, chunk: bytes) -> List[Token]:
+        data = self.partial + chunk if self.partial else chunk
+        result: List[Token] = []
+        pos = 0
+        end = len(data)
+        while pos < end:
+            m = TOKEN_PATTERN.match(data, pos)
+            if m is None:
+                break
+            pos = m.end()
+            text, newline, csi_params, csi_command, charset, command = m.groups()
+            if text is not None:
+                run = text.decode('latin-1')
+                if self.shifted:
+                    run = run.translate(V100_ACS_TABLE)
+                result.append(run)
+            elif newline is not None:
+                result.append('\r' if newline == b'\r' else '\n')
+            elif csi_command is not None:
+                params = [int(p) if p else 0 for p in PARAM_SEPARATOR.split(csi_params)]
+                result.append(EscapeSequence(command='[' + csi_command.decode('latin-1'), params=params))
+            elif charset is not None:
+                if charset == b'B':
+                    self.shifted = False
+                elif charset == b'0':
+                    self.shifted = True
                 else:
-                    return EscapeSequence(command=cmd1 + chr(c), params=params)
-        elif cmd1 == '(':
-            cmd2 = chr(self.read_byte())
-            if cmd2 == 'B':
-                self.shifted = False
-            elif cmd2 == '0':
-                self.shifted = True
+                    raise ValueError('Unsupported escape sequence: ESC (' + charset.decode('latin-1'))
+            elif command == b'c':
+                result.append(EscapeSequence('c', []))
             else:
-                raise ValueError('Unsupported escape sequence: ESC ' + cmd1 + cmd2)
-            return self.read_token()
-        elif cmd1 == 'c':
-            return EscapeSequence('c', [])
-        else:
-            raise ValueError('Unsupported escape sequence: ESC ' + cmd1)
+                raise ValueError('Unsupported escape sequence: ESC ' + command.decode('latin-1'))
+        self.partial = data[pos:]
+        return result
 
 
 class TelnetAnsiReaderWriter(AnsiReaderWriter):
 
-    def __init__(self, tn: Telnet):
+    def __init__(self, tn: 'Telnet'):
         super().__init__()
-        self.tn: Telnet = tn
-        self.buf: bytes = b''
-        self.cursor: int = 0
+        self.tn: 'Telnet' = tn
 
     def write(self, data: bytes):
         self.tn.write(data)
 
-    def read_byte(self) -> Optional[int]:
-        if self.cursor >= len(self.buf):
-            self.buf = self.tn.read_eager()
-            self.cursor = 0
-        if self.buf == b'':
-            return None
-        c = self.buf[self.cursor]
-        self.cursor += 1
-        return c
+    def wait_for_input(self, timeout: float) -> bool:
+        if self.tn.cookedq:
+            return True
+        readable, _, _ = select([self.tn], [], [], max(0.0, timeout))
+        return len(readable) > 0
+
+    def read_chunk(self) -> bytes:
+        return self.tn.read_eager()
 
 
 class FixedAnsiReaderWriter(AnsiReaderWriter):
 
-    def __init__(self, buf: bytes):
+    def __init__(self, buf: bytes, chunk_size: Optional[int] = None):
         super().__init__()
         if type(buf) != bytes:
             raise TypeError("buf should be bytes")
         self.buf: bytes = buf
         self.cursor: int = 0
+        self.chunk_size: int = chunk_size if chunk_size is not None else max(1, len(buf))
 
     def write(self, data: bytes):
         pass
 
-    def read_byte(self) -> Optional[int]:
-        if self.cursor >= len(self.buf):
-            return None
-        c = self.buf[self.cursor]
-        self.cursor += 1
-        return c
+    def wait_for_input(self, timeout: float) -> bool:
+        return self.cursor < len(self.buf)
+
+    def read_chunk(self) -> bytes:
+        chunk = self.buf[self.cursor:self.cursor + self.chunk_size]
+        self.cursor += len(chunk)
+        return chunk
+
+
+class BufferedAnsiReaderWriter(AnsiReaderWriter):
+    # Fed with data by someone else, e.g. an asyncio task; written keys are kept until taken.
+
+    def __init__(self):
+        super().__init__()
+        self.incoming: bytearray = bytearray()
+        self.outgoing: bytearray = bytearray()
+
+    def feed(self, data: bytes):
+        self.incoming += data
+
+    def take_output(self) -> bytes:
+        data = bytes(self.outgoing)
+        self.outgoing.clear()
+        return data
+
+    def write(self, data: bytes):
+        self.outgoing += data
+
+    def wait_for_input(self, timeout: float) -> bool:
+        return len(self.incoming) > 0
+
+    def read_chunk(self) -> bytes:
+        data = bytes(self.incoming)
+        self.incoming.clear()
+        return data
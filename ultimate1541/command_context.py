@@ -0,0 +1,23 @@
+import os
+import sys
+from typing import Optional, TextIO
+
+
+class CommandContext:
+    # Where a command prints to and what its relative local paths are relative to.
+    # The agent and the fleet runner give every command its own, as they run commands in threads
+    # that share the standard output and the working directory of the process.
+
+    def __init__(self, stdout: Optional[TextIO] = None, stderr: Optional[TextIO] = None, cwd: Optional[str] = None):
+        self.stdout: TextIO = stdout if stdout is not None else sys.stdout
+        self.stderr: TextIO = stderr if stderr is not None else sys.stderr
+        self.cwd: Optional[str] = cwd
+
+    def path(self, local_path: str) -> str:
+        # - stays the standard input or output
+        if local_path == '-' or self.cwd is None:
+            return local_path
+        return os.path.join(self.cwd, os.path.expanduser(local_path))
+
+    def print(self, *args, **kwargs):
+        print(*args, file=self.stdout, **kwargs)
@@ -0,0 +1,64 @@
+import socket
+import struct
+from typing import Optional
+
+from ultimate1541.tracing import traced
+
+# The binary remote control socket of the Ultimate (the "Ultimate DMA service" in the network settings).
+# Every command is a little-endian 16-bit command code and 16-bit payload length, followed by the payload;
+# the commands used here get no reply.
+
+COMMAND_PORT = 64
+
+SOCKET_CMD_DMA = 0xff01
+SOCKET_CMD_DMARUN = 0xff02
+SOCKET_CMD_RESET = 0xff04
+
+HEADER = struct.Struct('<HH')
+MAX_PAYLOAD = 0xffff
+
+
+def check_prg(data: bytes):
+    # a program file starts with its two-byte load address
+    if len(data) < 3:
+        raise ValueError('Not a program file: it is too short')
+    if len(data) > MAX_PAYLOAD:
+        raise ValueError('Program file is too long: {} bytes'.format(len(data)))
+    address = data[0] | (data[1] << 8)
+    if address + len(data) - 2 > 0x10000:
+        raise ValueError('Program file does not fit in the memory when loaded at ${:04x}'.format(address))
+
+
+class CommandSocket:
+    def __init__(self, host: str, port: int = COMMAND_PORT, timeout: Optional[float] = None):
+        self.sock: socket.socket = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, command: int, payload: bytes = b''):
+        if len(payload) > MAX_PAYLOAD:
+            raise ValueError('Payload too long: {} bytes'.format(len(payload)))
+        self.sock.sendall(HEADER.pack(command, len(payload)) + payload)
+
+    @traced
+    def run_prg(self, data: bytes):
+        # loads the program into the memory of the C64 and runs it, like LOAD and RUN
+        check_prg(data)
+        self.send(SOCKET_CMD_DMARUN, data)
+
+    @traced
+    def load_prg(self, data: bytes):
+        check_prg(data)
+        self.send(SOCKET_CMD_DMA, data)
+
+    @traced
+    def reset(self):
+        self.send(SOCKET_CMD_RESET)
@@ -1,9 +1,13 @@
-from typing import Tuple, Optional, List
-from time import sleep
+import re
+from typing import Tuple, Optional, List, Callable, Generator, Union, Any
+from time import monotonic
 
 from ultimate1541.menu import Menu
 from ultimate1541.pseudoscreen import PseudoScreen
 from ultimate1541.ansi_reader import AnsiReaderWriter
+from ultimate1541.settle import SettleDetector, MAX_SETTLE_TIME, deadline_after, time_left
+from ultimate1541 import tracing
+from ultimate1541.tracing import traced, traced_steps
 
 ANSI_UP = b'\x1b[A'
 ANSI_DOWN = b'\x1b[B'
@@ -12,25 +16,144 @@ ANSI_LEFT = b'\x1b[D'
 ANSI_RETURN = b'\r'
 ANSI_F2 = b'\x1b[12~'
 
+# pressing up this many times reaches the top of any menu
+MAX_MENU_LENGTH = 40
+
+# the title at the top of the menu, e.g. *** Ultimate-II+ V3.10 ***
+FIRMWARE_HEADER = re.compile(r'\*\*\* +(\S*Ultimate.*?) +\*\*\*')
+
+
+class NavigationError(ValueError):
+    pass
+
+
+class NavigationStep:
+    def __init__(self, label: str, index: Optional[int] = None, *, use_return: bool = True):
+        self.label: str = label
+        self.index: Optional[int] = index
+        self.use_return: bool = use_return
+
+    def __str__(self):
+        return self.label if self.index is None else self.label + '@' + str(self.index)
+
+
+class WaitForData:
+    # asked for by the steps: send the pressed keys and wait at most `timeout` seconds for more of the screen;
+    # the answer is whether anything arrived
+    __slots__ = ('timeout',)
+
+    def __init__(self, timeout: float):
+        self.timeout: float = timeout
+
+
+class ListDirectory:
+    # asked for by the steps: the names in a browser location in the order the browser shows them, or None
+    __slots__ = ('location',)
+
+    def __init__(self, location: List[str]):
+        self.location: List[str] = location
+
+
+# The decisions about the screen and the menus are written once, as generators of the *_steps methods,
+# which ask for what needs waiting with WaitForData and ListDirectory and get the answer sent back.
+# ConsoleManipulator.run performs the steps with blocking reads, AsyncConsoleManipulator.run awaits them.
+Steps = Generator[Union[WaitForData, ListDirectory], Any, Any]
+
 
 class ConsoleManipulator:
     def __init__(self, reader: AnsiReaderWriter):
         self.screen: PseudoScreen = PseudoScreen()
         self.reader: AnsiReaderWriter = reader
+        self.settle: SettleDetector = SettleDetector()
+        self.small_menu: Optional[Menu] = None
+        # keys pressed since the last refresh, sent together in one write
+        self.keys: bytearray = bytearray()
+        # how many key presses those are, for tracing
+        self.key_count: int = 0
+        self.small_menu_version: int = -1
+        # where the file browser is: the device followed by the directories, [] for the device list,
+        # None if unknown; checked against the path line before it is relied on
+        self.location: Optional[List[str]] = None
+        # the browser location to return to when the settings are left
+        self.location_before_settings: Optional[List[str]] = None
+        # the entry the browser cursor is on, None for the first one; meaningful only with a known location
+        self.cursor_entry: Optional[str] = None
+        # gives the entries of a browser location in the order the browser shows them, or None
+        self.directory_lister: Optional[Callable[[List[str]], Optional[List[str]]]] = None
 
     def open(self):
         pass
 
+    @traced
     def close(self):
-        self.reader.write(b'\x1b\x1b' * 10)
+        self.press(b'\x1b\x1b', 10)
+        self.flush_keys()
+        self.location = None
 
-    def refresh_screen(self):
-        sleep(0.2)
+    def run(self, steps: Steps) -> Any:
+        # performs the steps, waiting for the screen with blocking reads; returns what the steps return
+        answer = None
+        error: Optional[Exception] = None
         while True:
-            t = self.reader.read_token()
-            if t is None:
+            try:
+                request = steps.throw(error) if error is not None else steps.send(answer)
+            except StopIteration as e:
+                return e.value
+            answer, error = None, None
+            try:
+                if isinstance(request, WaitForData):
+                    answer = self.__wait_for_data(request.timeout)
+                elif self.directory_lister is not None:
+                    answer = self.directory_lister(request.location)
+            except Exception as e:
+                error = e
+
+    def refresh_screen(self, *, deadline: Optional[float] = None):
+        self.run(self.refresh_screen_steps(deadline=deadline))
+
+    @traced_steps
+    def refresh_screen_steps(self, *, deadline: Optional[float] = None) -> Steps:
+        start = monotonic()
+        hard_deadline = start + MAX_SETTLE_TIME
+        if deadline is not None:
+            hard_deadline = min(hard_deadline, deadline)
+        self.flush_keys()
+        received = self.__drain()
+        last = start
+        while True:
+            window = self.settle.quiet_window() if received else self.settle.response_window()
+            wait = min(window, hard_deadline - monotonic())
+            if wait <= 0:
+                return
+            if not (yield WaitForData(wait)):
                 return
-            self.screen.write(t)
+            now = monotonic()
+            if received:
+                self.settle.observe_gap(now - last)
+            else:
+                self.settle.observe_response(now - start)
+            last = now
+            if self.__drain():
+                received = True
+
+    def __drain(self) -> bool:
+        received = False
+        while True:
+            tokens = self.reader.read_tokens()
+            if not tokens:
+                return received
+            for t in tokens:
+                self.screen.write(t)
+            received = True
+
+    def __wait_for_data(self, timeout: float) -> bool:
+        if tracing.tracer is None:
+            return self.reader.wait_for_data(timeout)
+        start = monotonic()
+        try:
+            return self.reader.wait_for_data(timeout)
+        finally:
+            tracing.count(wait_s=monotonic() - start)
 
     def __rect_to_menu(self, rect: [[Tuple[int, str]]]) -> Menu:
         menu = Menu()
@@ -54,33 +177,78 @@ class ConsoleManipulator:
         return self.__rect_to_menu(rect)
 
     def get_small_menu(self) -> Optional[Menu]:
+        if self.small_menu_version == self.screen.version:
+            return self.small_menu
         maybe = self.screen.find_bordered_rectangle()
         if maybe is None:
-            return None
-        rect: [[Tuple[int, str]]] = self.screen.parse_rectangle(*maybe)
-        return self.__rect_to_menu(rect)
+            self.small_menu = None
+        else:
+            rect: [[Tuple[int, str]]] = self.screen.parse_rectangle(*maybe)
+            self.small_menu = self.__rect_to_menu(rect)
+        self.small_menu_version = self.screen.version
+        return self.small_menu
+
+    def wait_for_screen_steps(self, timeout: float, condition: Callable[[], bool]) -> Steps:
+        # refreshes the screen until the condition holds; returns False if it does not within the timeout
+        deadline = deadline_after(timeout)
+        while True:
+            yield from self.refresh_screen_steps(deadline=deadline)
+            if condition():
+                return True
+            if time_left(deadline) <= 0 or not (yield WaitForData(time_left(deadline))):
+                return False
 
     def wait_for_small_menu(self, timeout: float) -> None:
-        while timeout >= 0:
-            self.refresh_screen()
-            if self.get_small_menu() is not None:
-                return
-            timeout -= 0.2
-        raise TimeoutError('Small menu timed out')
+        self.run(self.wait_for_small_menu_steps(timeout))
+
+    @traced_steps
+    def wait_for_small_menu_steps(self, timeout: float) -> Steps:
+        if not (yield from self.wait_for_screen_steps(timeout, lambda: self.get_small_menu() is not None)):
+            raise TimeoutError('Small menu timed out')
 
     def wait_for_device_opening(self, timeout: float) -> None:
-        while timeout >= 0:
-            self.refresh_screen()
-            if self.screen.char_at(0, 24) == '/':
-                return
-            if self.screen.char_at(0, 23) == '/':
-                return
-            timeout -= 0.2
-        self.screen.print_all()
-        raise TimeoutError('Device opening timed out')
+        self.run(self.wait_for_device_opening_steps(timeout))
+
+    @traced_steps
+    def wait_for_device_opening_steps(self, timeout: float) -> Steps:
+        if not (yield from self.wait_for_screen_steps(timeout, lambda: self.path_line() is not None)):
+            self.screen.print_all()
+            raise TimeoutError('Device opening timed out')
+
+    def press(self, key: bytes, times: int = 1) -> None:
+        self.keys += key * times
+        self.key_count += times
+
+    def flush_keys(self) -> None:
+        if self.keys:
+            if tracing.tracer is not None:
+                tracing.count(keys=self.key_count, bytes_sent=len(self.keys))
+            self.reader.write(bytes(self.keys))
+            self.keys.clear()
+        self.key_count = 0
+
+    def current_menu(self) -> Menu:
+        menu = self.get_small_menu()
+        if menu is None:
+            menu = self.get_big_menu()
+        return menu
+
+    def __press_move(self, index: int, position: Optional[int]) -> None:
+        if position is None:
+            self.press(ANSI_UP, MAX_MENU_LENGTH)
+            self.press(ANSI_DOWN, index)
+        elif index < position:
+            self.press(ANSI_UP, position - index)
+        else:
+            self.press(ANSI_DOWN, index - position)
 
     def select_option(self, index: int, *, use_return: Optional[bool] = None) -> None:
-        self.refresh_screen()
+        self.run(self.select_option_steps(index, use_return=use_return))
+
+    @traced_steps
+    def select_option_steps(self, index: int, *, use_return: Optional[bool] = None) -> Steps:
+        self.location = None
+        yield from self.refresh_screen_steps()
         menu = self.get_small_menu()
         if use_return is None:
             if menu is None:
@@ -94,30 +262,33 @@ class ConsoleManipulator:
         if menu is None:
             menu = self.get_big_menu()
         if menu is not None and len(menu.selected) == 1:
-            return self.select_option_relative(index - menu.selected[0], use_return=(enter == ANSI_RETURN))
-        for j in range(40):
-            self.reader.write(ANSI_UP)
-        for j in range(index):
-            self.reader.write(ANSI_DOWN)
-        self.reader.write(enter)
-        self.refresh_screen()
+            yield from self.select_option_relative_steps(index - menu.selected[0], use_return=(enter == ANSI_RETURN))
+            return
+        self.__press_move(index, None)
+        self.press(enter)
+        yield from self.refresh_screen_steps()
 
     def select_option_relative(self, offset: int, *, use_return: bool = False) -> None:
+        self.run(self.select_option_relative_steps(offset, use_return=use_return))
+
+    @traced_steps
+    def select_option_relative_steps(self, offset: int, *, use_return: bool = False) -> Steps:
+        self.location = None
         if use_return:
             enter = ANSI_RETURN
         else:
             enter = ANSI_RIGHT
-        if offset < 0:
-            for j in range(-offset):
-                self.reader.write(ANSI_UP)
-        else:
-            for j in range(offset):
-                self.reader.write(ANSI_DOWN)
-        self.reader.write(enter)
-        self.refresh_screen()
+        self.__press_move(offset, 0)
+        self.press(enter)
+        yield from self.refresh_screen_steps()
+
+    def select_option_by_name(self, name: str, *, use_return: Optional[bool] = None) -> None:
+        self.run(self.select_option_by_name_steps(name, use_return=use_return))
 
-    def select_option_by_name(self, name: str, *, use_return:Optional[bool] = None) -> None:
-        self.refresh_screen()
+    @traced_steps
+    def select_option_by_name_steps(self, name: str, *, use_return:Optional[bool] = None) -> Steps:
+        self.location = None
+        yield from self.refresh_screen_steps()
         small_menu = self.get_small_menu()
         big_menu = None
         index: Optional[int] = None
@@ -135,35 +306,210 @@ class ConsoleManipulator:
             # print('big menu: ' + str(big_menu))
             menu = small_menu if small_menu is not None else big_menu
             raise ValueError('Item labelled ' + name + ' does not exist! Available items: ' + ', '.join(map(lambda i:i.label, menu.items)))
-        for j in range(index):
-            self.reader.write(ANSI_DOWN)
-        self.reader.write(enter)
-        sleep(0.2)
-        self.refresh_screen()
+        self.press(ANSI_DOWN, index)
+        self.press(enter)
+        yield from self.refresh_screen_steps()
+
+    def navigate(self, steps: List[NavigationStep], *, observe: Optional[Callable[[int, Menu], None]] = None,
+                 position: Optional[int] = None) -> None:
+        self.run(self.navigate_steps(steps, observe=observe, position=position))
+
+    @traced_steps
+    def navigate_steps(self, steps: List[NavigationStep], *, observe: Optional[Callable[[int, Menu], None]] = None,
+                       position: Optional[int] = None) -> Steps:
+        # steps with known indices are sent without looking at the screen,
+        # so a path with all indices known costs one burst of keys and one check before the last selection
+        # position is where the cursor is in the current menu, if it is known
+        if len(steps) == 0:
+            return
+        self.location = None
+        for i, step in enumerate(steps):
+            if step.index is None:
+                yield from self.refresh_screen_steps()
+                menu = self.current_menu()
+                index = menu.lookup_by_label(step.label)
+                if index is None:
+                    raise NavigationError('Item labelled ' + step.label + ' does not exist! Available items: ' + ', '.join(map(lambda i:i.label, menu.items)))
+                if observe is not None:
+                    observe(i, menu)
+                position = menu.selected[0] if len(menu.selected) == 1 else None
+            else:
+                index = step.index
+            self.__press_move(index, position)
+            if i == len(steps) - 1:
+                yield from self.refresh_screen_steps()
+                menu = self.current_menu()
+                if len(menu.selected) != 1 or menu.items[menu.selected[0]].label != step.label:
+                    raise NavigationError('Expected ' + step.label + ' to be selected, found: ' + ', '.join(menu.items[j].label for j in menu.selected))
+                if observe is not None and step.index is not None:
+                    observe(i, menu)
+            self.press(ANSI_RETURN if step.use_return else ANSI_RIGHT)
+            # the cursor position in a freshly opened menu is not known
+            position = None
+        yield from self.refresh_screen_steps()
 
     def go_back(self):
-        self.reader.write(ANSI_LEFT)
-        self.refresh_screen()
+        self.run(self.go_back_steps())
+
+    @traced_steps
+    def go_back_steps(self) -> Steps:
+        self.press(ANSI_LEFT)
+        yield from self.refresh_screen_steps()
+        if self.location:
+            self.cursor_entry = self.location[-1]
+            self.location = self.location[:-1]
 
     def go_home(self):
-        for j in range(8):
-            self.reader.write(ANSI_LEFT)
-        self.refresh_screen()
+        self.run(self.go_home_steps())
+
+    @traced_steps
+    def go_home_steps(self) -> Steps:
+        self.press(ANSI_LEFT, 8)
+        yield from self.refresh_screen_steps()
+        self.location = []
 
     def enter_settings(self):
-        self.reader.write(ANSI_F2)
-        self.wait_for_small_menu(timeout=1)
-        self.refresh_screen()
+        self.run(self.enter_settings_steps())
+
+    @traced_steps
+    def enter_settings_steps(self) -> Steps:
+        location = self.location
+        self.press(ANSI_F2)
+        yield from self.wait_for_small_menu_steps(timeout=1)
+        yield from self.refresh_screen_steps()
+        self.location_before_settings = location
+        self.location = None
 
     def leave_settings(self):
-        self.reader.write(b'\x1b ')
-        while self.get_small_menu() is not None:
-            self.refresh_screen()
+        self.run(self.leave_settings_steps())
+
+    @traced_steps
+    def leave_settings_steps(self) -> Steps:
+        self.press(b'\x1b ')
+        if not (yield from self.wait_for_screen_steps(1, lambda: self.get_small_menu() is None)):
+            raise TimeoutError('Settings did not close')
+        self.location = self.location_before_settings
+        self.location_before_settings = None
+
+    def firmware(self) -> Optional[str]:
+        # the product and version in the title of the menu, e.g. Ultimate-II+ V3.10; None for an unknown title
+        match = FIRMWARE_HEADER.fullmatch(self.screen.line(0).strip())
+        return match.group(1) if match is not None else None
 
+    def path_line(self) -> Optional[str]:
+        # the path of the directory shown by the file browser
+        for y in (24, 23):
+            if self.screen.char_at(0, y) == '/':
+                return self.screen.line(y).strip()
+        return None
 
+    def location_on_screen(self, location: List[str]) -> bool:
+        return self.run(self.location_on_screen_steps(location))
 
+    @traced_steps
+    def location_on_screen_steps(self, location: List[str]) -> Steps:
+        yield from self.refresh_screen_steps()
+        if len(location) == 0 or self.get_small_menu() is not None:
+            return False
+        line = self.path_line()
+        if line is None:
+            return False
+        shown = line.rstrip('/').lower()
+        expected = ('/' + '/'.join(location)).lower()
+        # long paths are shortened at the front
+        return shown == expected or (shown.startswith('/...') and expected.endswith(shown[4:]))
 
+    def browse_to(self, device: str, directories: List[str]) -> None:
+        self.run(self.browse_to_steps(device, directories))
+
+    @traced_steps
+    def browse_to_steps(self, device: str, directories: List[str]) -> Steps:
+        # Opens the directory in the file browser, starting from where the browser already is:
+        # it goes up only to the common ancestor and then down from there.
+        target = [device] + directories
+        location = self.location
+        if location is None or len(location) == 0 or not (yield from self.location_on_screen_steps(location)):
+            yield from self.go_home_steps()
+            location = []
+        common = 0
+        while common < min(len(location), len(target)) and location[common] == target[common]:
+            common += 1
+        if len(location) > common:
+            self.press(ANSI_LEFT, len(location) - common)
+            yield from self.refresh_screen_steps()
+            self.cursor_entry = location[common]
+        if common == 0:
+            for i, d in enumerate(self.get_big_menu().items):
+                if d.label.startswith(device):
+                    yield from self.select_option_steps(i, use_return=False)
+                    break
+            else:
+                raise ValueError('Cannot find device ' + device)
+            yield from self.wait_for_device_opening_steps(timeout=3)
+            self.cursor_entry = None
+            common = 1
+        self.location = target[:common]
+        for d in target[common:]:
+            yield from self.select_entry_steps(d, use_return=False)
+
+    def select_entry(self, name: str, *, use_return: bool) -> None:
+        self.run(self.select_entry_steps(name, use_return=use_return))
+
+    @traced_steps
+    def select_entry_steps(self, name: str, *, use_return: bool) -> Steps:
+        # Selects an entry of the directory shown by the file browser; RIGHT enters a directory,
+        # RETURN opens the menu of a file.
+        # With a listing of the directory the cursor goes straight to the entry in one burst of keys,
+        # even if it is scrolled off the screen, and only the final selection is checked.
+        # Without one, or if the browser turns out to sort differently, the entry has to be visible.
+        location = self.location
+        names = None
+        if location:
+            names = yield ListDirectory(location)
+        if names is None or name not in names:
+            yield from self.navigate_steps([NavigationStep(name, use_return=use_return)])
+        else:
+            index = names.index(name)
+            self.__press_move(index, names.index(self.cursor_entry) if self.cursor_entry in names else 0)
+            found = yield from self.__entry_selected_steps(name)
+            if not found:
+                # the cursor was not where it was thought to be
+                self.press(ANSI_UP, len(names))
+                self.press(ANSI_DOWN, index)
+                found = yield from self.__entry_selected_steps(name)
+            if found:
+                self.press(ANSI_RETURN if use_return else ANSI_RIGHT)
+                yield from self.refresh_screen_steps()
+            else:
+                # the browser does not sort like browser_order; the entry can still be found on the screen
+                if self.get_big_menu().lookup_by_label(name) is None:
+                    self.press(ANSI_UP, len(names))
+                yield from self.navigate_steps([NavigationStep(name, use_return=use_return)])
+        if location is not None:
+            if use_return:
+                self.location = location
+                self.cursor_entry = name
+            else:
+                self.location = location + [name]
+                self.cursor_entry = None
 
-        
+    def __entry_selected_steps(self, name: str) -> Steps:
+        yield from self.refresh_screen_steps()
+        menu = self.get_big_menu()
+        return len(menu.selected) == 1 and menu.items[menu.selected[0]].label == name
 
+    def do_with_file(self, command: str, device: str, path: List[str]) -> None:
+        self.run(self.do_with_file_steps(command, device, path))
 
+    @traced_steps
+    def do_with_file_steps(self, command: str, device: str, path: List[str]) -> Steps:
+        # chooses the command, like Run or Mount disk, from the menu of a file in the browser
+        if len(path) == 0:
+            raise ValueError('path cannot be empty')
+        yield from self.browse_to_steps(device, path[:-1])
+        location = self.location
+        yield from self.select_entry_steps(path[-1], use_return=True)
+        yield from self.wait_for_small_menu_steps(timeout=1)
+        yield from self.select_option_by_name_steps(command)
+        # the context menu is gone, the browser stays in the directory
+        self.location = location
@@ -0,0 +1,165 @@
+import io
+import sys
+import threading
+import traceback
+from queue import Queue, Empty
+from time import monotonic
+from typing import Optional, List, Callable, TextIO
+
+from ultimate1541 import Ultimate1541
+from ultimate1541.command_context import CommandContext
+from ultimate1541.menu_cache import MenuCache
+from ultimate1541.sync import SyncManifest
+
+DEFAULT_FLEET_CONCURRENCY = 8
+# how long one device may take, in seconds, before it is reported as failed and left behind
+DEFAULT_HOST_TIMEOUT = 120.0
+# how long a single network operation may wait, in seconds
+DEFAULT_NETWORK_TIMEOUT = 30.0
+
+
+def read_hosts(spec: str) -> List[str]:
+    # a comma-separated list of addresses, or @file with one address per line; # starts a comment
+    if spec.startswith('@'):
+        with open(spec[1:], 'r', encoding='utf-8') as f:
+            text = f.read()
+    else:
+        text = spec.replace(',', '\n')
+    hosts = []
+    for line in text.splitlines():
+        host = line.split('#', 1)[0].strip()
+        if host != '' and host not in hosts:
+            hosts.append(host)
+    return hosts
+
+
+class HostResult:
+    def __init__(self, host: str):
+        self.host: str = host
+        self.seconds: float = 0.0
+        self.error: Optional[BaseException] = None
+        # everything the command printed while running for this host
+        self.output: str = ''
+        self.started: Optional[float] = None
+        self.done: bool = False
+
+    def __str__(self):
+        if self.error is not None:
+            return '{}: failed after {:.2f} s: {}'.format(self.host, self.seconds, describe_error(self.error))
+        return '{}: ok in {:.2f} s'.format(self.host, self.seconds)
+
+
+class FleetReport:
+    def __init__(self):
+        self.results: List[HostResult] = []
+        self.finished: int = 0
+        self.seconds: float = 0.0
+
+    def succeeded(self) -> List[HostResult]:
+        return [r for r in self.results if r.error is None]
+
+    def failed(self) -> List[HostResult]:
+        return [r for r in self.results if r.error is not None]
+
+    def __str__(self):
+        text = '{} of {} devices ok in {:.2f} s'.format(len(self.succeeded()), len(self.results), self.seconds)
+        if self.failed():
+            text += ', failed: ' + ', '.join(r.host for r in self.failed())
+        return text
+
+
+def describe_error(e: BaseException) -> str:
+    text = str(e)
+    return type(e).__name__ + (': ' + text if text else '')
+
+
+def run_fleet(hosts: List[str], action: Callable[[Ultimate1541, CommandContext], None], *,
+              concurrency: int = DEFAULT_FLEET_CONCURRENCY, timeout: float = DEFAULT_NETWORK_TIMEOUT,
+              host_timeout: float = DEFAULT_HOST_TIMEOUT,
+              progress: Optional[Callable[[HostResult, FleetReport], None]] = None,
+              capture_output: bool = True) -> FleetReport:
+    # Runs the action against every host, at most `concurrency` at a time.
+    # A host that takes longer than `host_timeout` is reported as failed and its worker is abandoned and replaced,
+    # so one dead device cannot hold up the others; network operations time out on their own after `timeout`.
+    # With capture_output, the action prints to a context of its own host, collected in HostResult.output.
+    report = FleetReport()
+    report.results = [HostResult(host) for host in hosts]
+    if not hosts:
+        return report
+    pending: Queue = Queue()
+    for result in report.results:
+        pending.put(result)
+    lock = threading.Condition()
+    menu_cache = MenuCache.default()
+    sync_manifest = SyncManifest.default()
+
+    def finish(result: HostResult, error: Optional[BaseException]):
+        # called with the lock held
+        if result.done:
+            return
+        result.done = True
+        result.error = error
+        result.seconds = monotonic() - result.started
+        report.finished += 1
+        if progress is not None:
+            progress(result, report)
+        lock.notify_all()
+
+    def work():
+        while True:
+            try:
+                result = pending.get_nowait()
+            except Empty:
+                return
+            with lock:
+                result.started = monotonic()
+            # has .buffer like sys.stdout, for commands that write binary data
+            output = io.TextIOWrapper(io.BytesIO(), encoding='utf-8', write_through=True) if capture_output else None
+            context = CommandContext(output, output)
+            error = None
+            try:
+                with Ultimate1541(result.host, menu_cache=menu_cache, sync_manifest=sync_manifest,
+                                  timeout=timeout) as u:
+                    action(u, context)
+            except Exception as e:
+                error = e
+                if output is not None and not isinstance(e, (OSError, EOFError, ValueError)):
+                    traceback.print_exc(file=output)
+            text = output.buffer.getvalue().decode('utf-8', 'replace') if output is not None else ''
+            with lock:
+                abandoned = result.done
+                if not abandoned:
+                    result.output = text
+                    finish(result, error)
+            if abandoned:
+                # a replacement worker has taken over this slot
+                return
+
+    def start_worker():
+        threading.Thread(target=work, name='u1541-fleet', daemon=True).start()
+
+    start = monotonic()
+    for _ in range(max(1, min(concurrency, len(hosts)))):
+        start_worker()
+    with lock:
+        while report.finished < len(report.results):
+            now = monotonic()
+            running = [r for r in report.results if r.started is not None and not r.done]
+            for r in running:
+                if now - r.started >= host_timeout:
+                    finish(r, TimeoutError('no result after {:.0f} s'.format(host_timeout)))
+                    start_worker()
+            deadlines = [r.started + host_timeout for r in running if not r.done]
+            lock.wait(max(0.01, min(deadlines) - now) if deadlines else 1.0)
+    report.seconds = monotonic() - start
+    return report
+
+
+def print_fleet_report(report: FleetReport, out: Optional[TextIO] = None):
+    out = out if out is not None else sys.stdout
+    for result in report.results:
+        print(str(result), file=out)
+        for line in result.output.splitlines():
+            print('  ' + line, file=out)
+    print(str(report), file=out)
+    out.flush()
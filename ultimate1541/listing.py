@@ -0,0 +1,208 @@
+import calendar
+import re
+import threading
+import time
+from ftplib import error_perm, error_reply
+from time import monotonic
+from typing import Optional, List, Tuple, Dict, Iterator, Callable, Union, TYPE_CHECKING
+
+from ultimate1541.transfer import UltimateFTP, FTP_ERRORS
+
+if TYPE_CHECKING:
+    from ultimate1541.aio import AsyncFTP
+
+# how long a directory listing is trusted, in seconds
+DEFAULT_LISTING_TTL: float = 10.0
+
+UNIX_LIST_LINE = re.compile(
+    r'^([\-dlcbps])[\-rwxsStT]{9}\S*\s+\d+\s+\S+\s+\S+\s+(\d+)\s+(\w{3}\s+\d{1,2}\s+(?:\d{1,2}:\d{2}|\d{4}))\s(.*)$')
+DOS_LIST_LINE = re.compile(
+    r'^(\d{2}-\d{2}-\d{2,4}\s+\d{1,2}:\d{2}[AP]M)\s+(<DIR>|\d+)\s+(.*)$', re.IGNORECASE)
+
+
+class DirEntry:
+    def __init__(self, name: str, type: str = 'file', size: Optional[int] = None, mtime: Optional[float] = None,
+                 raw: Optional[str] = None):
+        self.name: str = name
+        # 'file', 'dir' or 'link'
+        self.type: str = type
+        self.is_dir: bool = type == 'dir'
+        self.size: Optional[int] = size
+        self.mtime: Optional[float] = mtime
+        self.raw: str = raw if raw is not None else name
+
+    def __str__(self):
+        return self.raw
+
+    def __repr__(self):
+        return 'DirEntry({!r}, {!r}, {!r}, {!r})'.format(self.name, self.type, self.size, self.mtime)
+
+
+def parse_mdtm(value: str) -> Optional[float]:
+    # YYYYMMDDHHMMSS[.sss], always UTC
+    try:
+        return float(calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S')))
+    except ValueError:
+        return None
+
+
+def parse_unix_date(text: str) -> Optional[float]:
+    text = ' '.join(text.split())
+    try:
+        if ':' in text:
+            # recent files show the time instead of the year
+            parsed = time.strptime(text + ' ' + str(time.gmtime().tm_year), '%b %d %H:%M %Y')
+        else:
+            parsed = time.strptime(text, '%b %d %Y')
+    except ValueError:
+        return None
+    return float(calendar.timegm(parsed))
+
+
+def parse_list_line(line: str) -> Optional[DirEntry]:
+    m = UNIX_LIST_LINE.match(line)
+    if m is not None:
+        kind, size, date, name = m.groups()
+        entry_type = {'d': 'dir', 'l': 'link'}.get(kind, 'file')
+        if entry_type == 'link' and ' -> ' in name:
+            name = name[:name.index(' -> ')]
+        if name in ('.', '..'):
+            return None
+        return DirEntry(name, entry_type, int(size), parse_unix_date(date), line)
+    m = DOS_LIST_LINE.match(line)
+    if m is not None:
+        date, size, name = m.groups()
+        try:
+            mtime = float(calendar.timegm(time.strptime(date, '%m-%d-%y %I:%M%p')))
+        except ValueError:
+            mtime = None
+        if size.upper() == '<DIR>':
+            return DirEntry(name, 'dir', None, mtime, line)
+        return DirEntry(name, 'file', int(size), mtime, line)
+    if line.strip() == '' or line.startswith('total '):
+        return None
+    # unknown format, the best guess is that the name is the last word
+    return DirEntry(line.split()[-1], 'file', None, None, line)
+
+
+def parse_mlsd_line(line: str) -> Optional[DirEntry]:
+    facts_text, _, name = line.partition(' ')
+    facts: Dict[str, str] = {}
+    for fact in facts_text[:-1].split(';'):
+        key, _, value = fact.partition('=')
+        facts[key.lower()] = value
+    kind = facts.get('type', 'file').lower()
+    if kind in ('cdir', 'pdir'):
+        return None
+    size = int(facts['size']) if 'size' in facts else None
+    mtime = parse_mdtm(facts['modify']) if 'modify' in facts else None
+    return DirEntry(name, 'dir' if kind == 'dir' else 'file', size, mtime, line)
+
+
+LISTING_PARSERS: Dict[str, Callable[[str], Optional[DirEntry]]] = {'MLSD': parse_mlsd_line, 'LIST': parse_list_line}
+
+
+def next_listing_command(ftp: Union[UltimateFTP, 'AsyncFTP'], refused: Optional[str] = None) -> Optional[str]:
+    # The listing command to try: MLSD is preferred, because it has exact sizes and dates; servers without it
+    # get LIST. After the server refused a command, the one to try next, or None if there is none left.
+    if refused == 'MLSD':
+        ftp.mlsd_supported = False
+        return 'LIST'
+    if refused is not None:
+        return None
+    return 'MLSD' if ftp.mlsd_supported else 'LIST'
+
+
+def find_entry(entries: List[DirEntry], remote_path: str) -> Optional[DirEntry]:
+    # the entry of the path in the listing of its parent directory
+    name = normalize_dir(remote_path).rsplit('/', 1)[1]
+    for entry in entries:
+        if entry.name == name:
+            return entry
+    return None
+
+
+def browser_order(entries: List[DirEntry]) -> List[DirEntry]:
+    # the file browser of the Ultimate lists directories first, then files, each alphabetically ignoring case
+    return sorted(entries, key=lambda e: (not e.is_dir, e.name.lower(), e.name))
+
+
+def stream_listing(ftp: UltimateFTP, remote_dir: str) -> Iterator[DirEntry]:
+    # Reads the listing line by line from the data connection, so that callers can stop early
+    # and never hold a huge directory in memory.
+    # No other command may be sent over the same connection until the iteration is finished.
+    ftp.cwd(remote_dir)
+    ftp.sendcmd('TYPE A')
+    command = next_listing_command(ftp)
+    while True:
+        try:
+            conn = ftp.transfercmd(command)
+            break
+        except (error_perm, error_reply):
+            command = next_listing_command(ftp, command)
+            if command is None:
+                raise
+    parse = LISTING_PARSERS[command]
+    complete = False
+    try:
+        with conn.makefile('r', encoding=ftp.encoding) as lines:
+            for line in lines:
+                entry = parse(line.rstrip('\r\n'))
+                if entry is not None:
+                    yield entry
+        complete = True
+    finally:
+        conn.close()
+        if complete:
+            ftp.voidresp()
+        else:
+            # the transfer was abandoned; the server still sends a reply, which must not be left for the next command
+            try:
+                ftp.voidresp()
+            except FTP_ERRORS:
+                pass
+
+
+class DirectoryCache:
+    def __init__(self, ttl: float = DEFAULT_LISTING_TTL):
+        self.ttl: float = ttl
+        self.lock: threading.Lock = threading.Lock()
+        # normalized directory path -> (time of listing, entries)
+        self.listings: Dict[str, Tuple[float, List[DirEntry]]] = {}
+
+    def get(self, remote_dir: str) -> Optional[List[DirEntry]]:
+        with self.lock:
+            cached = self.listings.get(normalize_dir(remote_dir))
+        if cached is None or monotonic() - cached[0] > self.ttl:
+            return None
+        return cached[1]
+
+    def put(self, remote_dir: str, entries: List[DirEntry]):
+        with self.lock:
+            self.listings[normalize_dir(remote_dir)] = (monotonic(), entries)
+
+    def invalidate(self, remote_dir: str):
+        with self.lock:
+            self.listings.pop(normalize_dir(remote_dir), None)
+
+    def invalidate_parent(self, remote_path: str):
+        self.invalidate(parent_dir(remote_path))
+
+    def invalidate_tree(self, remote_dir: str):
+        prefix = normalize_dir(remote_dir).rstrip('/') + '/'
+        with self.lock:
+            for key in list(self.listings.keys()):
+                if key == prefix.rstrip('/') or key.startswith(prefix):
+                    del self.listings[key]
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+
+
+def normalize_dir(remote_dir: str) -> str:
+    return '/' + '/'.join(part for part in remote_dir.split('/') if part != '')
+
+
+def parent_dir(remote_path: str) -> str:
+    return normalize_dir(normalize_dir(remote_path).rsplit('/', 1)[0])
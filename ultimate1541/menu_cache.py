@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+from time import time
+from typing import Optional, List, Dict
+
+from ultimate1541.menu import Menu
+
+
+def default_cache_dir() -> str:
+    if 'U1541_CACHE_DIR' in os.environ:
+        return os.environ['U1541_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'u1541')
+
+
+# Remembers the labels and values of the settings menus seen on each device, so that later
+# navigation can go straight to an item without looking at the screen at every level.
+# Entries are keyed by device address and firmware version, and stored as JSON.
+# When the firmware version is not known (None), the menus are remembered for this process only,
+# as there is no telling whether the device is still running the same firmware later.
+# One cache can be shared by clients of different devices running in separate threads.
+class MenuCache:
+    def __init__(self, path: Optional[str] = None):
+        self.path: Optional[str] = path
+        self.lock: threading.RLock = threading.RLock()
+        # device -> {'firmware': ..., 'menus': {'A/B': [[label, value], ...]}, 'updated': {'A/B': timestamp}}
+        self.devices: Dict[str, dict] = {}
+        # the same for devices with an unknown firmware version; never saved
+        self.unknown_firmware: Dict[str, dict] = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.devices = json.load(f)
+            except (OSError, ValueError):
+                self.devices = {}
+
+    @staticmethod
+    def default() -> 'MenuCache':
+        return MenuCache(os.path.join(default_cache_dir(), 'menus.json'))
+
+    def __entry(self, device: str, firmware: Optional[str]) -> dict:
+        devices = self.devices if firmware is not None else self.unknown_firmware
+        entry = devices.get(device)
+        if entry is None or entry['firmware'] != firmware:
+            entry = {'firmware': firmware, 'menus': {}, 'updated': {}}
+            devices[device] = entry
+        entry.setdefault('updated', {})
+        return entry
+
+    def __menus(self, device: str, firmware: Optional[str]) -> Dict[str, List[List[str]]]:
+        return self.__entry(device, firmware)['menus']
+
+    def menu(self, device: str, firmware: Optional[str], menu_path: List[str]) -> Optional[List[List[str]]]:
+        return self.__menus(device, firmware).get('/'.join(menu_path))
+
+    def updated_at(self, device: str, firmware: Optional[str], menu_path: List[str]) -> Optional[float]:
+        return self.__entry(device, firmware)['updated'].get('/'.join(menu_path))
+
+    def lookup(self, device: str, firmware: Optional[str], menu_path: List[str], label: str) -> Optional[int]:
+        items = self.__menus(device, firmware).get('/'.join(menu_path))
+        if items is None:
+            return None
+        for ix, (item_label, _) in enumerate(items):
+            if item_label == label:
+                return ix
+        return None
+
+    def value(self, device: str, firmware: Optional[str], menu_path: List[str], label: str) -> Optional[str]:
+        items = self.__menus(device, firmware).get('/'.join(menu_path))
+        if items is None:
+            return None
+        for item_label, item_value in items:
+            if item_label == label:
+                return item_value
+        return None
+
+    def remember(self, device: str, firmware: Optional[str], menu_path: List[str], menu: Menu):
+        items = [[item.label, item.annotation] for item in menu.items]
+        key = '/'.join(menu_path)
+        with self.lock:
+            entry = self.__entry(device, firmware)
+            entry['updated'][key] = time()
+            if entry['menus'].get(key) != items:
+                entry['menus'][key] = items
+                self.save()
+
+    def set_value(self, device: str, firmware: Optional[str], menu_path: List[str], label: str, value: str):
+        with self.lock:
+            items = self.__menus(device, firmware).get('/'.join(menu_path))
+            if items is None:
+                return
+            for item in items:
+                if item[0] == label and item[1] != value:
+                    item[1] = value
+                    self.save()
+
+    def invalidate(self, device: str):
+        with self.lock:
+            self.unknown_firmware.pop(device, None)
+            if self.devices.pop(device, None) is not None:
+                self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.devices, f, indent=1, ensure_ascii=False)
+            os.replace(tmp, self.path)
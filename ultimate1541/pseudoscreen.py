@@ -1,4 +1,5 @@
-from typing import Optional, Union, Tuple, List
+from array import array
+from typing import Optional, Union, Tuple, List, Dict
 
 from ultimate1541.escape_sequence import EscapeSequence
 
@@ -21,17 +22,103 @@ COLOUR_NAMES = [
     'Wht',
 ]
 
+SCREEN_WIDTH = 80
+SCREEN_HEIGHT = 25
+SPACE = ord(' ')
+TOP_LEFT = ord('┌')
+TOP_RIGHT = ord('┐')
+BOTTOM_LEFT = ord('└')
+BOTTOM_RIGHT = ord('┘')
+HORIZONTAL = ord('─')
+VERTICAL = ord('│')
+# Ultimate 1541 draws submenus with a dingle-dangle on the left side
+LEFT_BORDER = {VERTICAL, TOP_RIGHT, HORIZONTAL}
+MAX_CACHED_RECTANGLES = 32
+
 
 class PseudoScreen:
     def __init__(self):
-        self.text: List[str] = []
-        self.colours: List[List[int]] = []
+        # bumped on every change of screen contents; never goes back, even when the screen is reset
+        self.version: int = 0
+        self.row_versions: List[int] = [0] * SCREEN_HEIGHT
+        # positions of top-left and bottom-right corners in each row, as of corner_index_versions
+        self.corner_index: List[Tuple[List[int], List[int]]] = [([], [])] * SCREEN_HEIGHT
+        self.corner_index_versions: List[int] = [-1] * SCREEN_HEIGHT
+        self.rectangle: Optional[Tuple[int, int, int, int]] = None
+        self.rectangle_version: int = -1
+        self.parsed_rectangles: Dict[Tuple[int, int, Optional[int], int], Tuple[int, List[List[Tuple[int, str]]]]] = {}
+        self.clear()
+
+    def clear(self):
+        # characters are stored as code points, because box drawing characters do not fit in a byte
+        self.chars: array = array('I', [SPACE]) * (SCREEN_WIDTH * SCREEN_HEIGHT)
+        self.colours: bytearray = bytearray(SCREEN_WIDTH * SCREEN_HEIGHT)
+        # number of cells written so far in each row; cells past that are considered nonexistent
+        self.row_lengths: List[int] = [0] * SCREEN_HEIGHT
+        self.rows_used: int = 0
         self.cursor_x = 0
         self.cursor_y = 0
         self.text_colour = 7
+        self.version += 1
+        self.row_versions = [self.version] * SCREEN_HEIGHT
+
+    def __touch_row(self, y: int):
+        self.version += 1
+        self.row_versions[y] = self.version
+
+    def rows_changed_since(self, version: int, y1: int, y2: int) -> bool:
+        if version != self.version:
+            for y in range(max(0, y1), min(SCREEN_HEIGHT, y2)):
+                if self.row_versions[y] > version:
+                    return True
+        return False
 
     def line_count(self):
-        return len(self.text)
+        return self.rows_used
+
+    def line(self, y: int) -> str:
+        start = y * SCREEN_WIDTH
+        return ''.join(map(chr, self.chars[start:start + self.row_lengths[y]]))
+
+    def __last_colour_before(self, y: int) -> int:
+        while y > 0:
+            y -= 1
+            length = self.row_lengths[y]
+            if length > 0:
+                return self.colours[y * SCREEN_WIDTH + length - 1]
+        return 7
+
+    def write_run(self, text: str):
+        x = self.cursor_x
+        y = self.cursor_y
+        self.cursor_x += len(text)
+        if not (0 <= y < SCREEN_HEIGHT):
+            return
+        x_start = max(0, x)
+        x_end = min(SCREEN_WIDTH, x + len(text))
+        if x_start >= x_end:
+            return
+        row = y * SCREEN_WIDTH
+        length = self.row_lengths[y]
+        if length < x_start:
+            # cells skipped over by cursor movement inherit the colour of the cell before them
+            fill = self.colours[row + length - 1] if length > 0 else self.__last_colour_before(y)
+            self.colours[row + length:row + x_start] = bytes([fill]) * (x_start - length)
+        changed = length < x_start
+        if length < x_end:
+            changed = True
+            self.row_lengths[y] = x_end
+            if self.rows_used <= y:
+                self.rows_used = y + 1
+        if x_start != x or x_end != x + len(text):
+            text = text[x_start - x:x_end - x]
+        codes = array('I', map(ord, text))
+        colours = bytes([self.text_colour]) * (x_end - x_start)
+        # the Ultimate often redraws identical content, which should not invalidate anything
+        if changed or self.chars[row + x_start:row + x_end] != codes or self.colours[row + x_start:row + x_end] != colours:
+            self.chars[row + x_start:row + x_end] = codes
+            self.colours[row + x_start:row + x_end] = colours
+            self.__touch_row(y)
 
     def write(self, t: Union[None, str, EscapeSequence]):
         # print(t)
@@ -42,36 +129,10 @@ class PseudoScreen:
         elif t == '\n':
             self.cursor_y += 1
         elif type(t) is str:
-            if len(t) != 1:
-                raise ValueError('Cannot print ' + t)
-            while len(self.text) <= self.cursor_y:
-                self.text.append('')
-            while len(self.colours) <= self.cursor_y:
-                self.colours.append([])
-            cols: [int] = self.colours[self.cursor_y]
-            chrs: str = self.text[self.cursor_y]
-
-            def find_last_colour_before(y):
-                if y <= 0: return 7
-                cs = self.colours[y - 1]
-                if len(cs) > 0: return cs[-1]
-                return find_last_colour_before(y - 1)
-
-            while len(cols) <= self.cursor_x:
-                if len(cols) == 0:
-                    cols.append(find_last_colour_before(self.cursor_y))
-                else:
-                    cols.append(cols[-1])
-            while len(chrs) <= self.cursor_x:
-                chrs += ' '
-            cols[self.cursor_x] = self.text_colour
-            chrs = chrs[:self.cursor_x] + t + chrs[self.cursor_x + 1:]
-            self.text[self.cursor_y] = chrs
-            self.colours[self.cursor_y] = cols
-            self.cursor_x += 1
+            self.write_run(t)
         elif type(t) is EscapeSequence:
             if t.command == 'c':
-                self.__init__()
+                self.clear()
             elif t.command == '[m':
                 for param in t.params:
                     if param == 0:
@@ -114,86 +175,128 @@ class PseudoScreen:
     def find_all_occurences(self, character: str) -> List[Tuple[int, int]]:
         if len(character) != 1:
             raise ValueError("Can only search for one parameter")
+        code = ord(character)
+        chars = self.chars
         result = []
-        for y, line in enumerate(self.text):
-            for x, char in enumerate(line):
-                if char == character:
-                    result.append((x, y))
+        for y in range(self.rows_used):
+            row = y * SCREEN_WIDTH
+            end = row + self.row_lengths[y]
+            try:
+                i = chars.index(code, row, end)
+                while True:
+                    result.append((i - row, y))
+                    i = chars.index(code, i + 1, end)
+            except ValueError:
+                pass
         return result
 
     def parse_rectangle(self, x1: int, y1: int, x2: Optional[int] = None, y2: Optional[int] = None) -> List[
         List[Tuple[int, str]]]:
         if y2 is None:
-            y2 = len(self.text)
+            y2 = self.rows_used
+        key = (x1, y1, x2, y2)
+        cached = self.parsed_rectangles.get(key)
+        if cached is not None and not self.rows_changed_since(cached[0], y1, y2):
+            return cached[1]
+        result = self.__parse_rectangle(x1, y1, x2, y2)
+        if len(self.parsed_rectangles) >= MAX_CACHED_RECTANGLES:
+            self.parsed_rectangles.clear()
+        self.parsed_rectangles[key] = (self.version, result)
+        return result
+
+    def __parse_rectangle(self, x1: int, y1: int, x2: Optional[int], y2: int) -> List[List[Tuple[int, str]]]:
         result = []
         for y in range(y1, y2):
-            tl: str = self.text[y]
-            cl: [int] = self.colours[y]
-            sub_result: [Tuple[int, str]] = []
-            act_x2 = len(tl) if x2 is None else min(x2, len(tl))
+            length = self.row_lengths[y] if y < SCREEN_HEIGHT else 0
+            act_x2 = length if x2 is None else min(x2, length)
             if x1 >= act_x2:
                 continue
-            curr_colour = cl[x1]
-            curr_word = ''
-            for x in range(x1, act_x2):
+            row = y * SCREEN_WIDTH
+            tl: str = ''.join(map(chr, self.chars[row + x1:row + act_x2]))
+            cl: bytearray = self.colours[row + x1:row + act_x2]
+            sub_result: [Tuple[int, str]] = []
+            curr_colour = cl[0]
+            start = 0
+            for x in range(act_x2 - x1):
                 if tl[x] != ' ' and cl[x] != curr_colour:
+                    curr_word = tl[start:x]
                     if curr_word != '' and not curr_word.isspace():
                         sub_result.append((curr_colour, curr_word.strip()))
                     curr_colour = cl[x]
-                    curr_word = ''
-                curr_word += tl[x]
+                    start = x
+            curr_word = tl[start:]
             if curr_word != '' and not curr_word.isspace():
                 sub_result.append((curr_colour, curr_word.strip()))
             result.append(sub_result)
         return result
 
     def char_at(self, x: int, y: int):
-        if y >= len(self.text):
+        if not (0 <= y < SCREEN_HEIGHT) or not (0 <= x < self.row_lengths[y]):
             return ' '
-        line = self.text[y]
-        if x >= len(line):
-            return ' '
-        return line[x]
+        return chr(self.chars[y * SCREEN_WIDTH + x])
+
+    def __update_corner_index(self):
+        chars = self.chars
+        for y in range(SCREEN_HEIGHT):
+            if self.corner_index_versions[y] == self.row_versions[y]:
+                continue
+            row = y * SCREEN_WIDTH
+            end = row + self.row_lengths[y]
+            corners = ([], [])
+            for code, positions in zip((TOP_LEFT, BOTTOM_RIGHT), corners):
+                try:
+                    i = chars.index(code, row, end)
+                    while True:
+                        positions.append(i - row)
+                        i = chars.index(code, i + 1, end)
+                except ValueError:
+                    pass
+            self.corner_index[y] = corners
+            self.corner_index_versions[y] = self.row_versions[y]
+
+    def __is_bordered_rectangle(self, x1: int, y1: int, x2: int, y2: int) -> bool:
+        chars = self.chars
+        top = y1 * SCREEN_WIDTH
+        bottom = y2 * SCREEN_WIDTH
+        if chars[bottom + x1] != BOTTOM_LEFT or chars[top + x2] != TOP_RIGHT:
+            return False
+        horizontal = array('I', [HORIZONTAL]) * (x2 - x1 - 1)
+        if chars[top + x1 + 1:top + x2] != horizontal or chars[bottom + x1 + 1:bottom + x2] != horizontal:
+            return False
+        for y in range(y1 + 1, y2):
+            row = y * SCREEN_WIDTH
+            if chars[row + x1] not in LEFT_BORDER or chars[row + x2] != VERTICAL:
+                return False
+        return True
 
     def find_bordered_rectangle(self) -> Optional[Tuple[int, int, int, int]]:
         # TODO: some rectangles have a horizontal line instead of corner at top left!
-        top_lefts = self.find_all_occurences('┌')
-        bottom_rights = self.find_all_occurences('┘')
-        # print(top_lefts)
-        # print(bottom_rights)
-        for br in bottom_rights:
-            x2 = br[0]
-            y2 = br[1]
-            for tl in top_lefts:
-                x1 = tl[0]
-                y1 = tl[1]
-                if self.char_at(x1, y2) != '└':
-                    continue
-                if self.char_at(x2, y1) != '┐':
-                    continue
-                borders_bad = False
-                for x in range(x1 + 1, x2):
-                    if self.char_at(x, y1) != '─':
-                        borders_bad = True
-                    if self.char_at(x, y2) != '─':
-                        borders_bad = True
-                if borders_bad:
-                    continue
-                for y in range(y1 + 1, y2):
-                    # Ultimate 1541 draws submenus with a dingle-dangle on the left side
-                    if self.char_at(x1, y) != '│' and self.char_at(x1, y) != '┐' and self.char_at(x1, y) != '─':
-                        borders_bad = True
-                    if self.char_at(x2, y) != '│':
-                        borders_bad = True
-                if borders_bad:
-                    continue
-                return x1 + 1, y1 + 1, x2, y2
-        return None
+        if self.rectangle_version == self.version:
+            return self.rectangle
+        self.__update_corner_index()
+        top_lefts = [(x, y) for y in range(SCREEN_HEIGHT) for x in self.corner_index[y][0]]
+        self.rectangle = None
+        for y2 in range(SCREEN_HEIGHT):
+            for x2 in self.corner_index[y2][1]:
+                for x1, y1 in top_lefts:
+                    if y1 >= y2:
+                        break
+                    if x1 < x2 and self.__is_bordered_rectangle(x1, y1, x2, y2):
+                        self.rectangle = (x1 + 1, y1 + 1, x2, y2)
+                        break
+                if self.rectangle is not None:
+                    break
+            if self.rectangle is not None:
+                break
+        self.rectangle_version = self.version
+        return self.rectangle
 
     def print_all(self):
-        for y, line in enumerate(self.text):
+        for y in range(self.rows_used):
+            line = self.line(y)
             colour_counter: [int] = [0] * 16
-            for cl in self.colours[y]:
+            row = y * SCREEN_WIDTH
+            for cl in self.colours[row:row + self.row_lengths[y]]:
                 colour_counter[cl] += 1
             best_colour = colour_counter.index(max(colour_counter))
             if line.isspace():
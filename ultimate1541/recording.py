@@ -0,0 +1,198 @@
+from time import monotonic, sleep
+from typing import Optional, List, BinaryIO, Tuple
+
+from ultimate1541.ansi_reader import AnsiReaderWriter
+
+# A telnet session, as the client saw it: the screen output it read and the keys it sent, with timestamps.
+# The file starts with MAGIC, then every record is a kind byte (INBOUND or OUTBOUND),
+# the microseconds since the previous record and the length of the data, both as LEB128 varints, and the data.
+
+MAGIC = b'U1541REC\x01'
+INBOUND = b'i'
+OUTBOUND = b'o'
+
+
+class ReplayError(ValueError):
+    pass
+
+
+class Record:
+    def __init__(self, kind: bytes, time: float, data: bytes):
+        self.kind: bytes = kind
+        # seconds since the beginning of the recording
+        self.time: float = time
+        self.data: bytes = data
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(data: bytes, position: int) -> Tuple[int, int]:
+    # returns the value and the position after it
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise ReplayError('Recording is truncated')
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class RecordWriter:
+    def __init__(self, out: BinaryIO):
+        self.out: BinaryIO = out
+        self.last: Optional[float] = None
+        out.write(MAGIC)
+        out.flush()
+
+    def close(self):
+        self.out.close()
+
+    def add(self, kind: bytes, data: bytes):
+        now = monotonic()
+        delta = 0 if self.last is None else int((now - self.last) * 1e6)
+        self.last = now
+        self.out.write(kind + encode_varint(delta) + encode_varint(len(data)) + data)
+        # a session that ends with an exception is the interesting one, so nothing may stay in a buffer
+        self.out.flush()
+
+
+def parse_records(data: bytes) -> List[Record]:
+    if not data.startswith(MAGIC):
+        raise ReplayError('Not a session recording')
+    records = []
+    position = len(MAGIC)
+    time = 0
+    while position < len(data):
+        kind = data[position:position + 1]
+        if kind not in (INBOUND, OUTBOUND):
+            raise ReplayError('Unknown record kind at offset {}'.format(position))
+        delta, position = decode_varint(data, position + 1)
+        length, position = decode_varint(data, position)
+        if position + length > len(data):
+            raise ReplayError('Recording is truncated')
+        time += delta
+        records.append(Record(kind, time / 1e6, data[position:position + length]))
+        position += length
+    return records
+
+
+def read_records(path: str) -> List[Record]:
+    with open(path, 'rb') as f:
+        return parse_records(f.read())
+
+
+class RecordingAnsiReaderWriter(AnsiReaderWriter):
+    # Passes everything through to another reader, e.g. a TelnetAnsiReaderWriter, and records it.
+
+    def __init__(self, inner: AnsiReaderWriter, writer: RecordWriter):
+        super().__init__()
+        self.inner: AnsiReaderWriter = inner
+        self.writer: RecordWriter = writer
+
+    def write(self, data: bytes):
+        self.writer.add(OUTBOUND, data)
+        self.inner.write(data)
+
+    def wait_for_input(self, timeout: float) -> bool:
+        return self.inner.wait_for_input(timeout)
+
+    def read_chunk(self) -> bytes:
+        chunk = self.inner.read_chunk()
+        if chunk:
+            self.writer.add(INBOUND, chunk)
+        return chunk
+
+
+class ReplayAnsiReaderWriter(AnsiReaderWriter):
+    # Plays a recording back to a ConsoleManipulator. The screen output recorded after some keys
+    # is only given once the same keys have been sent; in strict mode, different keys are a ReplayError.
+    # In real time, output arrives with the recorded delays after the keys that preceded it;
+    # otherwise it is available at once and waiting for more returns immediately.
+
+    def __init__(self, records: List[Record], *, realtime: bool = False, strict: bool = True):
+        super().__init__()
+        self.records: List[Record] = records
+        self.position: int = 0
+        self.realtime: bool = realtime
+        self.strict: bool = strict
+        # the rest of the keys of the last outbound record that the client has not sent yet
+        self.expected: bytearray = bytearray()
+        # (monotonic time, recording time) that correspond to each other, set at the start and by every write
+        self.anchor: Optional[Tuple[float, float]] = None
+        # inbound records skipped because the client sent keys before reading them, when not strict
+        self.skipped: int = 0
+
+    def next_record(self) -> Optional[Record]:
+        return self.records[self.position] if self.position < len(self.records) else None
+
+    def finished(self) -> bool:
+        return self.position >= len(self.records)
+
+    def __delay(self, record: Record) -> float:
+        if not self.realtime:
+            return 0.0
+        if self.anchor is None:
+            self.anchor = (monotonic(), self.records[0].time)
+        now, time = self.anchor
+        return now + (record.time - time) - monotonic()
+
+    def wait_for_input(self, timeout: float) -> bool:
+        record = self.next_record()
+        if record is None or record.kind != INBOUND:
+            # nothing more comes until the client sends keys
+            if self.realtime:
+                sleep(max(0.0, timeout))
+            return False
+        delay = self.__delay(record)
+        if delay > timeout:
+            sleep(max(0.0, timeout))
+            return False
+        if delay > 0:
+            sleep(delay)
+        return True
+
+    def read_chunk(self) -> bytes:
+        record = self.next_record()
+        if record is None or record.kind != INBOUND or self.__delay(record) > 0:
+            return b''
+        self.position += 1
+        return record.data
+
+    def write(self, data: bytes):
+        remaining = bytes(data)
+        while remaining:
+            if not self.expected:
+                record = self.next_record()
+                while record is not None and record.kind == INBOUND:
+                    if self.strict:
+                        raise ReplayError('Keys {!r} sent before the recorded screen output was read'.format(remaining))
+                    self.skipped += 1
+                    self.position += 1
+                    record = self.next_record()
+                if record is None:
+                    if self.strict:
+                        raise ReplayError('Keys {!r} sent after the end of the recording'.format(remaining))
+                    return
+                self.position += 1
+                self.expected = bytearray(record.data)
+                self.anchor = (monotonic(), record.time)
+            n = min(len(remaining), len(self.expected))
+            if self.strict and remaining[:n] != self.expected[:n]:
+                raise ReplayError('Expected keys {!r}, got {!r}'.format(bytes(self.expected[:n]), remaining[:n]))
+            del self.expected[:n]
+            remaining = remaining[n:]
+
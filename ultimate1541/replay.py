@@ -0,0 +1,39 @@
+import sys
+from time import monotonic
+from typing import List
+
+from ultimate1541.console_manipulator import ConsoleManipulator
+from ultimate1541.recording import ReplayAnsiReaderWriter, read_records, INBOUND, OUTBOUND
+
+# python -m ultimate1541.replay <recording> [--realtime] [--screens]
+
+
+def main(args: List[str]):
+    # replays the keys of a recording through ConsoleManipulator, to see what the client saw
+    if len(args) == 0:
+        print('Usage: python -m ultimate1541.replay <recording> [--realtime] [--screens]')
+        return
+    records = read_records(args[0])
+    reader = ReplayAnsiReaderWriter(records, realtime='--realtime' in args)
+    console = ConsoleManipulator(reader)
+    start = monotonic()
+    while not reader.finished():
+        record = reader.next_record()
+        if record.kind == OUTBOUND:
+            console.press(record.data)
+        console.refresh_screen()
+        if '--screens' in args:
+            print('--- {:.3f} s'.format(record.time))
+            console.screen.print_all()
+    seconds = monotonic() - start
+    received = sum(len(r.data) for r in records if r.kind == INBOUND)
+    sent = sum(len(r.data) for r in records if r.kind == OUTBOUND)
+    print('--- final screen')
+    console.screen.print_all()
+    print('{} records, {} bytes received, {} bytes of keys sent, {:.3f} s recorded, replayed in {:.3f} s ({:.0f} kB/s)'
+          .format(len(records), received, sent, records[-1].time if records else 0, seconds,
+                  received / seconds / 1000 if seconds > 0 else 0))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,237 @@
+from time import time
+from typing import Optional, List, Tuple, Union, Dict, Callable, TYPE_CHECKING
+
+from ultimate1541.console_manipulator import ConsoleManipulator, NavigationStep, NavigationError, Steps, \
+    MAX_MENU_LENGTH
+from ultimate1541.menu import Menu
+
+if TYPE_CHECKING:
+    from ultimate1541 import Ultimate1541
+    from ultimate1541.aio import AsyncUltimate1541
+
+REU_SIZES: Dict[Union[str, int, Tuple[int, str]], str] = {}
+
+for mb in [128, 256, 512]:
+    normalized = str(mb) + ' KB'
+    REU_SIZES[(mb, 'k')] = normalized
+    REU_SIZES[(mb, 'kB')] = normalized
+    REU_SIZES[(mb, 'KB')] = normalized
+    REU_SIZES[(mb, 'K')] = normalized
+    REU_SIZES[mb * 1024] = normalized
+    REU_SIZES[mb * 1000] = normalized
+    REU_SIZES[str(mb) + 'k'] = normalized
+    REU_SIZES[str(mb) + ' k'] = normalized
+    REU_SIZES[str(mb) + 'kB'] = normalized
+    REU_SIZES[str(mb) + ' kB'] = normalized
+    REU_SIZES[str(mb) + 'K'] = normalized
+    REU_SIZES[str(mb) + ' K'] = normalized
+    REU_SIZES[str(mb) + 'KB'] = normalized
+    REU_SIZES[str(mb) + ' KB'] = normalized
+
+for mb in [1, 2, 4, 8, 16]:
+    normalized = str(mb) + ' MB'
+    REU_SIZES[(mb, 'MB')] = normalized
+    REU_SIZES[(mb, 'M')] = normalized
+    REU_SIZES[mb * 1024 * 1024] = normalized
+    REU_SIZES[mb * 1000 * 1000] = normalized
+    REU_SIZES[mb * 1024 * 1000] = normalized
+    REU_SIZES[str(mb) + 'M'] = normalized
+    REU_SIZES[str(mb) + ' M'] = normalized
+    REU_SIZES[str(mb) + 'MB'] = normalized
+    REU_SIZES[str(mb) + ' MB'] = normalized
+
+REU_ENABLED_PATH = ['C64 and cartridge settings', 'RAM Expansion Unit']
+REU_SIZE_PATH = ['C64 and cartridge settings', 'REU Size']
+COMMAND_INTERFACE_PATH = ['C64 and cartridge settings', 'Command Interface']
+
+
+def normalize_enabled(value: Union[bool, str]) -> str:
+    if value is True or value is False:
+        return 'Enabled' if value else 'Disabled'
+    if value.lower() in ['1', 'on', 'yes', 'true', 'enabled']:
+        return 'Enabled'
+    if value.lower() in ['0', 'off', 'no', 'false', 'disabled']:
+        return 'Disabled'
+    raise ValueError("Invalid on/off value: " + value)
+
+
+def normalize_reu_size(size: Union[int, str, Tuple[int, str]]) -> str:
+    if size not in REU_SIZES:
+        raise ValueError("Invalid REU size: " + str(size))
+    return REU_SIZES[size]
+
+
+SETTING_ALIASES: Dict[str, Tuple[List[str], Callable[[str], str]]] = {
+    'reu': (REU_ENABLED_PATH, normalize_enabled),
+    'reu_size': (REU_SIZE_PATH, normalize_reu_size),
+    'command_interface': (COMMAND_INTERFACE_PATH, normalize_enabled),
+}
+
+
+class SettingsTransaction:
+    # the changes are made in apply_steps, which both Ultimate1541 and AsyncUltimate1541 drive
+    def __init__(self, u: Union['Ultimate1541', 'AsyncUltimate1541']):
+        self.u: Union['Ultimate1541', 'AsyncUltimate1541'] = u
+        # option path -> value, in the order the changes were requested
+        self.changes: Dict[Tuple[str, ...], str] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.apply()
+
+    def set(self, option_path: List[str], value: str) -> None:
+        if len(option_path) < 2:
+            raise ValueError('Setting path should include a category and a setting: ' + '/'.join(option_path))
+        self.changes.pop(tuple(option_path), None)
+        self.changes[tuple(option_path)] = value
+
+    def set_by_name(self, name: str, value: str) -> None:
+        if name in SETTING_ALIASES:
+            option_path, normalize = SETTING_ALIASES[name]
+            self.set(option_path, normalize(value))
+        else:
+            self.set(name.split('/'), value)
+
+    def set_enabled(self, option_path: List[str], enabled: bool) -> None:
+        self.set(option_path, normalize_enabled(enabled))
+
+    def set_reu_enabled(self, enabled: bool) -> None:
+        self.set_enabled(REU_ENABLED_PATH, enabled)
+
+    def set_reu_size(self, size: Union[int, str, Tuple[int, str]]) -> None:
+        self.set(REU_SIZE_PATH, normalize_reu_size(size))
+
+    def set_command_interface_enabled(self, enabled: bool) -> None:
+        self.set_enabled(COMMAND_INTERFACE_PATH, enabled)
+
+    def apply(self) -> None:
+        if len(self.changes) == 0:
+            return
+        u = self.u
+        u.open_telnet()
+        c = u.console_manipulator
+        try:
+            c.run(self.apply_steps(c, use_cache=True))
+        except NavigationError:
+            # the cached menu layout is stale, start over the slow way
+            u.menu_cache.invalidate(u.ip_addr)
+            c.close()
+            c.run(self.apply_steps(c, use_cache=False))
+        self.changes.clear()
+
+    def __index(self, menu_path: List[str], label: str, use_cache: bool) -> Optional[int]:
+        if not use_cache:
+            return None
+        return self.u.menu_cache.lookup(self.u.ip_addr, self.u.firmware, menu_path, label)
+
+    def ordered_changes(self, use_cache: bool = True) -> List[Tuple[Tuple[str, ...], List[Tuple[str, str]]]]:
+        groups: Dict[Tuple[str, ...], List[Tuple[str, str]]] = {}
+        for option_path, value in self.changes.items():
+            groups.setdefault(option_path[:-1], []).append((option_path[-1], value))
+
+        def position(menu_path: List[str], label: str) -> int:
+            index = self.__index(menu_path, label, use_cache)
+            # sorting is stable, so items not in the cache keep their requested order
+            return MAX_MENU_LENGTH if index is None else index
+
+        result = []
+        for category in sorted(groups.keys(), key=lambda c: [position(list(c[:i]), c[i]) for i in range(len(c))]):
+            items = sorted(groups[category], key=lambda item: position(list(category), item[0]))
+            result.append((category, items))
+        return result
+
+    def apply_steps(self, c: ConsoleManipulator, *, use_cache: bool) -> Steps:
+        u = self.u
+        cache = u.menu_cache
+        yield from c.go_home_steps()
+        yield from c.enter_settings_steps()
+        current: Optional[Tuple[str, ...]] = None
+        for category, items in self.ordered_changes(use_cache):
+            if current is not None:
+                for _ in current:
+                    yield from c.go_back_steps()
+            position: Optional[int] = None
+            for i, (setting, value) in enumerate(items):
+                base = [] if i == 0 else list(category)
+                labels = (list(category) if i == 0 else []) + [setting, value]
+
+                def observe(level: int, menu: Menu, base=base, labels=labels):
+                    cache.remember(u.ip_addr, u.firmware, base + labels[:level], menu)
+
+                steps = [NavigationStep(label, self.__index(base + labels[:level], label, use_cache))
+                         for level, label in enumerate(labels)]
+                yield from c.navigate_steps(steps, observe=observe, position=position)
+                cache.set_value(u.ip_addr, u.firmware, list(category), setting, value)
+                # after the value is chosen, the cursor stays on the setting
+                position = self.__index(list(category), setting, use_cache)
+            current = category
+        yield from c.leave_settings_steps()
+
+
+def crawl_settings(u: 'Ultimate1541', *, max_age: Optional[float] = None) -> Dict[str, Dict[str, str]]:
+    u.open_telnet()
+    u.console_manipulator.run(crawl_settings_steps(u, u.console_manipulator, max_age=max_age))
+    return snapshot(u)
+
+
+def crawl_settings_steps(u: Union['Ultimate1541', 'AsyncUltimate1541'], c: ConsoleManipulator, *,
+                         max_age: Optional[float] = None) -> Steps:
+    # Categories already in the menu cache (and not older than max_age seconds) are not visited again,
+    # and every visited category is saved immediately, so an interrupted crawl picks up where it stopped.
+    cache = u.menu_cache
+    now = time()
+
+    def is_fresh(menu_path: List[str]) -> bool:
+        updated = cache.updated_at(u.ip_addr, u.firmware, menu_path)
+        return updated is not None and (max_age is None or now - updated <= max_age)
+
+    yield from c.go_home_steps()
+    yield from c.enter_settings_steps()
+    root = c.current_menu()
+    cache.remember(u.ip_addr, u.firmware, [], root)
+    position = root.selected[0] if len(root.selected) == 1 else None
+    for index, item in enumerate(root.items):
+        if is_fresh([item.label]):
+            continue
+        yield from c.navigate_steps([NavigationStep(item.label, index)], position=position)
+        cache.remember(u.ip_addr, u.firmware, [item.label], c.current_menu())
+        yield from c.go_back_steps()
+        # leaving a submenu puts the cursor back on its entry
+        position = index
+    yield from c.leave_settings_steps()
+    cache.save()
+
+
+def snapshot(u: Union['Ultimate1541', 'AsyncUltimate1541']) -> Dict[str, Dict[str, str]]:
+    cache = u.menu_cache
+    root = cache.menu(u.ip_addr, u.firmware, [])
+    result: Dict[str, Dict[str, str]] = {}
+    if root is None:
+        return result
+    for category, _ in root:
+        items = cache.menu(u.ip_addr, u.firmware, [category])
+        if items is not None:
+            result[category] = {label: value for label, value in items}
+    return result
+
+
+def profile_changes(u: Union['Ultimate1541', 'AsyncUltimate1541'], profile: Dict[str, Dict[str, str]]) -> List[Tuple[str, str, str]]:
+    # Settings that were never seen are assumed to differ.
+    current = snapshot(u)
+    changes = []
+    for category, values in profile.items():
+        for setting, value in values.items():
+            if current.get(category, {}).get(setting) != value:
+                changes.append((category, setting, value))
+    return changes
+
+
+def apply_profile(u: 'Ultimate1541', profile: Dict[str, Dict[str, str]]) -> List[Tuple[str, str, str]]:
+    changes = profile_changes(u, profile)
+    with u.settings() as s:
+        for category, setting, value in changes:
+            s.set([category, setting], value)
+    return changes
@@ -0,0 +1,41 @@
+from time import monotonic
+
+# hard upper bound for a single refresh, no matter how busy the Ultimate is
+MAX_SETTLE_TIME: float = 1.0
+# how long to wait for the first byte of a redraw before assuming nothing is coming
+MIN_RESPONSE_WINDOW: float = 0.05
+MAX_RESPONSE_WINDOW: float = 0.2
+# how long the line has to stay quiet after some data arrived
+MIN_QUIET_WINDOW: float = 0.02
+MAX_QUIET_WINDOW: float = 0.1
+# how much slack is given on top of the observed latencies
+SAFETY_FACTOR: float = 3.0
+# weight of a new observation in the moving averages
+SMOOTHING: float = 0.25
+
+
+class SettleDetector:
+    def __init__(self):
+        # pessimistic starting values, equivalent to the old fixed 200 ms sleep
+        self.response_latency: float = MAX_RESPONSE_WINDOW / SAFETY_FACTOR
+        self.chunk_gap: float = MAX_QUIET_WINDOW / SAFETY_FACTOR
+
+    def response_window(self) -> float:
+        return min(MAX_RESPONSE_WINDOW, max(MIN_RESPONSE_WINDOW, self.response_latency * SAFETY_FACTOR))
+
+    def quiet_window(self) -> float:
+        return min(MAX_QUIET_WINDOW, max(MIN_QUIET_WINDOW, self.chunk_gap * SAFETY_FACTOR))
+
+    def observe_response(self, latency: float):
+        self.response_latency += (latency - self.response_latency) * SMOOTHING
+
+    def observe_gap(self, gap: float):
+        self.chunk_gap += (gap - self.chunk_gap) * SMOOTHING
+
+
+def deadline_after(timeout: float) -> float:
+    return monotonic() + timeout
+
+
+def time_left(deadline: float) -> float:
+    return max(0.0, deadline - monotonic())
@@ -0,0 +1,98 @@
+import threading
+from typing import Optional, List, Tuple, Dict, Callable
+
+from ultimate1541 import Ultimate1541
+from ultimate1541.listing import DirEntry
+from ultimate1541.menu_cache import MenuCache
+from ultimate1541.sync import SyncManifest
+from ultimate1541.simulator.command_server import CommandServer
+from ultimate1541.simulator.ftp_server import FtpServer
+from ultimate1541.simulator.menu import DEFAULT_FIRMWARE, default_settings, sort_entries
+from ultimate1541.simulator.telnet_server import TelnetServer
+from ultimate1541.simulator.throttle import Stats
+
+
+class Simulator:
+    # A stand-in for a 1541 Ultimate II+ on the local machine: the telnet menu and the FTP server over a directory,
+    # whose subdirectories are the devices (e.g. root/Usb0), and the remote control socket.
+    # latency is added before every screen redraw and FTP reply, key_delay for every key,
+    # and bandwidth (bytes per second) limits the screen output and FTP transfers; all are for benchmarking.
+
+    def __init__(self, root: str, *, host: str = '127.0.0.1', telnet_port: int = 0, ftp_port: int = 0,
+                 command_port: int = 0,
+                 latency: float = 0.0, key_delay: float = 0.0, bandwidth: Optional[float] = None,
+                 mlsd: bool = True, firmware: str = DEFAULT_FIRMWARE,
+                 settings: Optional[Dict[str, List[List]]] = None):
+        self.root: str = root
+        self.host: str = host
+        self.latency: float = latency
+        self.key_delay: float = key_delay
+        self.bandwidth: Optional[float] = bandwidth
+        self.mlsd: bool = mlsd
+        # downloads break off after this many bytes, like over a dropped connection; None lets them finish
+        self.drop_downloads_after: Optional[int] = None
+        # the order of the entries in the file browser, for sessions opened after it is set
+        self.browser_sort: Callable[[List[DirEntry]], List[DirEntry]] = sort_entries
+        self.firmware: str = firmware
+        self.settings: Dict[str, List[List]] = settings if settings is not None else default_settings()
+        # (command, path) of every context menu command, e.g. ('Run', '/Usb0/game.prg')
+        self.events: List[Tuple[str, str]] = []
+        # (command, payload) of every remote control socket command, e.g. ('Run', program)
+        self.dma_events: List[Tuple[str, bytes]] = []
+        # of the C64, where the remote control socket loads programs
+        self.memory: bytearray = bytearray(0x10000)
+        self.lock: threading.Lock = threading.Lock()
+        self.stats: Stats = Stats()
+        self.telnet_server: TelnetServer = TelnetServer((host, telnet_port), self)
+        self.ftp_server: FtpServer = FtpServer((host, ftp_port), self)
+        self.command_server: CommandServer = CommandServer((host, command_port), self)
+        self.threads: List[threading.Thread] = []
+
+    @property
+    def telnet_port(self) -> int:
+        return self.telnet_server.server_address[1]
+
+    @property
+    def ftp_port(self) -> int:
+        return self.ftp_server.server_address[1]
+
+    @property
+    def command_port(self) -> int:
+        return self.command_server.server_address[1]
+
+    def servers(self):
+        return self.telnet_server, self.ftp_server, self.command_server
+
+    def start(self) -> 'Simulator':
+        for server in self.servers():
+            thread = threading.Thread(target=server.serve_forever, name='u1541-simulator', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def close(self):
+        for server in self.servers():
+            if self.threads:
+                server.shutdown()
+            server.server_close()
+        self.threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def setting(self, category: str, label: str) -> Optional[str]:
+        with self.lock:
+            for item_label, value, _ in self.settings.get(category, []):
+                if item_label == label:
+                    return value
+        return None
+
+    def client(self, **kwargs) -> Ultimate1541:
+        # a client for this simulator, with a menu cache and sync manifest of its own unless they are given
+        kwargs.setdefault('menu_cache', MenuCache())
+        kwargs.setdefault('sync_manifest', SyncManifest())
+        return Ultimate1541(self.host, telnet_port=self.telnet_port, ftp_port=self.ftp_port,
+                            command_port=self.command_port, **kwargs)
@@ -0,0 +1,42 @@
+import sys
+import time
+
+from ultimate1541.simulator import Simulator
+
+USAGE = ("Usage: python -m ultimate1541.simulator <root directory> [--telnet-port <port>] [--ftp-port <port>] "
+         "[--command-port <port>] [--latency <seconds>] [--key-delay <seconds>] [--bandwidth <bytes per second>] [--no-mlsd]")
+
+
+def main(args):
+    if len(args) == 0 or args[0].startswith('-'):
+        print(USAGE)
+        return
+    options = {'--telnet-port': 2323, '--ftp-port': 2121, '--command-port': 6464, '--latency': 0.0, '--key-delay': 0.0, '--bandwidth': None}
+    mlsd = True
+    root = args[0]
+    args = args[1:]
+    while args:
+        if args[0] == '--no-mlsd':
+            mlsd = False
+            args = args[1:]
+        elif args[0] in options and len(args) >= 2:
+            options[args[0]] = float(args[1])
+            args = args[2:]
+        else:
+            raise ValueError('Unknown option: ' + args[0])
+    with Simulator(root, telnet_port=int(options['--telnet-port']), ftp_port=int(options['--ftp-port']),
+                   command_port=int(options['--command-port']),
+                   latency=options['--latency'], key_delay=options['--key-delay'], bandwidth=options['--bandwidth'],
+                   mlsd=mlsd) as simulator:
+        print('Telnet on {}:{}, FTP on {}:{}, remote control on {}:{}, press Ctrl+C to stop'.format(
+            simulator.host, simulator.telnet_port, simulator.host, simulator.ftp_port,
+            simulator.host, simulator.command_port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,44 @@
+import socketserver
+from typing import TYPE_CHECKING
+
+from ultimate1541.command_socket import HEADER, SOCKET_CMD_DMA, SOCKET_CMD_DMARUN, SOCKET_CMD_RESET
+
+if TYPE_CHECKING:
+    from ultimate1541.simulator import Simulator
+
+COMMAND_NAMES = {SOCKET_CMD_DMA: 'Load', SOCKET_CMD_DMARUN: 'Run', SOCKET_CMD_RESET: 'Reset'}
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    # The remote control socket: programs are copied into the simulated C64 memory;
+    # like on the device, nothing is replied and unknown commands are skipped.
+    server: 'CommandServer'
+
+    def handle(self):
+        simulator = self.server.simulator
+        while True:
+            header = self.rfile.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            command, length = HEADER.unpack(header)
+            payload = self.rfile.read(length)
+            if len(payload) < length:
+                return
+            name = COMMAND_NAMES.get(command)
+            if name is None:
+                continue
+            with simulator.lock:
+                if command in (SOCKET_CMD_DMA, SOCKET_CMD_DMARUN) and len(payload) >= 2:
+                    address = payload[0] | (payload[1] << 8)
+                    program = payload[2:2 + 0x10000 - address]
+                    simulator.memory[address:address + len(program)] = program
+                simulator.dma_events.append((name, payload))
+
+
+class CommandServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, simulator: 'Simulator'):
+        self.simulator: 'Simulator' = simulator
+        super().__init__(address, CommandHandler)
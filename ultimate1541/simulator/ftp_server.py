@@ -0,0 +1,259 @@
+import os
+import posixpath
+import shutil
+import socket
+import socketserver
+import time
+from time import monotonic
+from typing import Optional, TYPE_CHECKING
+
+from ultimate1541.simulator.throttle import send_throttled, recv_throttled
+
+if TYPE_CHECKING:
+    from ultimate1541.simulator import Simulator
+
+DATA_BLOCK_SIZE = 64 * 1024
+
+
+class FtpError(Exception):
+    def __init__(self, reply: str):
+        super().__init__(reply)
+        self.reply: str = reply
+
+
+class FtpHandler(socketserver.StreamRequestHandler):
+    # Enough of an FTP server for the client: passive mode, binary transfers with REST,
+    # LIST in the Unix format and optionally MLSD.
+    server: 'FtpServer'
+
+    def setup(self):
+        super().setup()
+        self.simulator: 'Simulator' = self.server.simulator
+        self.cwd: str = '/'
+        self.passive: Optional[socket.socket] = None
+        self.rest: int = 0
+
+    def reply(self, text: str):
+        self.wfile.write((text + '\r\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply('220 Ultimate simulator FTP server')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            command, _, argument = line.partition(' ')
+            command = command.upper()
+            self.simulator.stats.add(ftp_commands=1)
+            if self.simulator.latency > 0:
+                time.sleep(self.simulator.latency)
+            method = getattr(self, 'ftp_' + command.lower(), None)
+            if method is None:
+                self.reply('502 Command not implemented')
+                continue
+            try:
+                method(argument)
+            except FtpError as e:
+                self.reply(e.reply)
+            except OSError as e:
+                self.reply('550 ' + str(e))
+            if command == 'QUIT':
+                break
+        self.close_passive()
+
+    def local_path(self, path: str) -> str:
+        # an absolute remote path, always inside the root
+        remote = posixpath.normpath(posixpath.join(self.cwd, path))
+        parts = [p for p in remote.split('/') if p not in ('', '.', '..')]
+        return os.path.join(self.simulator.root, *parts)
+
+    def remote_path(self, path: str) -> str:
+        return '/' + '/'.join(p for p in posixpath.normpath(posixpath.join(self.cwd, path)).split('/') if p)
+
+    def close_passive(self):
+        if self.passive is not None:
+            self.passive.close()
+            self.passive = None
+
+    def open_data(self) -> socket.socket:
+        if self.passive is None:
+            raise FtpError('425 Use PASV first')
+        self.passive.settimeout(10)
+        try:
+            conn, _ = self.passive.accept()
+        finally:
+            self.close_passive()
+        return conn
+
+    def ftp_user(self, argument: str):
+        self.reply('331 Any password will do')
+
+    def ftp_pass(self, argument: str):
+        self.reply('230 Logged in')
+
+    def ftp_syst(self, argument: str):
+        self.reply('215 UNIX Type: L8')
+
+    def ftp_feat(self, argument: str):
+        features = ['SIZE', 'MDTM', 'REST STREAM'] + (['MLSD'] if self.simulator.mlsd else [])
+        self.reply('211-Features:\r\n' + ''.join(' ' + f + '\r\n' for f in features) + '211 End')
+
+    def ftp_type(self, argument: str):
+        self.reply('200 Type set')
+
+    def ftp_noop(self, argument: str):
+        self.reply('200 OK')
+
+    def ftp_quit(self, argument: str):
+        self.reply('221 Bye')
+
+    def ftp_pwd(self, argument: str):
+        self.reply('257 "' + self.cwd + '"')
+
+    def ftp_cwd(self, argument: str):
+        if not os.path.isdir(self.local_path(argument)):
+            raise FtpError('550 No such directory')
+        self.cwd = self.remote_path(argument)
+        self.reply('250 OK')
+
+    def ftp_cdup(self, argument: str):
+        self.ftp_cwd('..')
+
+    def ftp_pasv(self, argument: str):
+        self.close_passive()
+        host = self.request.getsockname()[0]
+        self.passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.passive.bind((host, 0))
+        self.passive.listen(1)
+        port = self.passive.getsockname()[1]
+        self.reply('227 Entering Passive Mode ({},{},{})'.format(host.replace('.', ','), port >> 8, port & 255))
+
+    def ftp_rest(self, argument: str):
+        try:
+            self.rest = int(argument)
+        except ValueError:
+            raise FtpError('501 Bad offset')
+        self.reply('350 Restarting at ' + argument)
+
+    def ftp_size(self, argument: str):
+        path = self.local_path(argument)
+        if not os.path.isfile(path):
+            raise FtpError('550 No such file')
+        self.reply('213 ' + str(os.path.getsize(path)))
+
+    def ftp_mdtm(self, argument: str):
+        path = self.local_path(argument)
+        if not os.path.isfile(path):
+            raise FtpError('550 No such file')
+        self.reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(path))))
+
+    def ftp_dele(self, argument: str):
+        path = self.local_path(argument)
+        if not os.path.isfile(path):
+            raise FtpError('550 No such file')
+        os.remove(path)
+        self.reply('250 Deleted')
+
+    def ftp_mkd(self, argument: str):
+        path = self.local_path(argument)
+        if os.path.exists(path):
+            raise FtpError('550 Already exists')
+        os.mkdir(path)
+        self.reply('257 "' + self.remote_path(argument) + '" created')
+
+    def ftp_rmd(self, argument: str):
+        path = self.local_path(argument)
+        if not os.path.isdir(path) or self.remote_path(argument).count('/') < 2:
+            raise FtpError('550 Cannot remove')
+        shutil.rmtree(path)
+        self.reply('250 Removed')
+
+    def listing_lines(self, argument: str, mlsd: bool):
+        directory = self.local_path(argument)
+        if not os.path.isdir(directory):
+            raise FtpError('550 No such directory')
+        lines = []
+        for name in sorted(os.listdir(directory)):
+            st = os.stat(os.path.join(directory, name))
+            is_dir = os.path.isdir(os.path.join(directory, name))
+            if mlsd:
+                lines.append('type={};size={};modify={}; {}'.format(
+                    'dir' if is_dir else 'file', 0 if is_dir else st.st_size,
+                    time.strftime('%Y%m%d%H%M%S', time.gmtime(st.st_mtime)), name))
+            else:
+                lines.append('{}rw-rw-rw-   1 user     ftp     {:>8} {} {}'.format(
+                    'd' if is_dir else '-', 0 if is_dir else st.st_size,
+                    time.strftime('%b %d  %Y', time.gmtime(st.st_mtime)), name))
+        return ''.join(line + '\r\n' for line in lines).encode('utf-8')
+
+    def send_listing(self, argument: str, mlsd: bool):
+        data = self.listing_lines(argument, mlsd)
+        conn = self.open_data()
+        self.reply('150 Here comes the listing')
+        with conn:
+            send_throttled(conn, data, self.simulator.bandwidth)
+        self.reply('226 Done')
+
+    def ftp_list(self, argument: str):
+        # options like -la are not supported
+        self.send_listing('' if argument.startswith('-') else argument, False)
+
+    def ftp_mlsd(self, argument: str):
+        if not self.simulator.mlsd:
+            raise FtpError('500 Unknown command')
+        self.send_listing(argument, True)
+
+    def ftp_retr(self, argument: str):
+        path = self.local_path(argument)
+        offset, self.rest = self.rest, 0
+        if not os.path.isfile(path):
+            raise FtpError('550 No such file')
+        conn = self.open_data()
+        self.reply('150 Sending')
+        count = 0
+        limit = self.simulator.drop_downloads_after
+        with conn, open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                block = f.read(DATA_BLOCK_SIZE if limit is None else min(DATA_BLOCK_SIZE, limit - count))
+                if not block:
+                    break
+                count += send_throttled(conn, block, self.simulator.bandwidth)
+        self.simulator.stats.add(ftp_bytes=count)
+        if limit is not None and count == limit and offset + count < os.path.getsize(path):
+            self.reply('426 Connection closed; transfer aborted')
+        else:
+            self.reply('226 Done')
+
+    def ftp_stor(self, argument: str):
+        path = self.local_path(argument)
+        offset, self.rest = self.rest, 0
+        if not os.path.isdir(os.path.dirname(path)):
+            raise FtpError('553 No such directory')
+        conn = self.open_data()
+        self.reply('150 Receiving')
+        count = 0
+        start = monotonic()
+        mode = 'r+b' if offset > 0 and os.path.exists(path) else 'wb'
+        with conn, open(path, mode) as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                block = recv_throttled(conn, DATA_BLOCK_SIZE, self.simulator.bandwidth, start, count)
+                if not block:
+                    break
+                f.write(block)
+                count += len(block)
+        self.simulator.stats.add(ftp_bytes=count)
+        self.reply('226 Done')
+
+
+class FtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, simulator: 'Simulator'):
+        self.simulator: 'Simulator' = simulator
+        super().__init__(address, FtpHandler)
@@ -0,0 +1,231 @@
+import os
+import threading
+from typing import Optional, List, Tuple, Dict, Callable
+
+from ultimate1541.listing import DirEntry
+from ultimate1541.settings import REU_SIZES
+
+DEFAULT_FIRMWARE = '*** Ultimate-II+ simulator ***'
+
+# rows of the screen used by the file browser
+FIRST_ROW = 2
+VISIBLE_ROWS = 21
+PATH_ROW = 24
+SCREEN_WIDTH = 80
+LABEL_WIDTH = 40
+
+NORMAL_LABEL = b'\x1b[37;2m'
+NORMAL_VALUE = b'\x1b[36;2m'
+SELECTED_LABEL = b'\x1b[37;1m'
+SELECTED_VALUE = b'\x1b[36;1m'
+HEADER = b'\x1b[33;1m'
+BORDER = b'\x1b[34;2m'
+
+CONTEXT_COMMANDS: Dict[str, List[str]] = {
+    '.prg': ['Run', 'Load', 'DMA', 'View'],
+    '.d64': ['Mount disk', 'Run disk', 'Mount & Run', 'View'],
+    '.d71': ['Mount disk', 'Run disk', 'View'],
+    '.d81': ['Mount disk', 'Run disk', 'View'],
+    '.reu': ['Load into REU', 'View'],
+}
+DEFAULT_CONTEXT_COMMANDS = ['View']
+
+
+def sort_entries(entries: List[DirEntry]) -> List[DirEntry]:
+    # how the simulated file browser orders a directory: directories first, then files, each ignoring case;
+    # kept apart from listing.browser_order, so that tests can make the client's guess wrong
+    return sorted(entries, key=lambda e: (not e.is_dir, e.name.lower()))
+
+
+def default_settings() -> Dict[str, List[List]]:
+    # category -> [[setting, value, choices], ...]
+    reu_sizes = sorted(set(REU_SIZES.values()), key=lambda v: int(v.split()[0]) * (1024 if v.endswith('MB') else 1))
+    enabled = ['Disabled', 'Enabled']
+    return {
+        'Drive A Settings': [['Drive', 'Enabled', enabled], ['Drive Type', '1541', ['1541', '1571', '1581']],
+                             ['Drive Bus ID', '8', ['8', '9', '10', '11']]],
+        'Drive B Settings': [['Drive', 'Disabled', enabled], ['Drive Type', '1541', ['1541', '1571', '1581']],
+                             ['Drive Bus ID', '9', ['8', '9', '10', '11']]],
+        'C64 and cartridge settings': [['Cartridge', 'None', ['None', 'Final Cartridge III', 'Action Replay']],
+                                       ['RAM Expansion Unit', 'Disabled', enabled],
+                                       ['REU Size', '512 KB', reu_sizes],
+                                       ['Command Interface', 'Disabled', enabled]],
+        'Network settings': [['Host Name', 'Ultimate', ['Ultimate']], ['Use DHCP', 'Enabled', enabled]],
+    }
+
+
+class Popup:
+    # a bordered menu drawn over the browser: a context menu, or a level of the settings tree
+    def __init__(self, items: List[Tuple[str, str]], on_select: Callable[[int], None], cursor: int = 0):
+        self.items: List[Tuple[str, str]] = items
+        self.on_select: Callable[[int], None] = on_select
+        self.cursor: int = cursor
+
+
+class MenuUI:
+    # The menu of one telnet session: the device list, the file browser over the directories of the root
+    # (each top-level directory is a device), the context menu of a file and the F2 settings tree.
+    # Keys are 'up', 'down', 'left', 'right', 'return', 'f2' and 'escape'.
+
+    def __init__(self, root: str, settings: Dict[str, List[List]], events: List[Tuple[str, str]],
+                 lock: threading.Lock, firmware: str = DEFAULT_FIRMWARE,
+                 sort: Callable[[List[DirEntry]], List[DirEntry]] = sort_entries):
+        self.root: str = root
+        self.settings: Dict[str, List[List]] = settings
+        # (command, path) of every context menu command, e.g. ('Run', '/Usb0/game.prg')
+        self.events: List[Tuple[str, str]] = events
+        # guards settings and events, which are shared by all sessions
+        self.lock: threading.Lock = lock
+        self.firmware: str = firmware
+        self.sort: Callable[[List[DirEntry]], List[DirEntry]] = sort
+        self.path: List[str] = []
+        self.cursor: int = 0
+        self.top: int = 0
+        self.popups: List[Popup] = []
+
+    def entries(self) -> List[DirEntry]:
+        directory = os.path.join(self.root, *self.path)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        result = []
+        for name in names:
+            full = os.path.join(directory, name)
+            if len(self.path) == 0:
+                if os.path.isdir(full):
+                    result.append(DirEntry(name, 'dir', None, None, 'Ready'))
+            elif os.path.isdir(full):
+                result.append(DirEntry(name, 'dir', None, None, 'DIR'))
+            else:
+                extension = os.path.splitext(name)[1]
+                result.append(DirEntry(name, 'file', os.path.getsize(full), None, extension[1:].upper()))
+        if len(self.path) == 0:
+            return sorted(result, key=lambda e: e.name)
+        return self.sort(result)
+
+    def press(self, key: str):
+        if self.popups:
+            self.__press_popup(key)
+        else:
+            self.__press_browser(key)
+
+    def __press_popup(self, key: str):
+        popup = self.popups[-1]
+        if key == 'up':
+            popup.cursor = max(0, popup.cursor - 1)
+        elif key == 'down':
+            popup.cursor = min(len(popup.items) - 1, popup.cursor + 1)
+        elif key in ('return', 'right'):
+            popup.on_select(popup.cursor)
+        elif key == 'left':
+            self.popups.pop()
+        elif key == 'escape':
+            self.popups.clear()
+
+    def __press_browser(self, key: str):
+        entries = self.entries()
+        if key == 'up':
+            self.cursor = max(0, self.cursor - 1)
+        elif key == 'down':
+            self.cursor = max(0, min(len(entries) - 1, self.cursor + 1))
+        elif key == 'left':
+            if self.path:
+                child = self.path.pop()
+                names = [e.name for e in self.entries()]
+                self.cursor = names.index(child) if child in names else 0
+        elif key in ('right', 'return') and self.cursor < len(entries):
+            entry = entries[self.cursor]
+            if entry.is_dir:
+                self.path.append(entry.name)
+                self.cursor = 0
+                self.top = 0
+            elif key == 'return':
+                self.__open_context_menu(entry.name)
+        elif key == 'f2':
+            self.__open_settings()
+        self.__scroll()
+
+    def __scroll(self):
+        if self.cursor < self.top:
+            self.top = self.cursor
+        elif self.cursor >= self.top + VISIBLE_ROWS:
+            self.top = self.cursor - VISIBLE_ROWS + 1
+
+    def __open_context_menu(self, name: str):
+        commands = CONTEXT_COMMANDS.get(os.path.splitext(name)[1].lower(), DEFAULT_CONTEXT_COMMANDS)
+        path = '/' + '/'.join(self.path + [name])
+
+        def select(index: int):
+            with self.lock:
+                self.events.append((commands[index], path))
+            self.popups.clear()
+
+        self.popups.append(Popup([(c, '') for c in commands], select))
+
+    def __open_settings(self):
+        categories = list(self.settings.keys())
+        self.popups.append(Popup([(c, '') for c in categories], lambda i: self.__open_category(categories[i])))
+
+    def __open_category(self, category: str):
+        settings = self.settings[category]
+
+        def items() -> List[Tuple[str, str]]:
+            return [(label, value) for label, value, _ in settings]
+
+        def select(index: int):
+            label, value, choices = settings[index]
+
+            def choose(choice: int):
+                with self.lock:
+                    settings[index][1] = choices[choice]
+                self.popups.pop()
+                # the category shows the new value
+                self.popups[-1].items = items()
+
+            self.popups.append(Popup([(c, '') for c in choices], choose,
+                                     choices.index(value) if value in choices else 0))
+
+        self.popups.append(Popup(items(), select))
+
+    def render(self) -> bytes:
+        # the whole screen, as the Ultimate draws it after a clear
+        out = bytearray(b'\x1bc')
+        out += HEADER + self.firmware.center(SCREEN_WIDTH).encode('utf-8')
+        entries = self.entries()
+        for row in range(1, PATH_ROW):
+            out += b'\x1b[%d;1H' % (row + 1)
+            index = self.top + row - FIRST_ROW
+            if FIRST_ROW <= row < FIRST_ROW + VISIBLE_ROWS and index < len(entries):
+                entry = entries[index]
+                selected = index == self.cursor
+                out += SELECTED_LABEL if selected else NORMAL_LABEL
+                out += entry.name[:LABEL_WIDTH - 1].ljust(LABEL_WIDTH).encode('utf-8')
+                out += SELECTED_VALUE if selected else NORMAL_VALUE
+                out += entry.raw.ljust(SCREEN_WIDTH - LABEL_WIDTH).encode('utf-8')
+            else:
+                out += NORMAL_LABEL + b' ' * SCREEN_WIDTH
+        if self.path:
+            out += b'\x1b[%d;1H' % (PATH_ROW + 1) + HEADER + ('/' + '/'.join(self.path) + '/').encode('utf-8')
+        if self.popups:
+            out += self.__render_popup(self.popups[-1])
+        return bytes(out)
+
+    @staticmethod
+    def __render_popup(popup: Popup) -> bytes:
+        label_width = max(len(label) for label, _ in popup.items)
+        value_width = max(len(value) for _, value in popup.items)
+        inner = label_width + (value_width + 2 if value_width else 0) + 2
+        x = 1 + max(0, (SCREEN_WIDTH - inner - 2) // 2)
+        y = 1 + max(FIRST_ROW, (PATH_ROW - len(popup.items) - 2) // 2)
+        out = bytearray()
+        out += b'\x1b[%d;%dH' % (y, x) + BORDER + b'\x1b(0l' + b'q' * inner + b'k\x1b(B'
+        for i, (label, value) in enumerate(popup.items):
+            selected = i == popup.cursor
+            out += b'\x1b[%d;%dH' % (y + 1 + i, x) + BORDER + b'\x1b(0x\x1b(B'
+            out += (SELECTED_LABEL if selected else NORMAL_LABEL) + (' ' + label.ljust(label_width)).encode('utf-8')
+            if value_width:
+                out += (SELECTED_VALUE if selected else NORMAL_VALUE) + ('  ' + value.ljust(value_width)).encode('utf-8')
+            out += b' ' + BORDER + b'\x1b(0x\x1b(B'
+        out += b'\x1b[%d;%dH' % (y + 1 + len(popup.items), x) + BORDER + b'\x1b(0m' + b'q' * inner + b'j\x1b(B'
+        return bytes(out)
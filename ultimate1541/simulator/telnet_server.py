@@ -0,0 +1,107 @@
+import re
+import socketserver
+from time import sleep
+from typing import List, TYPE_CHECKING
+
+from ultimate1541.simulator.menu import MenuUI
+from ultimate1541.simulator.throttle import send_throttled
+from ultimate1541.telnet import TelnetDecoder, IAC, WILL, ECHO
+
+if TYPE_CHECKING:
+    from ultimate1541.simulator import Simulator
+
+SUPPRESS_GO_AHEAD = bytes([3])
+
+CSI_KEY = re.compile(rb'\x1b\[([0-9;]*)([A-Za-z~])')
+CSI_KEYS = {(b'', b'A'): 'up', (b'', b'B'): 'down', (b'', b'C'): 'right', (b'', b'D'): 'left', (b'12', b'~'): 'f2'}
+
+
+class KeyParser:
+    # turns what the terminal sends into key names; a sequence cut off at the end of a chunk waits for the next one
+    def __init__(self):
+        self.pending: bytes = b''
+
+    def feed(self, data: bytes) -> List[str]:
+        data = self.pending + data
+        self.pending = b''
+        keys = []
+        i = 0
+        while i < len(data):
+            b = data[i:i + 1]
+            if b == b'\x1b':
+                if i + 1 >= len(data):
+                    self.pending = data[i:]
+                    break
+                if data[i + 1:i + 2] != b'[':
+                    # a lone escape
+                    keys.append('escape')
+                    i += 1
+                    continue
+                m = CSI_KEY.match(data, i)
+                if m is None:
+                    if re.fullmatch(rb'\x1b\[[0-9;]*', data[i:]):
+                        self.pending = data[i:]
+                        break
+                    i += 2
+                    continue
+                key = CSI_KEYS.get((m.group(1), m.group(2)))
+                if key is not None:
+                    keys.append(key)
+                i = m.end()
+            elif b == b'\r':
+                keys.append('return')
+                i += 1
+            else:
+                # line feeds and NULs after carriage returns, and keys the menu does not use
+                i += 1
+        return keys
+
+
+class TelnetHandler(socketserver.BaseRequestHandler):
+    server: 'TelnetServer'
+
+    def handle(self):
+        simulator = self.server.simulator
+        ui = MenuUI(simulator.root, simulator.settings, simulator.events, simulator.lock, simulator.firmware,
+                    simulator.browser_sort)
+        decoder = TelnetDecoder()
+        keys = KeyParser()
+        self.send(IAC + WILL + ECHO + IAC + WILL + SUPPRESS_GO_AHEAD)
+        self.redraw(ui)
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            payload, _ = decoder.feed(data)
+            pressed = keys.feed(payload)
+            if not pressed:
+                continue
+            for key in pressed:
+                if simulator.key_delay > 0:
+                    sleep(simulator.key_delay)
+                ui.press(key)
+            simulator.stats.add(keys=len(pressed))
+            if simulator.latency > 0:
+                sleep(simulator.latency)
+            self.redraw(ui)
+
+    def redraw(self, ui: MenuUI):
+        self.send(ui.render())
+        self.server.simulator.stats.add(redraws=1)
+
+    def send(self, data: bytes):
+        simulator = self.server.simulator
+        send_throttled(self.request, data, simulator.bandwidth)
+        simulator.stats.add(telnet_bytes=len(data))
+
+
+class TelnetServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, simulator: 'Simulator'):
+        self.simulator: 'Simulator' = simulator
+        super().__init__(address, TelnetHandler)
@@ -0,0 +1,52 @@
+import socket
+import threading
+from time import monotonic, sleep
+from typing import Optional
+
+
+class Stats:
+    # counters shared by the servers of one simulator
+    def __init__(self):
+        self.lock: threading.Lock = threading.Lock()
+        self.keys: int = 0
+        self.redraws: int = 0
+        self.telnet_bytes: int = 0
+        self.ftp_commands: int = 0
+        self.ftp_bytes: int = 0
+
+    def add(self, **counts: int):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def as_dict(self):
+        with self.lock:
+            return {'keys': self.keys, 'redraws': self.redraws, 'telnet_bytes': self.telnet_bytes,
+                    'ftp_commands': self.ftp_commands, 'ftp_bytes': self.ftp_bytes}
+
+
+def send_throttled(sock: socket.socket, data: bytes, bandwidth: Optional[float]) -> int:
+    # sends no faster than bandwidth bytes per second; None is unlimited
+    if bandwidth is None:
+        sock.sendall(data)
+        return len(data)
+    chunk = max(1, int(bandwidth / 100))
+    start = monotonic()
+    view = memoryview(data)
+    for position in range(0, len(data), chunk):
+        sock.sendall(view[position:position + chunk])
+        ahead = (position + chunk) / bandwidth - (monotonic() - start)
+        if ahead > 0:
+            sleep(ahead)
+    return len(data)
+
+
+def recv_throttled(sock: socket.socket, size: int, bandwidth: Optional[float], start: float,
+                   received: int) -> bytes:
+    # receives so that the total since start stays within bandwidth bytes per second
+    if bandwidth is not None:
+        ahead = received / bandwidth - (monotonic() - start)
+        if ahead > 0:
+            sleep(ahead)
+        size = min(size, max(1, int(bandwidth / 100)))
+    return sock.recv(size)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+from ftplib import error_perm, error_reply
+from typing import Optional, List, Tuple, Dict, Callable, TYPE_CHECKING
+
+from ultimate1541.listing import DirEntry
+from ultimate1541.menu_cache import default_cache_dir
+from ultimate1541.transfer import TransferReport, DEFAULT_CONCURRENCY
+
+if TYPE_CHECKING:
+    from ultimate1541 import Ultimate1541
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(65536)
+            if not block:
+                return h.hexdigest()
+            h.update(block)
+
+
+# Content hashes of files as they were uploaded, keyed by device address and remote path,
+# with the size and modification time the local file had then.
+# Used when the server cannot tell the size or modification time of a remote file.
+class SyncManifest:
+    def __init__(self, path: Optional[str] = None):
+        self.path: Optional[str] = path
+        self.lock: threading.Lock = threading.Lock()
+        self.devices: Dict[str, Dict[str, Dict[str, object]]] = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.devices = json.load(f)
+            except (OSError, ValueError):
+                self.devices = {}
+
+    @staticmethod
+    def default() -> 'SyncManifest':
+        return SyncManifest(os.path.join(default_cache_dir(), 'sync-manifest.json'))
+
+    def get(self, device: str, remote_path: str) -> Optional[Dict[str, object]]:
+        return self.devices.get(device, {}).get(remote_path)
+
+    def put(self, device: str, remote_path: str, size: int, sha1: str, mtime_ns: Optional[int] = None):
+        with self.lock:
+            self.devices.setdefault(device, {})[remote_path] = {'size': size, 'sha1': sha1, 'mtime_ns': mtime_ns}
+
+    def remove(self, device: str, remote_path: str):
+        with self.lock:
+            self.devices.get(device, {}).pop(remote_path, None)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.devices, f, indent=1)
+            os.replace(tmp, self.path)
+
+
+class SyncReport:
+    def __init__(self):
+        self.skipped: List[str] = []
+        self.deleted: List[str] = []
+        self.created_dirs: List[str] = []
+        self.transfers: TransferReport = TransferReport()
+
+    def __str__(self):
+        return 'uploaded {}, skipped {} unchanged, deleted {}'.format(
+            self.transfers, len(self.skipped), len(self.deleted))
+
+
+def needs_upload(local_path: str, remote: Optional[DirEntry], known: Optional[Dict[str, object]],
+                 local_hash: Callable[[], str]) -> bool:
+    # The cheap checks come first; the content is only hashed when the sizes match
+    # and the local file was modified since it was uploaded.
+    if remote is None:
+        return True
+    stat = os.stat(local_path)
+    if remote.size is not None and remote.size != stat.st_size:
+        return True
+    if known is not None:
+        if known['size'] != stat.st_size:
+            return True
+        if known.get('mtime_ns') == stat.st_mtime_ns:
+            return False
+        return known['sha1'] != local_hash()
+    # never uploaded from here; trust the remote copy only if it is the same size and not older
+    return remote.size is None or remote.mtime is None or remote.mtime < stat.st_mtime
+
+
+def sync(u: 'Ultimate1541', local_dir: str, remote_dir: str, *,
+         manifest: SyncManifest, delete: bool = False, concurrency: int = DEFAULT_CONCURRENCY) -> SyncReport:
+    # The sizes and modification times of the remote files come from one listing per directory (MLSD,
+    # or LIST where the server does not have it) rather than from SIZE and MDTM for every file.
+    # LIST may not have exact times, which is what the manifest is for.
+    report = SyncReport()
+    device = u.ip_addr
+    remote_dir = remote_dir.rstrip('/') or '/'
+    uploads: List[Tuple[str, str]] = []
+    # remote path -> the stat of the local file when it was compared
+    stats: Dict[str, os.stat_result] = {}
+    for root, dirs, files in os.walk(local_dir):
+        dirs.sort()
+        relative = os.path.relpath(root, local_dir)
+        target_dir = remote_dir if relative == '.' else remote_dir + '/' + relative.replace(os.sep, '/')
+        try:
+            listing = {entry.name: entry for entry in u.list_dir(target_dir)}
+        except error_perm:
+            u.make_directory(target_dir)
+            report.created_dirs.append(target_dir)
+            listing = {}
+        for name in sorted(files):
+            local_path = os.path.join(root, name)
+            remote_path = target_dir.rstrip('/') + '/' + name
+            if needs_upload(local_path, listing.get(name), manifest.get(device, remote_path),
+                            lambda: file_hash(local_path)):
+                uploads.append((local_path, remote_path))
+                stats[remote_path] = os.stat(local_path)
+            else:
+                report.skipped.append(remote_path)
+        if delete:
+            for name, remote in sorted(listing.items()):
+                if not remote.is_dir and name not in files and name not in dirs:
+                    remote_path = target_dir.rstrip('/') + '/' + name
+                    try:
+                        u.delete_file(remote_path)
+                    except (error_perm, error_reply):
+                        # LIST formats the parser does not know do not tell directories apart
+                        continue
+                    manifest.remove(device, remote_path)
+                    report.deleted.append(remote_path)
+    report.transfers = u.upload_files(uploads, overwrite=True, concurrency=concurrency)
+    for result in report.transfers.succeeded():
+        before = stats[result.target]
+        sha1 = file_hash(result.source)
+        after = os.stat(result.source)
+        if (after.st_size, after.st_mtime_ns) == (before.st_size, before.st_mtime_ns):
+            manifest.put(device, result.target, after.st_size, sha1, after.st_mtime_ns)
+        else:
+            # changed during the upload, so what was sent is not known
+            manifest.remove(device, result.target)
+    manifest.save()
+    return report
@@ -0,0 +1,69 @@
+from typing import Tuple
+
+# telnet protocol bytes, as in RFC 854
+IAC = bytes([255])
+DONT = bytes([254])
+DO = bytes([253])
+WONT = bytes([252])
+WILL = bytes([251])
+SB = bytes([250])
+SE = bytes([240])
+ECHO = bytes([1])
+
+
+def negotiation_reply(cmd: bytes, opt: bytes) -> bytes:
+    # the Ultimate may echo, everything else is refused
+    if cmd == WILL and opt == ECHO:
+        return IAC + DO + opt
+    elif cmd in (DO, DONT):
+        return IAC + WONT + opt
+    elif cmd in (WILL, WONT):
+        return IAC + DONT + opt
+    return b''
+
+
+class TelnetDecoder:
+    # Separates telnet commands from the data stream, for clients that do not use telnetlib.
+    # Commands may be split across chunks.
+
+    def __init__(self):
+        self.pending: bytes = b''
+
+    def feed(self, chunk: bytes) -> Tuple[bytes, bytes]:
+        # returns the data and the replies that should be sent back
+        data = self.pending + chunk if self.pending else chunk
+        self.pending = b''
+        if IAC not in data:
+            return data, b''
+        payload = bytearray()
+        replies = bytearray()
+        i = 0
+        while i < len(data):
+            j = data.find(IAC, i)
+            if j < 0:
+                payload += data[i:]
+                break
+            payload += data[i:j]
+            if j + 1 >= len(data):
+                self.pending = data[j:]
+                break
+            cmd = data[j + 1:j + 2]
+            if cmd == IAC:
+                payload += IAC
+                i = j + 2
+            elif cmd in (DO, DONT, WILL, WONT):
+                if j + 2 >= len(data):
+                    self.pending = data[j:]
+                    break
+                replies += negotiation_reply(cmd, data[j + 2:j + 3])
+                i = j + 3
+            elif cmd == SB:
+                end = data.find(IAC + SE, j + 2)
+                if end < 0:
+                    self.pending = data[j:]
+                    break
+                i = end + 2
+            else:
+                # commands without an option, like NOP or GA
+                i = j + 2
+        return bytes(payload), bytes(replies)
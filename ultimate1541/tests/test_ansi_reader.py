@@ -0,0 +1,33 @@
+import unittest
+
+from ultimate1541.ansi_reader import FixedAnsiReaderWriter
+from ultimate1541.escape_sequence import EscapeSequence
+
+
+def read_all(r: FixedAnsiReaderWriter) -> list:
+    result = []
+    while True:
+        t = r.read_token()
+        if t is None:
+            return result
+        result.append(str(t) if type(t) is EscapeSequence else t)
+
+
+class TestAnsiReader(unittest.TestCase):
+
+    def test_text_runs(self):
+        r = FixedAnsiReaderWriter(b'\x1b[37;1mHello\r\n\x1b(0lqk\x1b(B ok')
+        self.assertEqual(read_all(r), ['ESC [37;1m', 'Hello', '\r', '\n', '┌─┐', ' ok'])
+
+    def test_split_escape_sequences(self):
+        data = b'\x1bc\x1b[12;34H\x1b(0x\x1b(Babc\x1b[m'
+        whole = read_all(FixedAnsiReaderWriter(data))
+        for chunk_size in range(1, 6):
+            r = FixedAnsiReaderWriter(data, chunk_size=chunk_size)
+            tokens = read_all(r)
+            self.assertEqual(''.join(whole), ''.join(tokens))
+            self.assertEqual(r.partial, b'')
+
+    def test_unsupported_escape_sequence(self):
+        with self.assertRaises(ValueError):
+            read_all(FixedAnsiReaderWriter(b'\x1bZ'))
@@ -0,0 +1,79 @@
+import unittest
+from typing import List
+
+from ultimate1541.ansi_reader import FixedAnsiReaderWriter
+from ultimate1541.console_manipulator import ConsoleManipulator, NavigationStep, NavigationError, ANSI_UP, \
+    ANSI_DOWN, ANSI_RETURN, ANSI_LEFT, ANSI_RIGHT, MAX_MENU_LENGTH
+
+MENU_SCREEN = (b'\x1bc\x1b[37;2mHeader\r\n\r\n'
+               b' Alpha\r\n'
+               b'\x1b[37;1m Beta\x1b[37;2m\r\n'
+               b' Gamma\r\n')
+
+BROWSER_SCREEN = MENU_SCREEN + b'\x1b[25;1H/Usb0/X/B/'
+
+
+class RecordingAnsiReaderWriter(FixedAnsiReaderWriter):
+
+    def __init__(self, buf: bytes):
+        super().__init__(buf)
+        self.written: List[bytes] = []
+
+    def write(self, data: bytes):
+        self.written.append(data)
+
+
+class TestConsoleManipulator(unittest.TestCase):
+
+    def test_keys_are_sent_in_one_write(self):
+        r = RecordingAnsiReaderWriter(MENU_SCREEN)
+        m = ConsoleManipulator(r)
+        m.select_option(2, use_return=True)
+        self.assertEqual(r.written, [ANSI_DOWN + ANSI_RETURN])
+
+    def test_navigate_with_known_indices(self):
+        r = RecordingAnsiReaderWriter(MENU_SCREEN)
+        m = ConsoleManipulator(r)
+        m.navigate([NavigationStep('Beta', 1)])
+        self.assertEqual(r.written, [ANSI_UP * MAX_MENU_LENGTH + ANSI_DOWN, ANSI_RETURN])
+
+    def test_navigate_verifies_selection(self):
+        m = ConsoleManipulator(RecordingAnsiReaderWriter(MENU_SCREEN))
+        with self.assertRaises(NavigationError):
+            m.navigate([NavigationStep('Gamma', 2)])
+
+    def test_firmware(self):
+        m = ConsoleManipulator(FixedAnsiReaderWriter(b'\x1bc     *** Ultimate-II+ V3.10 (1.2B) ***\r\n'))
+        m.refresh_screen()
+        self.assertEqual(m.firmware(), 'Ultimate-II+ V3.10 (1.2B)')
+        m = ConsoleManipulator(FixedAnsiReaderWriter(MENU_SCREEN))
+        m.refresh_screen()
+        self.assertIsNone(m.firmware())
+
+    def test_browse_to_goes_up_to_common_ancestor(self):
+        r = RecordingAnsiReaderWriter(BROWSER_SCREEN)
+        m = ConsoleManipulator(r)
+        m.location = ['Usb0', 'X', 'B']
+        m.browse_to('Usb0', ['X', 'B'])
+        self.assertEqual(r.written, [])
+        m.browse_to('Usb0', ['X'])
+        self.assertEqual(r.written, [ANSI_LEFT])
+        self.assertEqual(m.location, ['Usb0', 'X'])
+
+    def test_browse_to_starts_from_home_when_lost(self):
+        r = RecordingAnsiReaderWriter(BROWSER_SCREEN)
+        m = ConsoleManipulator(r)
+        m.location = ['Usb0', 'Y']
+        with self.assertRaises(ValueError):
+            m.browse_to('Usb0', [])
+        self.assertEqual(r.written, [ANSI_LEFT * 8])
+
+    def test_select_entry_off_screen_with_listing(self):
+        r = RecordingAnsiReaderWriter(b'\x1bc\x1b[37;2mHeader\r\n\r\n E49\r\n\x1b[37;1m E50\x1b[37;2m\r\n E51\r\n'
+                                      b'\x1b[25;1H/Usb0/X/')
+        m = ConsoleManipulator(r)
+        m.directory_lister = lambda location: ['E' + str(i) for i in range(60)] if location == ['Usb0', 'X'] else None
+        m.location = ['Usb0', 'X']
+        m.select_entry('E50', use_return=False)
+        self.assertEqual(r.written, [ANSI_DOWN * 50, ANSI_RIGHT])
+        self.assertEqual(m.location, ['Usb0', 'X', 'E50'])
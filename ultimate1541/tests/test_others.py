@@ -1,8 +1,395 @@
+import os
+import socket
+import sys
+import io
+import tempfile
+import threading
+import time
 import unittest
 
 import ultimate1541
+from ultimate1541.menu import Menu
+from ultimate1541 import settings
+from ultimate1541.menu_cache import MenuCache
+from ultimate1541.listing import DirEntry, DirectoryCache, parse_list_line, parse_mlsd_line, parse_mdtm, \
+    browser_order
+from ultimate1541.sync import needs_upload, file_hash
+from ultimate1541.transfer import send_file
+from ultimate1541 import agent
+from ultimate1541.fleet import read_hosts, run_fleet
+from ultimate1541.watch import BuildWatcher, watch
+from ultimate1541.telnet import TelnetDecoder, IAC, DO, WILL, WONT, ECHO, SB, SE
+from ultimate1541.settle import SettleDetector, MAX_RESPONSE_WINDOW, MIN_RESPONSE_WINDOW, MIN_QUIET_WINDOW
 
 class TestSplitPath(unittest.TestCase):
 
     def test_split_path(self):
-        self.assertEqual(ultimate1541.split_path('/Usb0/A/B'), ['Usb0', 'A', 'B'])
\ No newline at end of file
+        self.assertEqual(ultimate1541.split_path('/Usb0/A/B'), ['Usb0', 'A', 'B'])
+
+class TestSettleDetector(unittest.TestCase):
+
+    def test_windows_adapt_to_observed_latency(self):
+        d = SettleDetector()
+        self.assertAlmostEqual(d.response_window(), MAX_RESPONSE_WINDOW)
+        for _ in range(50):
+            d.observe_response(0.001)
+            d.observe_gap(0.001)
+        self.assertAlmostEqual(d.response_window(), MIN_RESPONSE_WINDOW)
+        self.assertAlmostEqual(d.quiet_window(), MIN_QUIET_WINDOW)
+        for _ in range(50):
+            d.observe_response(10)
+        self.assertAlmostEqual(d.response_window(), MAX_RESPONSE_WINDOW)
+
+
+class TestMenuCache(unittest.TestCase):
+
+    def test_remember_and_persist(self):
+        menu = Menu()
+        menu.add_item('RAM Expansion Unit', 'Enabled', False)
+        menu.add_item('REU Size', '512 KB', True)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'menus.json')
+            cache = MenuCache(path)
+            cache.remember('1.2.3.4', 'V3.7', ['C64'], menu)
+            cache.set_value('1.2.3.4', 'V3.7', ['C64'], 'REU Size', '16 MB')
+            cache = MenuCache(path)
+            self.assertEqual(cache.lookup('1.2.3.4', 'V3.7', ['C64'], 'REU Size'), 1)
+            self.assertEqual(cache.value('1.2.3.4', 'V3.7', ['C64'], 'REU Size'), '16 MB')
+            self.assertIsNone(cache.lookup('1.2.3.4', 'V3.8', ['C64'], 'REU Size'))
+            cache.remember('1.2.3.4', 'V3.7', ['C64'], menu)
+            cache.invalidate('1.2.3.4')
+            self.assertIsNone(MenuCache(path).lookup('1.2.3.4', 'V3.7', ['C64'], 'REU Size'))
+            # an unknown firmware version is remembered, but not saved, and does not replace the saved entry
+            cache.remember('1.2.3.4', 'V3.7', ['C64'], menu)
+            cache.remember('1.2.3.4', None, ['Drive'], menu)
+            self.assertEqual(cache.lookup('1.2.3.4', None, ['Drive'], 'REU Size'), 1)
+            self.assertIsNone(MenuCache(path).lookup('1.2.3.4', None, ['Drive'], 'REU Size'))
+            self.assertEqual(MenuCache(path).lookup('1.2.3.4', 'V3.7', ['C64'], 'REU Size'), 1)
+
+    def test_default_is_in_memory(self):
+        u = ultimate1541.Ultimate1541('1.2.3.4')
+        self.assertIsNone(u.menu_cache.path)
+
+
+class TestSettingsTransaction(unittest.TestCase):
+
+    def test_changes_are_grouped_and_ordered(self):
+        u = ultimate1541.Ultimate1541('1.2.3.4', menu_cache=MenuCache())
+        menu = Menu()
+        for label in ['Command Interface', 'RAM Expansion Unit', 'REU Size']:
+            menu.add_item(label, '', False)
+        u.menu_cache.remember('1.2.3.4', u.firmware, ['C64 and cartridge settings'], menu)
+        s = u.settings()
+        s.set_by_name('reu_size', '16M')
+        s.set(['Drive A Settings', 'Drive'], 'Enabled')
+        s.set_by_name('reu', 'on')
+        s.set_by_name('command_interface', 'off')
+        s.set_by_name('reu', 'off')
+        self.assertEqual(s.ordered_changes(), [
+            (('C64 and cartridge settings',), [
+                ('Command Interface', 'Disabled'),
+                ('RAM Expansion Unit', 'Disabled'),
+                ('REU Size', '16 MB')]),
+            (('Drive A Settings',), [('Drive', 'Enabled')]),
+        ])
+
+    def test_profile_changes(self):
+        u = ultimate1541.Ultimate1541('1.2.3.4', menu_cache=MenuCache())
+        root = Menu()
+        root.add_item('C64 and cartridge settings', '', True)
+        category = Menu()
+        category.add_item('RAM Expansion Unit', 'Enabled', True)
+        category.add_item('REU Size', '512 KB', False)
+        u.menu_cache.remember('1.2.3.4', u.firmware, [], root)
+        u.menu_cache.remember('1.2.3.4', u.firmware, ['C64 and cartridge settings'], category)
+        self.assertEqual(settings.snapshot(u), {
+            'C64 and cartridge settings': {'RAM Expansion Unit': 'Enabled', 'REU Size': '512 KB'}})
+        self.assertEqual(settings.profile_changes(u, {
+            'C64 and cartridge settings': {'RAM Expansion Unit': 'Enabled', 'REU Size': '16 MB'},
+            'Drive A Settings': {'Drive': 'Enabled'},
+        }), [('C64 and cartridge settings', 'REU Size', '16 MB'), ('Drive A Settings', 'Drive', 'Enabled')])
+
+
+class TestSync(unittest.TestCase):
+
+    def test_needs_upload(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.prg')
+            with open(path, 'wb') as f:
+                f.write(b'\x01\x08')
+            h = file_hash(path)
+            stat = os.stat(path)
+            mtime = stat.st_mtime
+            hashed = []
+
+            def local_hash():
+                hashed.append(path)
+                return h
+
+            self.assertTrue(needs_upload(path, None, None, local_hash))
+            self.assertTrue(needs_upload(path, DirEntry('a.prg', 'file', 3, mtime + 10), None, local_hash))
+            self.assertFalse(needs_upload(path, DirEntry('a.prg', 'file', 2, mtime + 10), None, local_hash))
+            self.assertTrue(needs_upload(path, DirEntry('a.prg', 'file', 2, mtime - 10), None, local_hash))
+            self.assertTrue(needs_upload(path, DirEntry('a.prg'), None, local_hash))
+            self.assertTrue(needs_upload(path, DirEntry('a.prg'), {'size': 3, 'sha1': h}, local_hash))
+            unchanged = {'size': 2, 'sha1': 'x', 'mtime_ns': stat.st_mtime_ns}
+            self.assertFalse(needs_upload(path, DirEntry('a.prg'), unchanged, local_hash))
+            # the content is only read when nothing cheaper decides
+            self.assertEqual(hashed, [])
+            self.assertFalse(needs_upload(path, DirEntry('a.prg'), {'size': 2, 'sha1': h}, local_hash))
+            self.assertTrue(needs_upload(path, DirEntry('a.prg'), {'size': 2, 'sha1': 'x', 'mtime_ns': 0}, local_hash))
+            self.assertEqual(hashed, [path, path])
+
+    def test_parse_mdtm(self):
+        self.assertEqual(parse_mdtm('19700101000100'), 60.0)
+        self.assertIsNone(parse_mdtm('garbage'))
+
+
+class TestListing(unittest.TestCase):
+
+    def test_parse_list_line(self):
+        e = parse_list_line('-rw-rw-rw-   1 user     ftp         2050 Jan 01  1980 plasma.prg')
+        self.assertEqual((e.name, e.type, e.size, e.mtime), ('plasma.prg', 'file', 2050, 315532800.0))
+        e = parse_list_line('drwxrwxrwx   1 user     ftp            0 Jan 01  1980 Games Collection')
+        self.assertEqual((e.name, e.is_dir), ('Games Collection', True))
+        e = parse_list_line('01-01-80  12:00AM       <DIR>          Demos')
+        self.assertEqual((e.name, e.is_dir), ('Demos', True))
+        self.assertIsNone(parse_list_line('total 3'))
+        e = parse_mlsd_line('type=file;size=174848;modify=19800101000000; disk.d64')
+        self.assertEqual((e.name, e.type, e.size, e.mtime), ('disk.d64', 'file', 174848, 315532800.0))
+        self.assertIsNone(parse_mlsd_line('type=cdir;modify=19800101000000; .'))
+
+    def test_browser_order(self):
+        entries = [DirEntry('b.prg'), DirEntry('Zork', 'dir'), DirEntry('A.PRG'), DirEntry('demos', 'dir')]
+        self.assertEqual([e.name for e in browser_order(entries)], ['demos', 'Zork', 'A.PRG', 'b.prg'])
+
+    def test_directory_cache(self):
+        c = DirectoryCache()
+        entries = [DirEntry('a.prg')]
+        c.put('/Usb0/dir/', entries)
+        c.put('/Usb0/dir/sub', entries)
+        self.assertIs(c.get('/Usb0/dir'), entries)
+        c.invalidate_parent('/Usb0/dir/sub/x.prg')
+        self.assertIsNone(c.get('/Usb0/dir/sub'))
+        self.assertIs(c.get('/Usb0/dir'), entries)
+        c.invalidate_tree('/Usb0')
+        self.assertIsNone(c.get('/Usb0/dir'))
+        c.ttl = -1
+        c.put('/Usb0', entries)
+        self.assertIsNone(c.get('/Usb0'))
+
+
+class TestTransfer(unittest.TestCase):
+
+    def test_send_file(self):
+        data = bytes(range(256)) * 10
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.prg')
+            with open(path, 'wb') as f:
+                f.write(data)
+            for offset in [0, 1000, len(data)]:
+                a, b = socket.socketpair()
+                with a, b, open(path, 'rb') as f:
+                    self.assertEqual(send_file(a, f, offset, len(data), 300), len(data) - offset)
+                    a.shutdown(socket.SHUT_WR)
+                    received = b''
+                    while True:
+                        chunk = b.recv(65536)
+                        if not chunk:
+                            break
+                        received += chunk
+                    self.assertEqual(received, data[offset:])
+
+class TestTelnetDecoder(unittest.TestCase):
+
+    def test_commands_split_across_chunks(self):
+        data = b'ab' + IAC + WILL + ECHO + b'c' + IAC + IAC + IAC + SB + b'\x18\x01' + IAC + SE + b'd' + IAC + DO + b'\x18'
+        for split in range(len(data) + 1):
+            d = TelnetDecoder()
+            payload, replies = d.feed(data[:split])
+            more_payload, more_replies = d.feed(data[split:])
+            self.assertEqual(payload + more_payload, b'abc\xffd')
+            self.assertEqual(replies + more_replies, IAC + DO + ECHO + IAC + WONT + b'\x18')
+
+
+class TestFleet(unittest.TestCase):
+
+    def test_read_hosts(self):
+        self.assertEqual(read_hosts('10.0.0.1, 10.0.0.2,,10.0.0.1'), ['10.0.0.1', '10.0.0.2'])
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'hosts')
+            with open(path, 'w') as f:
+                f.write('# rack 1\n10.0.0.1\n10.0.0.2  # spare\n\n')
+            self.assertEqual(read_hosts('@' + path), ['10.0.0.1', '10.0.0.2'])
+
+    def test_slow_and_failing_hosts(self):
+        timeouts = []
+
+        def action(u, context):
+            timeouts.append(u.timeout)
+            context.print('hello from ' + u.ip_addr)
+            if u.ip_addr == 'dead':
+                time.sleep(5)
+            if u.ip_addr == 'broken':
+                raise OSError('connection refused')
+            # output from other threads, e.g. of parallel transfers, belongs to the host as well
+            worker = threading.Thread(target=context.print, args=('bye from ' + u.ip_addr,))
+            worker.start()
+            worker.join()
+
+        with tempfile.TemporaryDirectory() as d:
+            os.environ['U1541_CACHE_DIR'] = d
+            try:
+                stdout = sys.stdout
+                report = run_fleet(['dead', 'ok1', 'broken', 'ok2'], action, concurrency=2, timeout=7,
+                                   host_timeout=0.5)
+            finally:
+                del os.environ['U1541_CACHE_DIR']
+        self.assertIs(sys.stdout, stdout)
+        self.assertLess(report.seconds, 2)
+        self.assertEqual(timeouts, [7] * 4)
+        self.assertEqual([r.host for r in report.succeeded()], ['ok1', 'ok2'])
+        results = {r.host: r for r in report.results}
+        self.assertIsInstance(results['dead'].error, TimeoutError)
+        self.assertIsInstance(results['broken'].error, OSError)
+        self.assertEqual(results['ok2'].output, 'hello from ok2\nbye from ok2\n')
+
+
+@unittest.skipUnless(agent.agent_supported(), 'needs Unix domain sockets')
+class TestAgent(unittest.TestCase):
+
+    def test_sessions_are_reused(self):
+        seen = []
+
+        def run_command(u, command, params, context):
+            seen.append(u)
+            if command == 'fail':
+                raise ValueError('bad parameter')
+            context.print(command + ' ' + ' '.join(params) + ' to ' + context.path('a.prg'))
+            context.stdout.buffer.write(b'\x00\x01')
+            context.stdout.buffer.flush()
+
+        with tempfile.TemporaryDirectory() as d:
+            os.environ['U1541_CACHE_DIR'] = d
+            try:
+                a = agent.Agent(run_command)
+                path = os.path.join(d, 'agent.sock')
+                server = threading.Thread(target=a.serve, args=(path,))
+                server.start()
+                for _ in range(100):
+                    if agent.ping(path):
+                        break
+                    time.sleep(0.01)
+                self.assertEqual(os.stat(path).st_mode & 0o077, 0)
+                out, err = io.BytesIO(), io.BytesIO()
+                status = agent.forward(agent.connect(path), '10.0.0.1', 'run', ['/Usb0/a.prg'], stdout=out, stderr=err)
+                self.assertEqual(status, 0)
+                expected = 'run /Usb0/a.prg to ' + os.path.join(os.getcwd(), 'a.prg') + '\n'
+                self.assertEqual(out.getvalue(), expected.encode() + b'\x00\x01')
+                status = agent.forward(agent.connect(path), '10.0.0.1', 'fail', [], stdout=out, stderr=err)
+                self.assertEqual(status, 1)
+                self.assertIn(b'bad parameter', err.getvalue())
+                self.assertIs(seen[0], seen[1])
+                self.assertTrue(agent.stop(path))
+                server.join(5)
+                self.assertFalse(server.is_alive())
+                self.assertFalse(os.path.exists(path))
+            finally:
+                del os.environ['U1541_CACHE_DIR']
+
+
+    def test_devices_do_not_wait_for_each_other(self):
+        started, release = threading.Event(), threading.Event()
+
+        def run_command(u, command, params, context):
+            if command == 'block':
+                started.set()
+                release.wait(5)
+            context.print(u.ip_addr)
+
+        with tempfile.TemporaryDirectory() as d:
+            os.environ['U1541_CACHE_DIR'] = d
+            try:
+                a = agent.Agent(run_command, idle_timeout=0)
+                path = os.path.join(d, 'agent.sock')
+                server = threading.Thread(target=a.serve, args=(path,))
+                server.start()
+                for _ in range(100):
+                    if agent.ping(path):
+                        break
+                    time.sleep(0.01)
+                blocked_out = io.BytesIO()
+                blocked = threading.Thread(target=agent.forward, args=(agent.connect(path), '10.0.0.1', 'block', []),
+                                           kwargs={'stdout': blocked_out, 'stderr': io.BytesIO()})
+                blocked.start()
+                self.assertTrue(started.wait(5))
+                out = io.BytesIO()
+                self.assertEqual(agent.forward(agent.connect(path), '10.0.0.2', 'run', [], stdout=out,
+                                               stderr=io.BytesIO()), 0)
+                self.assertEqual(out.getvalue(), b'10.0.0.2\n')
+                # only the device without a running command is idle
+                a.close_idle_sessions()
+                self.assertEqual(list(a.sessions.keys()), ['10.0.0.1'])
+                release.set()
+                blocked.join(5)
+                self.assertEqual(blocked_out.getvalue(), b'10.0.0.1\n')
+                self.assertTrue(agent.stop(path))
+                server.join(5)
+            finally:
+                release.set()
+                del os.environ['U1541_CACHE_DIR']
+
+
+class TestWatch(unittest.TestCase):
+
+    def test_build_watcher(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.prg')
+            with open(path, 'wb') as f:
+                f.write(b'\x01\x08')
+            w = BuildWatcher(path, debounce=0)
+            self.assertIsNone(w.poll())
+            self.assertEqual(w.poll(), b'\x01\x08')
+            self.assertIsNone(w.poll())
+            # rebuilt with the same content
+            os.utime(path, ns=(0, 0))
+            self.assertIsNone(w.poll())
+            self.assertIsNone(w.poll())
+            with open(path, 'wb') as f:
+                f.write(b'\x01\x08\x60')
+            self.assertIsNone(w.poll())
+            self.assertEqual(w.poll(), b'\x01\x08\x60')
+
+    def test_stale_builds_are_not_run(self):
+        class FakeUltimate:
+            def __init__(self):
+                self.uploaded = []
+
+            def upload_file(self, local_path, remote_path, overwrite):
+                with open(local_path, 'rb') as f:
+                    self.uploaded.append(f.read())
+                if len(self.uploaded) == 1:
+                    # a newer build lands during the first upload
+                    with open(path, 'wb') as f:
+                        f.write(b'new')
+                    time.sleep(0.3)
+
+        runs = []
+        stop = threading.Event()
+
+        def run(remote_path):
+            runs.append(u.uploaded[-1])
+            stop.set()
+
+        u = FakeUltimate()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.prg')
+            with open(path, 'wb') as f:
+                f.write(b'old')
+            thread = threading.Thread(target=watch, args=(u, path, '/Usb0/a.prg', run),
+                                      kwargs={'interval': 0.01, 'debounce': 0.05, 'stop': stop, 'log': lambda m: None})
+            thread.start()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(u.uploaded, [b'old', b'new'])
+        self.assertEqual(runs, [b'new'])
@@ -2,6 +2,7 @@ import unittest
 
 from ultimate1541.ansi_reader import FixedAnsiReaderWriter
 from ultimate1541.console_manipulator import ConsoleManipulator
+from ultimate1541.escape_sequence import EscapeSequence
 from ultimate1541.pseudoscreen import PseudoScreen
 
 
@@ -41,3 +42,33 @@ class TestPseudoScreen(unittest.TestCase):
         s.print_all()
         rect = s.find_bordered_rectangle()
         self.assertEqual(rect, (3, 2, 9, 4))
+
+    def test_cursor_positioning(self):
+        s = prepare_screen(b'\x1bc\x1b[3;5HAB\x1b[1;1H\x1b[37;1mC')
+        self.assertEqual(s.line_count(), 3)
+        self.assertEqual(s.line(2), '    AB')
+        self.assertEqual(s.char_at(5, 2), 'B')
+        self.assertEqual(s.char_at(6, 2), ' ')
+        self.assertEqual(s.char_at(0, 1), ' ')
+        self.assertEqual(s.parse_rectangle(0, 0), [[(15, 'C')], [(7, 'AB')]])
+        self.assertEqual(s.find_all_occurences('B'), [(5, 2)])
+
+    def test_find_bordered_rectangle_tracks_changes(self):
+        r = FixedAnsiReaderWriter(
+            b'\x1bc\x1b(0lqqqqqqk\x1b(B\r\n'
+            b'\x1b(0x\x1b(B test \x1b(0x\x1b(B\r\n'
+            b'\x1b(0mqqqqqqj\x1b(B\r\n')
+        m = ConsoleManipulator(r)
+        m.refresh_screen()
+        s = m.screen
+        self.assertEqual(s.find_bordered_rectangle(), (1, 1, 7, 2))
+        menu = m.get_small_menu()
+        version = s.version
+        s.write(EscapeSequence('[H', [1, 1]))
+        s.write('┌')
+        self.assertEqual(s.version, version)
+        self.assertIs(m.get_small_menu(), menu)
+        s.write(EscapeSequence('[H', [2, 8]))
+        s.write(' ')
+        self.assertIsNone(s.find_bordered_rectangle())
+        self.assertIsNone(m.get_small_menu())
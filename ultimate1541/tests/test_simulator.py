@@ -0,0 +1,366 @@
+import asyncio
+import io
+import os
+import socket
+import tempfile
+import time
+import unittest
+import warnings
+
+import u1541
+from ultimate1541 import tracing
+from ultimate1541.aio import AsyncUltimate1541
+from ultimate1541.command_context import CommandContext
+from ultimate1541.console_manipulator import ConsoleManipulator
+from ultimate1541.listing import DirEntry, browser_order
+from ultimate1541.recording import ReplayAnsiReaderWriter, ReplayError, read_records, INBOUND, OUTBOUND
+from ultimate1541.simulator import Simulator
+from ultimate1541.simulator.telnet_server import KeyParser
+from ultimate1541.transfer import FtpPool
+
+
+def make_tree(root: str):
+    games = os.path.join(root, 'Usb0', 'GAMES')
+    os.makedirs(games)
+    os.makedirs(os.path.join(root, 'Usb1'))
+    for i in range(50):
+        with open(os.path.join(games, 'game{:02d}.prg'.format(i)), 'wb') as f:
+            f.write(bytes([1, 8, i]))
+
+
+class TestKeyParser(unittest.TestCase):
+
+    def test_split_sequences(self):
+        data = b'\x1b[B\x1b[12~\r\x00\x1b \x1b[D'
+        for split in range(len(data) + 1):
+            p = KeyParser()
+            self.assertEqual(p.feed(data[:split]) + p.feed(data[split:]),
+                             ['down', 'f2', 'return', 'escape', 'left'])
+
+
+class TestSimulator(unittest.TestCase):
+
+    def setUp(self):
+        # telnetlib is deprecated, but it is what the blocking client uses
+        warnings.simplefilter('ignore', DeprecationWarning)
+        self.root = tempfile.TemporaryDirectory()
+        make_tree(self.root.name)
+        self.simulator = Simulator(self.root.name).start()
+
+    def tearDown(self):
+        self.simulator.close()
+        self.root.cleanup()
+
+    def test_transfers(self):
+        with self.simulator.client() as u, tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.prg')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(100000))
+            u.upload_file(path, '/Usb1/a.prg', overwrite=True)
+            self.assertEqual(u.stat('/Usb1/a.prg').size, 100000)
+            u.download_file('/Usb1/a.prg', os.path.join(d, 'b.prg'))
+            with open(path, 'rb') as f1, open(os.path.join(d, 'b.prg'), 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+            self.assertEqual([e.name for e in u.list_dir('/Usb0')], ['GAMES'])
+
+    def test_trees(self):
+        with self.simulator.client() as u, tempfile.TemporaryDirectory() as d:
+            source = os.path.join(d, 'source')
+            os.makedirs(os.path.join(source, 'demos', 'old'))
+            contents = {'a.prg': os.urandom(100000), os.path.join('demos', 'b.prg'): os.urandom(10),
+                        os.path.join('demos', 'old', 'c.prg'): b''}
+            for name, data in contents.items():
+                with open(os.path.join(source, name), 'wb') as f:
+                    f.write(data)
+            self.assertEqual(len(u.upload_tree(source, '/Usb1/tree').succeeded()), 3)
+            self.assertTrue(u.is_dir('/Usb1/tree/demos/old'))
+            target = os.path.join(d, 'target')
+            self.assertEqual(len(u.download_tree('/Usb1/tree', target).succeeded()), 3)
+            for name, data in contents.items():
+                with open(os.path.join(target, name), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_interrupted_download(self):
+        with self.simulator.client() as u, tempfile.TemporaryDirectory() as d:
+            data = os.urandom(100000)
+            with open(os.path.join(self.root.name, 'Usb1', 'a.prg'), 'wb') as f:
+                f.write(data)
+            os.makedirs(os.path.join(self.root.name, 'Usb1', 'sub'))
+            target = os.path.join(d, 'target')
+            self.simulator.drop_downloads_after = 30000
+            report = u.download_tree('/Usb1', target)
+            self.assertEqual(len(report.failed()), 1)
+            # no truncated file under the real name
+            self.assertFalse(os.path.exists(os.path.join(target, 'a.prg')))
+            self.assertTrue(os.path.isdir(os.path.join(target, 'sub')))
+            self.simulator.drop_downloads_after = None
+            report = u.download_tree('/Usb1', target, resume=True)
+            self.assertEqual([r.size for r in report.succeeded()], [70000])
+            self.assertEqual(sorted(os.listdir(target)), ['a.prg', 'sub'])
+            with open(os.path.join(target, 'a.prg'), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_pool_checks_idle_connections(self):
+        pool = FtpPool(self.simulator.host, 1, port=self.simulator.ftp_port, idle_check_after=0)
+        try:
+            with pool.connection() as ftp:
+                first = ftp
+            with pool.connection() as ftp:
+                # still alive, so reused
+                self.assertIs(ftp, first)
+                # as if the server had dropped it while it was idle
+                ftp.sock.shutdown(socket.SHUT_RDWR)
+            with pool.connection() as ftp:
+                self.assertIsNot(ftp, first)
+                self.assertEqual(ftp.pwd(), '/')
+            self.assertEqual(pool.connections, [ftp])
+        finally:
+            pool.close()
+
+    def test_dir(self):
+        with self.simulator.client() as u, self.simulator.client() as other, tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'x.prg')
+            with open(path, 'wb') as f:
+                f.write(bytes(70000))
+            self.assertEqual(u.dir('/Usb1'), [])
+            other.upload_file(path, '/Usb1/x.prg')
+            lines = u.dir('/Usb1')
+            self.assertEqual(len(lines), 1)
+            self.assertTrue(lines[0].startswith('-rw'))
+            self.assertIn(' 70000 ', lines[0])
+            self.assertTrue(lines[0].endswith(' x.prg'))
+
+    def test_sync_without_mlsd(self):
+        self.simulator.mlsd = False
+        with self.simulator.client() as u, tempfile.TemporaryDirectory() as d:
+            os.makedirs(os.path.join(d, 'sub'))
+            for name in ['a.prg', os.path.join('sub', 'b.prg')]:
+                with open(os.path.join(d, name), 'wb') as f:
+                    f.write(os.urandom(1000))
+            self.assertEqual(len(u.sync(d, '/Usb1').transfers.succeeded()), 2)
+            report = u.sync(d, '/Usb1')
+            self.assertEqual(report.skipped, ['/Usb1/a.prg', '/Usb1/sub/b.prg'])
+            with open(os.path.join(d, 'a.prg'), 'wb') as f:
+                f.write(os.urandom(1000))
+            os.utime(os.path.join(d, 'a.prg'), ns=(0, 0))
+            report = u.sync(d, '/Usb1')
+            self.assertEqual([r.target for r in report.transfers.succeeded()], ['/Usb1/a.prg'])
+            with open(os.path.join(self.root.name, 'Usb1', 'a.prg'), 'rb') as f1, \
+                    open(os.path.join(d, 'a.prg'), 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_command_context(self):
+        # local paths and output go where the context says, not to the process's directory and standard output
+        with self.simulator.client() as u, tempfile.TemporaryDirectory() as d:
+            out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8', write_through=True)
+            context = CommandContext(out, out, d)
+            u1541.COMMANDS['download'](u, ['/Usb0/GAMES/game07.prg'], context)
+            with open(os.path.join(d, 'game07.prg'), 'rb') as f:
+                self.assertEqual(f.read(), bytes([1, 8, 7]))
+            u1541.COMMANDS['download'](u, ['/Usb0/GAMES/game08.prg', '-'], context)
+            u1541.COMMANDS['dir'](u, ['/Usb1'], context)
+            u1541.COMMANDS['upload'](u, ['game07.prg', '/Usb1/copy.prg'], context)
+            output = out.buffer.getvalue()
+            self.assertTrue(output.startswith(bytes([1, 8, 8]) + b'[1/1] '))
+            self.assertIn(b'\nUploaded ', output)
+            self.assertTrue(u.exists('/Usb1/copy.prg'))
+
+    def test_run_files(self):
+        stats = self.simulator.stats
+        with self.simulator.client() as u:
+            u.run_file('/Usb0/GAMES/game45.prg')
+            redraws = stats.redraws
+            # same directory, no need to go through the device list again
+            u.run_file('/Usb0/GAMES/game02.prg')
+            self.assertLessEqual(stats.redraws - redraws, 4)
+            with self.assertRaises(ValueError):
+                u.mount_file('/Usb0/GAMES/game03.prg')
+            u.run_file('/Usb0/GAMES/game03.prg')
+        self.assertEqual(self.simulator.events, [('Run', '/Usb0/GAMES/game45.prg'), ('Run', '/Usb0/GAMES/game02.prg'),
+                                                 ('Run', '/Usb0/GAMES/game03.prg')])
+
+    def test_browser_sorts_differently(self):
+        # the listing puts game45.prg far down, the browser near the top; it is found on the screen instead
+        self.simulator.browser_sort = lambda entries: sorted(entries, key=lambda e: e.name, reverse=True)
+        with self.simulator.client() as u:
+            u.run_file('/Usb0/GAMES/game45.prg')
+            u.run_file('/Usb0/GAMES/game40.prg')
+        self.assertEqual(self.simulator.events, [('Run', '/Usb0/GAMES/game45.prg'), ('Run', '/Usb0/GAMES/game40.prg')])
+
+    def test_mount_commands(self):
+        with self.simulator.client() as u, tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'disk.d64')
+            with open(path, 'wb') as f:
+                f.write(bytes(174848))
+            u1541.COMMANDS['um'](u, [path, '/Usb1/disk.d64'], CommandContext())
+            u1541.COMMANDS['mount'](u, ['/Usb1/disk.d64'], CommandContext())
+        self.assertEqual(self.simulator.events, [('Mount disk', '/Usb1/disk.d64'), ('Mount disk', '/Usb1/disk.d64')])
+
+    def test_settings(self):
+        with self.simulator.client() as u:
+            with u.settings() as s:
+                s.set_reu_enabled(True)
+                s.set_reu_size('2 MB')
+                s.set_by_name('Drive A Settings/Drive Type', '1581')
+            self.assertEqual(u.dump_settings()['C64 and cartridge settings']['REU Size'], '2 MB')
+        self.assertEqual(self.simulator.setting('C64 and cartridge settings', 'RAM Expansion Unit'), 'Enabled')
+        self.assertEqual(self.simulator.setting('Drive A Settings', 'Drive Type'), '1581')
+
+    def test_tracing(self):
+        tracing.enable()
+        try:
+            with self.simulator.client() as u, tempfile.TemporaryDirectory() as d:
+                path = os.path.join(d, 'a.prg')
+                with open(path, 'wb') as f:
+                    f.write(bytes(5000))
+                u.upload_file(path, '/Usb1/a.prg', overwrite=True)
+                u.run_file('/Usb1/a.prg')
+        finally:
+            tracer = tracing.disable()
+        summary = {s.name: s for s in tracer.summary()}
+        run = summary['Ultimate1541.run_file']
+        self.assertEqual(run.calls, 1)
+        self.assertGreater(run.counters['keys'], 0)
+        self.assertGreater(run.counters['bytes_received'], 0)
+        self.assertIn('ConsoleManipulator.browse_to', summary)
+        self.assertIn('ConsoleManipulator.wait_for_small_menu', summary)
+        self.assertEqual(summary['ftp.upload'].counters['transfer_bytes'], 5000)
+        self.assertEqual(summary['Ultimate1541.upload_file'].counters['transfer_bytes'], 5000)
+        events = [e for e in tracer.chrome_trace()['traceEvents'] if e['ph'] == 'X']
+        browse = next(e for e in events if e['name'] == 'ConsoleManipulator.browse_to')
+        outer = next(e for e in events if e['name'] == 'Ultimate1541.run_file')
+        self.assertEqual(outer['args']['arguments'], ['/Usb1/a.prg'])
+        self.assertLessEqual(outer['ts'], browse['ts'])
+        self.assertGreaterEqual(outer['ts'] + outer['dur'], browse['ts'] + browse['dur'])
+        self.assertIn('Ultimate1541.run_file', tracer.format_summary())
+        # nothing is recorded once tracing is off
+        self.assertIs(tracing.span('x'), tracing.NO_SPAN)
+
+    def test_record_and_replay(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'session.rec')
+            with self.simulator.client(record_to=path) as u:
+                u.run_file('/Usb0/GAMES/game45.prg')
+            records = read_records(path)
+        self.assertIn(INBOUND, [r.kind for r in records])
+        self.assertIn(OUTBOUND, [r.kind for r in records])
+        self.assertEqual([r.time for r in records], sorted(r.time for r in records))
+        games = os.listdir(os.path.join(self.root.name, 'Usb0', 'GAMES'))
+
+        def lister(location):
+            return [e.name for e in browser_order([DirEntry(n, 'file') for n in games])]
+
+        def replay(**kwargs) -> ConsoleManipulator:
+            # the same steps as Ultimate1541.run_file, without a device
+            c = ConsoleManipulator(ReplayAnsiReaderWriter(records, **kwargs))
+            c.directory_lister = lister
+            c.refresh_screen()
+            c.browse_to('Usb0', ['GAMES'])
+            c.select_entry('game45.prg', use_return=True)
+            c.wait_for_small_menu(timeout=1)
+            self.assertEqual(c.get_small_menu().items[0].label, 'Run')
+            c.select_option_by_name('Run')
+            return c
+
+        c = replay()
+        self.assertEqual(c.get_big_menu().items[c.get_big_menu().selected[0]].label, 'game45.prg')
+        c.close()
+        self.assertTrue(c.reader.finished())
+        # at the recorded speed, the screen takes as long to answer the keys as it did
+        responses = [r.time - p.time for p, r in zip(records, records[1:]) if p.kind == OUTBOUND and r.kind == INBOUND]
+        start = time.monotonic()
+        replay(realtime=True)
+        self.assertGreaterEqual(time.monotonic() - start, sum(responses))
+        c = ConsoleManipulator(ReplayAnsiReaderWriter(records))
+        c.refresh_screen()
+        c.press(b'\x1b[12~')
+        with self.assertRaises(ReplayError):
+            c.refresh_screen()
+
+    def test_run_local(self):
+        program = bytes([0x01, 0x08]) + os.urandom(3000)
+        with tempfile.TemporaryDirectory() as d, self.simulator.client() as u:
+            path = os.path.join(d, 'a.prg')
+            with open(path, 'wb') as f:
+                f.write(program)
+            u.run_local_file(path)
+            with self.assertRaises(ValueError):
+                u.run_prg(bytes([0x00, 0xff]) + bytes(1000))
+        deadline = time.monotonic() + 5
+        while not self.simulator.dma_events and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.simulator.dma_events, [('Run', program)])
+        self.assertEqual(bytes(self.simulator.memory[0x0801:0x0801 + 3000]), program[2:])
+        # neither the menu nor the file system was touched
+        self.assertEqual(self.simulator.stats.redraws, 0)
+        self.assertEqual(self.simulator.stats.ftp_commands, 0)
+
+
+class TestAsyncSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        make_tree(self.root.name)
+        self.simulator = Simulator(self.root.name).start()
+
+    def tearDown(self):
+        self.simulator.close()
+        self.root.cleanup()
+
+    def client(self) -> AsyncUltimate1541:
+        return AsyncUltimate1541(self.simulator.host, telnet_port=self.simulator.telnet_port,
+                                 ftp_port=self.simulator.ftp_port)
+
+    def test_transfers(self):
+        async def main(d: str):
+            path = os.path.join(d, 'a.prg')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(100000))
+            async with self.client() as u:
+                self.assertEqual(await u.upload_file(path, '/Usb1/a.prg', overwrite=True, blocksize=4096), 100000)
+                self.assertEqual((await u.stat('/Usb1/a.prg')).size, 100000)
+                self.assertEqual(await u.download_file('/Usb1/a.prg', os.path.join(d, 'b.prg')), 100000)
+                # nothing left to send or receive
+                self.assertEqual(await u.upload_file(path, '/Usb1/a.prg', resume=True), 0)
+                self.assertEqual(await u.download_file('/Usb1/a.prg', os.path.join(d, 'b.prg'), resume=True), 0)
+                self.assertEqual([e.name for e in await u.list_dir('/Usb0')], ['GAMES'])
+                self.assertEqual(len(await u.list_dir('/Usb0/GAMES')), 50)
+                self.assertTrue(await u.is_dir('/Usb0/GAMES'))
+                self.assertFalse(await u.exists('/Usb1/b.prg'))
+                lines = await u.dir('/Usb1')
+                self.assertEqual(len(lines), 1)
+                self.assertTrue(lines[0].endswith(' a.prg'))
+                await u.delete_file('/Usb1/a.prg')
+                self.assertEqual(await u.list_dir('/Usb1'), [])
+            with open(path, 'rb') as f1, open(os.path.join(d, 'b.prg'), 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+        with tempfile.TemporaryDirectory() as d:
+            asyncio.run(main(d))
+
+    def test_run_files(self):
+        async def main():
+            async with self.client() as u:
+                # not on the first screen of the directory, found with the help of the FTP listing
+                await u.run_file('/Usb0/GAMES/game45.prg')
+                await u.run_file('/Usb0/GAMES/game02.prg')
+                with self.assertRaises(ValueError):
+                    await u.mount_file('/Usb0/GAMES/game03.prg')
+
+        asyncio.run(main())
+        self.assertEqual(self.simulator.events, [('Run', '/Usb0/GAMES/game45.prg'), ('Run', '/Usb0/GAMES/game02.prg')])
+
+    def test_settings(self):
+        async def main():
+            async with self.client() as u:
+                async with u.settings() as s:
+                    s.set_reu_enabled(True)
+                    s.set_reu_size('2 MB')
+                with self.assertRaises(TypeError):
+                    with u.settings():
+                        pass
+                return await u.dump_settings()
+
+        settings = asyncio.run(main())
+        self.assertEqual(settings['C64 and cartridge settings']['REU Size'], '2 MB')
+        self.assertEqual(self.simulator.setting('C64 and cartridge settings', 'RAM Expansion Unit'), 'Enabled')
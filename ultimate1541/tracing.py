@@ -0,0 +1,241 @@
+import json
+import threading
+from functools import wraps
+from time import perf_counter
+from typing import Optional, List, Dict, Callable, Any
+
+# Opt-in tracing of where the time goes: nested spans for the public methods of Ultimate1541 and the steps of
+# ConsoleManipulator, with counters of keys, bytes sent and received, time spent waiting for the screen
+# and bytes transferred over FTP. Nothing is recorded unless enable() was called;
+# the instrumentation then costs one check of the global tracer.
+
+COUNTERS = ('keys', 'bytes_sent', 'bytes_received', 'wait_s', 'transfer_bytes')
+
+
+class Span:
+    __slots__ = ('name', 'args', 'thread', 'start', 'end', 'children_time', 'counters')
+
+    def __init__(self, name: str, args: Optional[Dict[str, Any]], thread: int, start: float):
+        self.name: str = name
+        self.args: Optional[Dict[str, Any]] = args
+        self.thread: int = thread
+        self.start: float = start
+        self.end: float = start
+        # time spent in nested spans, so that the time of the span itself can be told apart
+        self.children_time: float = 0.0
+        # including those of nested spans
+        self.counters: Dict[str, float] = {}
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class SpanSummary:
+    def __init__(self, name: str):
+        self.name: str = name
+        self.calls: int = 0
+        self.total: float = 0.0
+        self.own: float = 0.0
+        self.longest: float = 0.0
+        self.counters: Dict[str, float] = {}
+
+    def throughput(self) -> Optional[float]:
+        # bytes per second of FTP transfers
+        size = self.counters.get('transfer_bytes', 0)
+        if size == 0 or self.total <= 0:
+            return None
+        return size / self.total
+
+
+class Tracer:
+    def __init__(self):
+        self.origin: float = perf_counter()
+        self.spans: List[Span] = []
+        self.thread_names: Dict[int, str] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.local: threading.local = threading.local()
+
+    def stack(self) -> List[Span]:
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def begin(self, name: str, args: Optional[Dict[str, Any]] = None) -> Span:
+        thread = threading.current_thread()
+        if thread.ident not in self.thread_names:
+            with self.lock:
+                self.thread_names[thread.ident] = thread.name
+        span = Span(name, args, thread.ident, perf_counter())
+        self.stack().append(span)
+        return span
+
+    def end(self, span: Span):
+        span.end = perf_counter()
+        stack = self.stack()
+        # spans end in the opposite order they began, unless a generator was abandoned
+        while stack and stack.pop() is not span:
+            pass
+        if stack:
+            parent = stack[-1]
+            parent.children_time += span.duration
+            for key, value in span.counters.items():
+                parent.counters[key] = parent.counters.get(key, 0) + value
+        with self.lock:
+            self.spans.append(span)
+
+    def count(self, counters: Dict[str, float]):
+        stack = self.stack()
+        if stack:
+            span_counters = stack[-1].counters
+            for key, value in counters.items():
+                span_counters[key] = span_counters.get(key, 0) + value
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        # the format of chrome://tracing and https://ui.perfetto.dev
+        events: List[Dict[str, Any]] = []
+        with self.lock:
+            spans = list(self.spans)
+            thread_names = dict(self.thread_names)
+        for thread, name in thread_names.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': thread, 'args': {'name': name}})
+        for span in sorted(spans, key=lambda s: s.start):
+            args: Dict[str, Any] = dict(span.args) if span.args else {}
+            args.update(span.counters)
+            events.append({'name': span.name, 'cat': span.name.split('.', 1)[0], 'ph': 'X', 'pid': 1,
+                           'tid': span.thread, 'ts': (span.start - self.origin) * 1e6, 'dur': span.duration * 1e6,
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self) -> List[SpanSummary]:
+        # by span name, the slowest first
+        result: Dict[str, SpanSummary] = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            s = result.get(span.name)
+            if s is None:
+                s = result[span.name] = SpanSummary(span.name)
+            s.calls += 1
+            s.total += span.duration
+            s.own += span.duration - span.children_time
+            s.longest = max(s.longest, span.duration)
+            for key, value in span.counters.items():
+                s.counters[key] = s.counters.get(key, 0) + value
+        return sorted(result.values(), key=lambda s: s.total, reverse=True)
+
+    def format_summary(self) -> str:
+        lines = ['{:48} {:>6} {:>10} {:>10} {:>10} {:>6} {:>8} {:>9} {:>9} {:>11}'.format(
+            'span', 'calls', 'total ms', 'own ms', 'max ms', 'keys', 'sent', 'received', 'wait ms', 'transfer')]
+        for s in self.summary():
+            throughput = s.throughput()
+            lines.append('{:48} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>6} {:>8} {:>9} {:>9.1f} {:>11}'.format(
+                s.name[:48], s.calls, s.total * 1000, s.own * 1000, s.longest * 1000,
+                int(s.counters.get('keys', 0)), int(s.counters.get('bytes_sent', 0)),
+                int(s.counters.get('bytes_received', 0)), s.counters.get('wait_s', 0) * 1000,
+                '' if throughput is None else '{:.0f} kB/s'.format(throughput / 1000)))
+        return '\n'.join(lines)
+
+
+tracer: Optional[Tracer] = None
+
+
+def enable() -> Tracer:
+    global tracer
+    if tracer is None:
+        tracer = Tracer()
+    return tracer
+
+
+def disable() -> Optional[Tracer]:
+    # returns what was recorded
+    global tracer
+    result, tracer = tracer, None
+    return result
+
+
+class ActiveSpan:
+    __slots__ = ('tracer', 'name', 'args', 'span')
+
+    def __init__(self, active: Tracer, name: str, args: Optional[Dict[str, Any]]):
+        self.tracer: Tracer = active
+        self.name: str = name
+        self.args: Optional[Dict[str, Any]] = args
+        self.span: Optional[Span] = None
+
+    def __enter__(self) -> Span:
+        self.span = self.tracer.begin(self.name, self.args)
+        return self.span
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            self.span.counters['error'] = 1
+        self.tracer.end(self.span)
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name: str, **args):
+    # with span('ftp.upload', path=path): ...
+    active = tracer
+    if active is None:
+        return NO_SPAN
+    return ActiveSpan(active, name, args or None)
+
+
+def count(**counters: float):
+    # adds to the counters of the innermost span of this thread
+    active = tracer
+    if active is not None:
+        active.count(counters)
+
+
+def traced(fn: Callable) -> Callable:
+    # a span for every call of the method, named after it and with its string arguments
+    name = fn.__qualname__
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        active = tracer
+        if active is None:
+            return fn(*args, **kwargs)
+        strings = [a for a in args[1:] if isinstance(a, str)]
+        with ActiveSpan(active, name, {'arguments': strings} if strings else None):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def traced_steps(fn: Callable) -> Callable:
+    # like traced, for the generator methods of ConsoleManipulator that both clients drive:
+    # the span lasts until the steps are finished and is named without the _steps suffix
+    name = fn.__qualname__
+    if name.endswith('_steps'):
+        name = name[:-len('_steps')]
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        active = tracer
+        if active is None:
+            return (yield from fn(*args, **kwargs))
+        strings = [a for a in args[1:] if isinstance(a, str)]
+        with ActiveSpan(active, name, {'arguments': strings} if strings else None):
+            return (yield from fn(*args, **kwargs))
+
+    return wrapper
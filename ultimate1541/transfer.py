@@ -0,0 +1,375 @@
+import mmap
+import os
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from ftplib import FTP, error_reply, error_perm, error_temp
+from queue import Queue, Empty
+from time import monotonic
+from typing import Optional, List, Tuple, Iterator, Callable, BinaryIO
+
+from ultimate1541 import tracing
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_BLOCK_SIZE = 64 * 1024
+# downloads are written under the local name with this suffix, and renamed once they are complete
+PARTIAL_SUFFIX = '.part'
+
+FTP_ERRORS = (OSError, EOFError, error_reply, error_temp, error_perm)
+
+# an FTP control connection idle for longer than this is checked with NOOP before reuse
+FTP_IDLE_CHECK_AFTER: float = 30.0
+
+
+class UltimateFTP(FTP):
+    # remembers the current directory, so that consecutive operations in one directory do not repeat CWD
+    current_dir: Optional[str] = None
+    # cleared once the server rejects MLSD
+    mlsd_supported: bool = True
+
+    def __init__(self, host: str = '', port: int = 21, timeout: Optional[float] = None):
+        super().__init__(timeout=timeout)
+        if host:
+            self.connect(host, port)
+            self.login()
+
+    def cwd(self, dirname: str):
+        if dirname == self.current_dir:
+            return '250 OK'
+        self.current_dir = None
+        response = super().cwd(dirname)
+        if dirname.startswith('/'):
+            self.current_dir = dirname
+        return response
+
+
+class FtpPool:
+    def __init__(self, ip_addr: str, size: int = DEFAULT_CONCURRENCY, *, timeout: Optional[float] = None,
+                 port: int = 21, idle_check_after: float = FTP_IDLE_CHECK_AFTER):
+        if size < 1:
+            raise ValueError('Pool size must be positive')
+        self.ip_addr: str = ip_addr
+        self.port: int = port
+        self.size: int = size
+        self.timeout: Optional[float] = timeout
+        self.idle_check_after: float = idle_check_after
+        # (connection, when it was last returned to the pool)
+        self.idle: Queue = Queue()
+        self.lock: threading.Lock = threading.Lock()
+        self.connections: List[UltimateFTP] = []
+        self.slots: threading.BoundedSemaphore = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self) -> Iterator[UltimateFTP]:
+        self.slots.acquire()
+        ftp = None
+        try:
+            ftp = self.__idle_connection()
+            if ftp is None:
+                ftp = UltimateFTP(self.ip_addr, self.port, timeout=self.timeout)
+                with self.lock:
+                    self.connections.append(ftp)
+            yield ftp
+            self.idle.put((ftp, monotonic()))
+        except BaseException:
+            # the connection may be in the middle of a transfer, it cannot be reused
+            if ftp is not None:
+                self.discard(ftp)
+            raise
+        finally:
+            self.slots.release()
+
+    def __idle_connection(self) -> Optional[UltimateFTP]:
+        while True:
+            try:
+                ftp, last_used = self.idle.get_nowait()
+            except Empty:
+                return None
+            if monotonic() - last_used <= self.idle_check_after:
+                return ftp
+            # the server may have dropped an idle control connection in the meantime
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp
+            except FTP_ERRORS:
+                self.discard(ftp)
+
+    def discard(self, ftp: UltimateFTP):
+        with self.lock:
+            if ftp in self.connections:
+                self.connections.remove(ftp)
+        ftp.close()
+
+    def close(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        self.idle = Queue()
+        for ftp in connections:
+            try:
+                ftp.quit()
+            except FTP_ERRORS:
+                ftp.close()
+
+
+class TransferResult:
+    def __init__(self, source: str, target: str):
+        self.source: str = source
+        self.target: str = target
+        self.size: int = 0
+        self.seconds: float = 0.0
+        self.error: Optional[Exception] = None
+
+    def __str__(self):
+        if self.error is not None:
+            return self.source + ' -> ' + self.target + ': ' + str(self.error)
+        return self.source + ' -> ' + self.target + ': ' + format_throughput(self.size, self.seconds)
+
+
+class TransferReport:
+    def __init__(self):
+        self.results: List[TransferResult] = []
+        # number of results already complete, for progress reporting
+        self.finished: int = 0
+        self.seconds: float = 0.0
+
+    def succeeded(self) -> List[TransferResult]:
+        return [r for r in self.results if r.error is None]
+
+    def failed(self) -> List[TransferResult]:
+        return [r for r in self.results if r.error is not None]
+
+    def total_size(self) -> int:
+        return sum(r.size for r in self.succeeded())
+
+    def __str__(self):
+        text = '{} files, {}'.format(len(self.succeeded()), format_throughput(self.total_size(), self.seconds))
+        if self.failed():
+            text += ', {} failed'.format(len(self.failed()))
+        return text
+
+
+def format_throughput(size: int, seconds: float) -> str:
+    if seconds <= 0:
+        return '{} bytes'.format(size)
+    return '{} bytes in {:.2f} s ({:.1f} kB/s)'.format(size, seconds, size / seconds / 1000)
+
+
+def delete_quietly(ftp: FTP, name: str):
+    try:
+        ftp.delete(name)
+    except (error_perm, error_reply):
+        pass
+
+
+def remote_size(ftp: FTP, name: str) -> Optional[int]:
+    try:
+        return ftp.size(name)
+    except (error_perm, error_reply):
+        return None
+
+
+def resume_offset(done: int, size: Optional[int]) -> Optional[int]:
+    # Where an interrupted transfer continues, given how much of the file the target already has
+    # and the size of the source, if known: 0 if the target is not a partial copy, None if it is complete.
+    if size is None:
+        return done
+    if done == size:
+        return None
+    if done > size:
+        return 0
+    return done
+
+
+def partial_path(local_path: str) -> str:
+    return local_path + PARTIAL_SUFFIX
+
+
+def resume_download(local_path: str, size: Callable[[], Optional[int]]) -> Optional[int]:
+    # Where a resumed download continues in the partial file, given a function for the size of the remote file;
+    # None if there is nothing left to receive, after renaming a partial file that turned out complete.
+    partial = partial_path(local_path)
+    if not os.path.exists(partial):
+        if os.path.exists(local_path) and os.path.getsize(local_path) == size():
+            return None
+        return 0
+    offset = resume_offset(os.path.getsize(partial), size())
+    if offset is None:
+        os.replace(partial, local_path)
+    return offset
+
+
+def open_data_connection(ftp: FTP, command: str, offset: int) -> Optional[socket.socket]:
+    # None means the server does not support REST
+    try:
+        return ftp.transfercmd(command, offset)
+    except (error_perm, error_reply):
+        return None
+
+
+def send_stream(conn: socket.socket, f: BinaryIO, blocksize: int) -> int:
+    buffer = bytearray(blocksize)
+    view = memoryview(buffer)
+    count = 0
+    while True:
+        n = f.readinto(buffer)
+        if not n:
+            return count
+        conn.sendall(view[:n])
+        count += n
+
+
+def send_file(conn: socket.socket, f: BinaryIO, offset: int, size: int, blocksize: int) -> int:
+    if offset >= size:
+        return 0
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # not a regular file
+        f.seek(offset)
+        return send_stream(conn, f, blocksize)
+    with mapped:
+        view = memoryview(mapped)
+        try:
+            for position in range(offset, size, blocksize):
+                conn.sendall(view[position:position + blocksize])
+        finally:
+            view.release()
+    return size - offset
+
+
+def upload(ftp: FTP, local_path: str, remote_path: str, *, overwrite: bool = False, resume: bool = False,
+           blocksize: int = DEFAULT_BLOCK_SIZE) -> int:
+    # returns the number of bytes sent; a local path of - means the standard input
+    with tracing.span('ftp.upload', path=remote_path):
+        count = store(ftp, local_path, remote_path, overwrite=overwrite, resume=resume, blocksize=blocksize)
+        tracing.count(transfer_bytes=count)
+        return count
+
+
+def store(ftp: FTP, local_path: str, remote_path: str, *, overwrite: bool, resume: bool, blocksize: int) -> int:
+    ftp.cwd(os.path.dirname(remote_path))
+    name = os.path.basename(remote_path)
+    command = 'STOR {}'.format(name)
+    ftp.voidcmd('TYPE I')
+    if local_path == '-':
+        if overwrite:
+            delete_quietly(ftp, name)
+        with ftp.transfercmd(command) as conn:
+            count = send_stream(conn, sys.stdin.buffer, blocksize)
+        ftp.voidresp()
+        return count
+    with open(local_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        if resume:
+            offset = resume_offset(remote_size(ftp, name) or 0, size)
+            if offset is None:
+                return 0
+        conn = open_data_connection(ftp, command, offset) if offset > 0 else None
+        if conn is None:
+            offset = 0
+            if overwrite:
+                delete_quietly(ftp, name)
+            conn = ftp.transfercmd(command)
+        with conn:
+            count = send_file(conn, f, offset, size, blocksize)
+        ftp.voidresp()
+        return count
+
+
+def download(ftp: FTP, remote_path: str, local_path: str, *, resume: bool = False,
+             blocksize: int = DEFAULT_BLOCK_SIZE, output: Optional[BinaryIO] = None) -> int:
+    # returns the number of bytes received; a local path of - means the output stream, the standard output by default
+    with tracing.span('ftp.download', path=remote_path):
+        count = retrieve(ftp, remote_path, local_path, resume=resume, blocksize=blocksize, output=output)
+        tracing.count(transfer_bytes=count)
+        return count
+
+
+def retrieve(ftp: FTP, remote_path: str, local_path: str, *, resume: bool, blocksize: int,
+             output: Optional[BinaryIO] = None) -> int:
+    ftp.cwd(os.path.dirname(remote_path))
+    name = os.path.basename(remote_path)
+    command = 'RETR {}'.format(name)
+    ftp.voidcmd('TYPE I')
+    offset = 0
+    if resume and local_path != '-':
+        offset = resume_download(local_path, lambda: remote_size(ftp, name))
+        if offset is None:
+            return 0
+    conn = open_data_connection(ftp, command, offset) if offset > 0 else None
+    if conn is None:
+        offset = 0
+        conn = ftp.transfercmd(command)
+    buffer = bytearray(blocksize)
+    view = memoryview(buffer)
+    count = 0
+    with conn:
+        if local_path == '-':
+            out = output if output is not None else sys.stdout.buffer
+        else:
+            # an interrupted download never leaves a truncated file under the local name
+            out = open(partial_path(local_path), 'ab' if offset > 0 else 'wb')
+        try:
+            while True:
+                n = conn.recv_into(buffer)
+                if n == 0:
+                    break
+                out.write(view[:n])
+                count += n
+        finally:
+            if local_path == '-':
+                out.flush()
+            else:
+                out.close()
+    ftp.voidresp()
+    if local_path != '-':
+        os.replace(partial_path(local_path), local_path)
+    return count
+
+
+def bulk_transfer(pool: FtpPool, files: List[Tuple[str, str]], operation: Callable[[FTP, str, str], int], *,
+                  concurrency: int = DEFAULT_CONCURRENCY,
+                  progress: Optional[Callable[[TransferResult, TransferReport], None]] = None) -> TransferReport:
+    report = TransferReport()
+    lock = threading.Lock()
+
+    def transfer(result: TransferResult):
+        start = monotonic()
+        try:
+            with pool.connection() as ftp:
+                result.size = operation(ftp, result.source, result.target)
+        except FTP_ERRORS as e:
+            result.error = e
+        result.seconds = monotonic() - start
+        with lock:
+            report.finished += 1
+            if progress is not None:
+                progress(result, report)
+
+    report.results = [TransferResult(source, target) for source, target in files]
+    start = monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, pool.size))) as executor:
+        list(executor.map(transfer, report.results))
+    report.seconds = monotonic() - start
+    return report
+
+
+def bulk_upload(pool: FtpPool, files: List[Tuple[str, str]], *, overwrite: bool = False, resume: bool = False,
+                blocksize: int = DEFAULT_BLOCK_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+                progress: Optional[Callable[[TransferResult, TransferReport], None]] = None) -> TransferReport:
+    return bulk_transfer(pool, files,
+                         lambda ftp, source, target: upload(ftp, source, target, overwrite=overwrite, resume=resume,
+                                                            blocksize=blocksize),
+                         concurrency=concurrency, progress=progress)
+
+
+def bulk_download(pool: FtpPool, files: List[Tuple[str, str]], *, resume: bool = False,
+                  blocksize: int = DEFAULT_BLOCK_SIZE, concurrency: int = DEFAULT_CONCURRENCY,
+                  progress: Optional[Callable[[TransferResult, TransferReport], None]] = None) -> TransferReport:
+    return bulk_transfer(pool, files,
+                         lambda ftp, source, target: download(ftp, source, target, resume=resume, blocksize=blocksize),
+                         concurrency=concurrency, progress=progress)
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from time import monotonic
+from typing import Optional, Callable, Tuple, TYPE_CHECKING
+
+from ultimate1541.transfer import FTP_ERRORS
+
+if TYPE_CHECKING:
+    from ultimate1541 import Ultimate1541
+
+# how often the file is looked at, in seconds
+DEFAULT_POLL_INTERVAL = 0.2
+# how long the file must stay unchanged before it is considered a finished build, in seconds
+DEFAULT_DEBOUNCE = 0.3
+
+
+class BuildWatcher:
+    # Polls a build artifact. A new build is reported once the file has stopped changing for the debounce time
+    # and its content differs from the previous build, so that rebuilds producing the same bytes are ignored.
+
+    def __init__(self, path: str, *, debounce: float = DEFAULT_DEBOUNCE):
+        self.path: str = path
+        self.debounce: float = debounce
+        self.signature: Optional[Tuple[int, int]] = None
+        self.changed_at: Optional[float] = None
+        self.last_hash: Optional[str] = None
+
+    def poll(self) -> Optional[bytes]:
+        # returns the content of a new build, or None
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            # being rewritten
+            self.signature = None
+            self.changed_at = None
+            return None
+        now = monotonic()
+        signature = (st.st_mtime_ns, st.st_size)
+        if signature != self.signature:
+            self.signature = signature
+            self.changed_at = now
+            return None
+        if self.changed_at is None or now - self.changed_at < self.debounce:
+            return None
+        self.changed_at = None
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) != st.st_size:
+            # changed while being read, try again later
+            self.signature = None
+            return None
+        sha1 = hashlib.sha1(data).hexdigest()
+        if sha1 == self.last_hash:
+            return None
+        self.last_hash = sha1
+        return data
+
+
+def watch(u: 'Ultimate1541', local_path: str, remote_path: str, then: Optional[Callable[[str], None]] = None, *,
+          interval: float = DEFAULT_POLL_INTERVAL, debounce: float = DEFAULT_DEBOUNCE,
+          stop: Optional[threading.Event] = None, log: Callable[[str], None] = print):
+    # Uploads every new build of local_path to remote_path and then calls `then` with the remote path,
+    # e.g. to run it, until `stop` is set.
+    # The same Ultimate1541 is used throughout, so its connections stay open between builds.
+    # Builds are polled in the background; if another build arrives while one is being uploaded,
+    # the stale one is not run and only the newest build is uploaded next.
+    stop = stop if stop is not None else threading.Event()
+    watcher = BuildWatcher(local_path, debounce=debounce)
+    lock = threading.Lock()
+    arrived = threading.Event()
+    latest = [None]
+
+    def poll():
+        while not stop.wait(interval):
+            data = watcher.poll()
+            if data is not None:
+                with lock:
+                    if latest[0] is not None:
+                        log('Newer build replaces one that was not uploaded yet')
+                    latest[0] = data
+                arrived.set()
+
+    def take() -> Optional[bytes]:
+        with lock:
+            data = latest[0]
+            latest[0] = None
+            arrived.clear()
+        return data
+
+    poller = threading.Thread(target=poll, name='u1541-watch', daemon=True)
+    poller.start()
+    snapshot_dir = tempfile.mkdtemp(prefix='u1541-watch-')
+    # the upload reads a private copy, which the next build cannot change or truncate under it
+    snapshot = os.path.join(snapshot_dir, os.path.basename(local_path))
+    try:
+        while not stop.is_set():
+            if not arrived.wait(interval):
+                continue
+            data = take()
+            if data is None:
+                continue
+            with open(snapshot, 'wb') as f:
+                f.write(data)
+            start = monotonic()
+            try:
+                u.upload_file(snapshot, remote_path, overwrite=True)
+                if arrived.is_set():
+                    log('Uploaded a stale build, skipping it')
+                    continue
+                if then is not None:
+                    then(remote_path)
+            except FTP_ERRORS + (ValueError,) as e:
+                # keep watching, the next build tries again
+                log('Failed: ' + str(e))
+                if isinstance(e, (OSError, EOFError)):
+                    u.close()
+                continue
+            log('Build of {} bytes done in {:.2f} s'.format(len(data), monotonic() - start))
+    finally:
+        stop.set()
+        poller.join()
+        shutil.rmtree(snapshot_dir, ignore_errors=True)